@@ -0,0 +1,171 @@
+"""Account deletion for Warbler.
+
+Deleting an account happens in two steps:
+
+1. `tombstone()` marks the user deleted inside the request and ends
+   their sessions. From then on they can't log in and are hidden from
+   pages and the API.
+2. A background job runs `purge()`, which deletes the user's likes,
+   follows and messages in small committed chunks and finally the user
+   row. Each chunk is short, so a very active account never holds long
+   locks or times out a request. Rows that reference the deleted
+   messages (likes by other users) go with them through the foreign
+   keys' ON DELETE CASCADE.
+
+Each chunk of likes and follows is announced once committed: the
+likes with one `likes_removed` event, the follows with the same
+`follows_removed` events unfollowing publishes. So the other users'
+activity rollups, trending counts, notifications and follow graph lose
+the purged user's likes and follows as if they had been undone.
+
+Ops can also purge a user in the foreground and watch its progress:
+
+    FLASK_APP=app.py flask purge-user <user_id>
+"""
+
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+import jobs
+import sessions
+from models import db, User, Message, Follows, Likes
+
+# Rows deleted per committed chunk, unless PURGE_CHUNK_SIZE is set.
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def tombstone(user):
+    """Mark `user` deleted and queue the purge of their data.
+
+    Commits the tombstone so the account disappears at once; the purge
+    runs after the request.
+    """
+
+    user.deleted_at = datetime.utcnow()
+    db.session.commit()
+    sessions.revoke_user(user.id)
+
+    jobs.publish('user_deleted', key=f"purge:{user.id}", user_id=user.id)
+
+
+def _purge_steps(user_id):
+    """(name, model, chunk key column, filter, columns) for each table to
+    empty.
+
+    `columns` are read with each chunk's keys, for `_removed_events`.
+    """
+
+    author_id = (db.select([Message.user_id])
+                 .where(Message.id == Likes.message_id)
+                 .as_scalar())
+
+    return [
+        ('likes', Likes, Likes.id, Likes.user_id == user_id,
+         (Likes.message_id, author_id)),
+        ('following', Follows, Follows.user_being_followed_id,
+         Follows.user_following_id == user_id, ()),
+        ('followers', Follows, Follows.user_following_id,
+         Follows.user_being_followed_id == user_id, ()),
+        ('messages', Message, Message.id, Message.user_id == user_id, ()),
+    ]
+
+
+def _removed_events(name, user_id, rows):
+    """(event, payload) pairs announcing that step `name` deleted `rows`."""
+
+    if name == 'likes':
+        return [('likes_removed', {'user_id': user_id, 'likes': [
+            [message_id, author_id] for like_id, message_id, author_id in rows
+        ]})]
+
+    if name == 'following':
+        return [('follows_removed', {
+            'user_id': user_id, 'followed_ids': [row[0] for row in rows]})]
+
+    if name == 'followers':
+        return [('follows_removed', {
+            'user_id': follower_id, 'followed_ids': [user_id]})
+            for follower_id, in rows]
+
+    return []
+
+
+def remaining(user_id):
+    """Rows still left to purge for `user_id`, by step name."""
+
+    return {
+        name: model.query.filter(criterion).count()
+        for name, model, key, criterion, columns in _purge_steps(user_id)
+    }
+
+
+def purge(user_id, chunk_size=None):
+    """Delete a tombstoned user's rows in chunks, then the user.
+
+    A generator: yields a progress dict after every committed chunk.
+    Safe to re-run after an interruption; it picks up where it stopped.
+    """
+
+    if chunk_size is None:
+        chunk_size = current_app.config.get(
+            'PURGE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+
+    deleted = {}
+
+    for name, model, key, criterion, columns in _purge_steps(user_id):
+        deleted[name] = 0
+
+        while True:
+            rows = (db.session.query(key, *columns)
+                    .filter(criterion)
+                    .limit(chunk_size)
+                    .all())
+            if not rows:
+                db.session.commit()
+                break
+
+            count = (model.query
+                     .filter(criterion, key.in_([row[0] for row in rows]))
+                     .delete(synchronize_session=False))
+            db.session.commit()
+
+            for event, payload in _removed_events(name, user_id, rows):
+                jobs.publish(event, **payload)
+
+            deleted[name] += count
+            yield {'step': name, 'deleted': dict(deleted)}
+
+    User.query.filter(User.id == user_id).delete(synchronize_session=False)
+    db.session.commit()
+
+    yield {'step': 'done', 'deleted': deleted}
+
+
+@jobs.on('user_deleted')
+def purge_deleted_user(user_id):
+    """Background job: purge a user deleted through the site."""
+
+    for progress in purge(user_id):
+        current_app.logger.info("Purging user %s: %s", user_id, progress)
+
+
+@click.command('purge-user')
+@click.argument('user_id', type=int)
+@with_appcontext
+def purge_user_command(user_id):
+    """Tombstone and purge a user now, printing progress."""
+
+    user = User.query.get(user_id)
+    if user is None:
+        raise click.BadParameter(f"No user #{user_id}.")
+
+    if user.deleted_at is None:
+        user.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+    click.echo(f"Remaining: {remaining(user_id)}")
+    for progress in purge(user_id):
+        click.echo(f"{progress['step']}: {progress['deleted']}")
@@ -0,0 +1,190 @@
+"""Monthly activity rollups and archive pages for Warbler.
+
+`monthly_activity` holds one row per user per month: messages posted
+and likes received on them. Job handlers keep it current as messages are
+posted, deleted, liked and unliked, so a user's history can be listed
+by month without counting `messages`. The archive pages then read one
+month of messages through the `(user_id, timestamp)` index.
+
+Rows can be rebuilt from scratch, e.g. after a backfill:
+
+    FLASK_APP=app.py flask rebuild-activity [<user_id>]
+"""
+
+from collections import Counter, OrderedDict
+from datetime import date, datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func
+
+import jobs
+from models import db, Message, Likes, MonthlyActivity
+
+
+def month_of(timestamp):
+    """First day of the month `timestamp` falls in."""
+
+    return date(timestamp.year, timestamp.month, 1)
+
+
+def month_bounds(year, month):
+    """`(start, end)` datetimes of a month; raises ValueError if invalid."""
+
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+
+    return start, end
+
+
+def months(user_id):
+    """A user's months with any activity, newest first."""
+
+    return (MonthlyActivity.query
+            .filter(MonthlyActivity.user_id == user_id,
+                    (MonthlyActivity.messages_count > 0)
+                    | (MonthlyActivity.likes_received > 0))
+            .order_by(MonthlyActivity.month.desc())
+            .all())
+
+
+def by_year(rows):
+    """Group `months()` rows into `{year: {'months', 'messages', 'likes'}}`,
+    newest year first."""
+
+    years = OrderedDict()
+
+    for row in rows:
+        year = years.setdefault(row.month.year, {
+            'months': [], 'messages': 0, 'likes': 0})
+        year['months'].append(row)
+        year['messages'] += row.messages_count
+        year['likes'] += row.likes_received
+
+    return years
+
+
+##############################################################################
+# Incremental maintenance
+
+
+def _message_month(message_id):
+    timestamp = (db.session.query(Message.timestamp)
+                 .filter(Message.id == message_id)
+                 .scalar())
+
+    return month_of(timestamp) if timestamp else None
+
+
+@jobs.on('message_posted')
+def count_message(message_id, user_id):
+    month = _message_month(message_id)
+    if month is None:
+        return
+
+    MonthlyActivity.bump(user_id, month, messages=1)
+    db.session.commit()
+
+
+@jobs.on('message_deleted')
+def uncount_message(message_id, user_id, month=None, likes=0):
+    # Jobs queued before the payload carried the month can't be placed;
+    # `rebuild-activity` fixes those months.
+    if month is None:
+        return
+
+    year, month = map(int, month.split('-'))
+    MonthlyActivity.bump(user_id, date(year, month, 1),
+                         messages=-1, likes=-likes)
+    db.session.commit()
+
+
+@jobs.on('like_added')
+def count_like(user_id, message_id, author_id):
+    month = _message_month(message_id)
+    if month is None:
+        return
+
+    MonthlyActivity.bump(author_id, month, likes=1)
+    db.session.commit()
+
+
+@jobs.on('like_removed')
+def uncount_like(user_id, message_id, author_id):
+    month = _message_month(message_id)
+    if month is None:
+        return
+
+    MonthlyActivity.bump(author_id, month, likes=-1)
+    db.session.commit()
+
+
+@jobs.on('likes_removed')
+def uncount_likes(user_id, likes):
+    """`likes` are `[message_id, author_id]` pairs removed at once, e.g.
+    by `accounts.purge()`."""
+
+    timestamps = dict(db.session.query(Message.id, Message.timestamp)
+                      .filter(Message.id.in_([pair[0] for pair in likes])))
+
+    removed = Counter(
+        (author_id, month_of(timestamps[message_id]))
+        for message_id, author_id in likes if message_id in timestamps)
+    MonthlyActivity.remove_likes(removed)
+    db.session.commit()
+
+
+##############################################################################
+# Rebuilding
+
+
+def rebuild(user_id=None):
+    """Recompute rollup rows from `messages` and `likes`.
+
+    For every user, or just `user_id`. Returns the number of rows
+    written.
+    """
+
+    year = func.extract('year', Message.timestamp)
+    month = func.extract('month', Message.timestamp)
+
+    likes = (db.session
+             .query(Likes.message_id, func.count().label('likes'))
+             .group_by(Likes.message_id)
+             .subquery())
+
+    query = (db.session
+             .query(Message.user_id, year.label('year'), month.label('month'),
+                    func.count(Message.id).label('messages'),
+                    func.coalesce(func.sum(likes.c.likes), 0).label('likes'))
+             .outerjoin(likes, likes.c.message_id == Message.id)
+             .group_by(Message.user_id, year, month))
+
+    stale = MonthlyActivity.query
+    if user_id is not None:
+        query = query.filter(Message.user_id == user_id)
+        stale = stale.filter(MonthlyActivity.user_id == user_id)
+
+    rows = [
+        {'user_id': row.user_id,
+         'month': date(int(row.year), int(row.month), 1),
+         'messages_count': row.messages,
+         'likes_received': int(row.likes)}
+        for row in query
+    ]
+
+    stale.delete(synchronize_session=False)
+    if rows:
+        db.session.execute(MonthlyActivity.__table__.insert(), rows)
+    db.session.commit()
+
+    return len(rows)
+
+
+@click.command('rebuild-activity')
+@click.argument('user_id', type=int, required=False)
+@with_appcontext
+def rebuild_activity_command(user_id):
+    """Recompute monthly activity for every user, or one user."""
+
+    click.echo(f"Wrote {rebuild(user_id)} monthly rows.")
@@ -0,0 +1,127 @@
+"""Operator pages: what the app's caches, buffers and database are doing.
+
+Every route answers JSON, and only to the users named in
+ADMIN_USERNAMES; everyone else gets a 404, as if the pages didn't
+exist.
+
+- `/admin/slow-queries`: the slow-query log (see `slowlog`), grouped by
+  statement with the most total time first, plus the latest entries.
+- `/admin/metrics`: counters of the single-flight groups, the write
+  buffer and the notification buffer, and the number of open streams.
+- `/admin/profile`: sample this process's stacks for a few seconds
+  (see `profiling`); `/admin/profile/token` and `/admin/profiles` for
+  per-request profiles.
+
+Each answers for the process that serves it: the slow-query log,
+metrics, samples and kept request profiles all live in that process's
+memory. With several workers, repeat a request to see the others, and
+fetch a request's profile from the worker that ran it (or read
+SLOW_QUERY_LOG_PATH for every process's slow queries).
+
+Config:
+
+- ADMIN_USERNAMES: usernames allowed in (default none).
+"""
+
+from flask import Blueprint, abort, current_app, g, request
+
+import notifications
+import profiling
+import singleflight
+import stream
+import writes
+from api import json_error, json_response
+from slowlog import log as slow_queries
+
+admin = Blueprint('admin', __name__, url_prefix='/admin')
+
+
+@admin.before_request
+def require_admin():
+    if not g.user or \
+            g.user.username not in current_app.config['ADMIN_USERNAMES']:
+        abort(404)
+
+
+@admin.route('/slow-queries')
+def slow_query_log():
+    """Slow statements grouped by SQL, and the latest `limit` entries."""
+
+    limit = request.args.get('limit', 50, type=int)
+
+    return json_response({
+        'threshold_ms': current_app.config['SLOW_QUERY_MS'],
+        'statements': slow_queries.summary(),
+        'entries': slow_queries.entries()[:limit],
+    })
+
+
+@admin.route('/slow-queries', methods=['DELETE'])
+def clear_slow_query_log():
+    slow_queries.clear()
+
+    return json_response({'cleared': True})
+
+
+@admin.route('/metrics')
+def metrics():
+    return json_response({
+        'singleflight': singleflight.metrics(),
+        'write_buffer': writes.buffer.metrics(),
+        'notifications': notifications.buffer.metrics(),
+        'streams': {'subscribers': stream.hub.subscriber_count()},
+    })
+
+
+@admin.route('/profile')
+def profile():
+    """Sample stacks for `seconds` (default 5), every `interval_ms`
+    (default 10); answer collapsed stacks, or with `format=json`, a
+    summary per endpoint."""
+
+    seconds = min(request.args.get('seconds', 5, type=float),
+                  current_app.config['PROFILE_MAX_SECONDS'])
+    interval = max(request.args.get('interval_ms', 10, type=float), 1) / 1000
+
+    try:
+        samples = profiling.sample(seconds, interval)
+    except profiling.ProfilerBusy:
+        return json_error('A profile is already being taken.', 409)
+
+    if request.args.get('format') == 'json':
+        return json_response({
+            'seconds': seconds,
+            'interval_ms': interval * 1000,
+            'samples': sum(samples.values()),
+            'endpoints': profiling.summarize(samples),
+        })
+
+    return current_app.response_class(
+        profiling.collapsed(samples), mimetype='text/plain')
+
+
+@admin.route('/profile/token', methods=['POST'])
+def profile_token():
+    """A token for the `X-Warbler-Profile` header."""
+
+    return json_response({
+        'header': profiling.HEADER,
+        'token': profiling.token(g.user.username),
+        'expires_in': current_app.config['PROFILE_TOKEN_MAX_AGE'],
+    })
+
+
+@admin.route('/profiles')
+def request_profiles():
+    return json_response({'data': profiling.profiles.recent()})
+
+
+@admin.route('/profiles/<profile_id>')
+def request_profile(profile_id):
+    """A request profile's pstats report."""
+
+    entry = profiling.profiles.get(profile_id)
+    if entry is None:
+        abort(404)
+
+    return current_app.response_class(entry['report'], mimetype='text/plain')
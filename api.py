@@ -0,0 +1,460 @@
+"""Versioned JSON API for Warbler.
+
+Serves the same data as the HTML pages as compact JSON built straight
+from the column-projected rows in `queries`.
+"""
+
+import json
+import time
+
+from flask import Blueprint, current_app, g, request
+
+import graph
+import jobs
+import notifications
+import queries
+import recommendations
+import stream
+import trending
+import writes
+from models import db, Follows
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Most ids accepted by one bulk follow or unfollow request.
+BULK_LIMIT = 1000
+
+
+##############################################################################
+# Serialization
+
+
+def _default(obj):
+    """Fallback for the stdlib encoder: datetimes become ISO strings."""
+
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def dumps(payload):
+    """Encode `payload` as compact JSON bytes, using orjson if installed."""
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+
+    return json.dumps(
+        payload, separators=(',', ':'), default=_default).encode('UTF-8')
+
+
+def json_response(payload, status=200):
+    """Build a JSON response from `payload`."""
+
+    return current_app.response_class(
+        dumps(payload), status=status, mimetype='application/json')
+
+
+def json_error(message, status):
+    return json_response({'error': message}, status)
+
+
+def serialize_message(row):
+    return {
+        'id': row.id,
+        'text': row.text,
+        'timestamp': row.timestamp,
+        'user': {
+            'id': row.user_id,
+            'username': row.username,
+            'image_url': row.image_url,
+        },
+    }
+
+
+def serialize_user_card(row):
+    return {
+        'id': row.id,
+        'username': row.username,
+        'image_url': row.image_url,
+        'bio': row.bio,
+    }
+
+
+def serialize_profile(row):
+    return {
+        'id': row.id,
+        'username': row.username,
+        'image_url': row.image_url,
+        'header_image_url': row.header_image_url,
+        'bio': row.bio,
+        'location': row.location,
+        'counts': {
+            'messages': row.messages_count,
+            'following': row.following_count,
+            'followers': row.followers_count,
+            'likes': row.likes_count,
+        },
+    }
+
+
+def serialize_notification(row):
+    return {
+        'id': row.id,
+        'kind': row.kind,
+        'count': row.count,
+        'updated_at': row.updated_at,
+        'unread': row.unread,
+        'subject': ({'id': row.subject_id, 'text': row.subject_text}
+                    if row.kind == notifications.LIKE else None),
+        'actor': ({'id': row.actor_id, 'username': row.actor_username,
+                   'image_url': row.actor_image_url}
+                  if row.actor_id is not None else None),
+    }
+
+
+def profile_payload(row, messages):
+    """Profile header plus its first page of messages."""
+
+    payload = serialize_profile(row)
+    payload['messages'] = messages
+    return payload
+
+
+def page(rows, cursor, serializer):
+    """Payload for one page of a keyset-paginated list."""
+
+    return {'data': [serializer(row) for row in rows], 'next': cursor}
+
+
+##############################################################################
+# Request helpers
+
+
+class ApiError(Exception):
+    """Abort the current API request with a JSON error."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _cursor_arg(name, decoder):
+    token = request.args.get(name)
+    if not token:
+        return None
+
+    try:
+        return decoder(token)
+    except ValueError:
+        raise ApiError('Invalid cursor.')
+
+
+def _user_ids_body():
+    """Unique user ids from a `{"user_ids": [...]}` body, in given order."""
+
+    body = request.get_json(silent=True)
+    user_ids = body.get('user_ids') if isinstance(body, dict) else None
+
+    if not isinstance(user_ids, list) or not all(
+            type(user_id) is int for user_id in user_ids):
+        raise ApiError('Expected {"user_ids": [<int>, ...]}.')
+
+    if len(user_ids) > BULK_LIMIT:
+        raise ApiError(f'At most {BULK_LIMIT} user ids per request.')
+
+    return list(dict.fromkeys(user_ids))
+
+
+def _limit_arg():
+    return queries.page_size(request.args.get('limit'))
+
+
+@api.errorhandler(ApiError)
+def api_error(error):
+    return json_error(error.message, error.status)
+
+
+@api.errorhandler(404)
+def not_found(error):
+    return json_error('Not found.', 404)
+
+
+@api.before_request
+def require_login():
+    """Everything except public profiles, messages and trending needs a
+    login."""
+
+    public = ('api.user_profile', 'api.user_messages', 'api.message_detail',
+              'api.trending_now')
+
+    if not g.user and request.endpoint not in public:
+        return json_error('Access unauthorized.', 401)
+
+
+##############################################################################
+# Routes
+
+
+@api.route('/timeline')
+def timeline():
+    """Home timeline of the logged-in user."""
+
+    # Whose messages it shows depends on the user's buffered follows.
+    writes.buffer.settle(g.user.id, writes.FOLLOW)
+    rows, cursor = queries.timeline(
+        g.user.id,
+        before=_cursor_arg('before', queries.decode_message_cursor),
+        limit=_limit_arg())
+
+    return json_response(page(rows, cursor, serialize_message))
+
+
+@api.route('/timeline/since/<cursor>')
+def timeline_since(cursor):
+    """Home timeline messages newer than `cursor`, oldest first.
+
+    For clients that poll rather than hold `/stream` open. `cursor` is
+    a message cursor: the `next` of the previous poll, or one made from
+    the newest message the client has. Answers `204 No Content` when
+    there's nothing new, usually straight from the stream hub's
+    checkpoint without querying. Otherwise `next` is the cursor to poll
+    with and `more` says whether to poll again right away.
+    """
+
+    try:
+        after = queries.decode_message_cursor(cursor)
+    except ValueError:
+        raise ApiError('Invalid cursor.')
+
+    user_id = g.user.id
+    if stream.hub.nothing_since(user_id, cursor):
+        return current_app.response_class(status=204)
+
+    read_at = time.monotonic()
+    if current_app.config['GRAPH_INDEX']:
+        authors = graph.index.following_ids(user_id)
+    else:
+        authors = queries.following_ids(user_id)
+    rows, more = queries.timeline_since(user_id, after, limit=_limit_arg())
+
+    if rows:
+        cursor = queries.message_cursor(rows[-1])
+    if not more:
+        stream.hub.checkpoint(user_id, cursor, read_at, authors | {user_id})
+
+    if not rows:
+        return current_app.response_class(status=204)
+
+    return json_response({'data': [serialize_message(row) for row in rows],
+                          'next': cursor, 'more': more})
+
+
+@api.route('/users/<int:user_id>')
+def user_profile(user_id):
+    """Profile header with counts and the first page of messages."""
+
+    row = queries.profile(user_id)
+    if row is None:
+        return json_error('Not found.', 404)
+
+    rows, cursor = queries.user_messages(user_id, limit=_limit_arg())
+
+    return json_response(
+        profile_payload(row, page(rows, cursor, serialize_message)))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """Messages written by a user, newest first."""
+
+    rows, cursor = queries.user_messages(
+        user_id,
+        before=_cursor_arg('before', queries.decode_message_cursor),
+        limit=_limit_arg())
+
+    return json_response(page(rows, cursor, serialize_message))
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    """Users following this user."""
+
+    # The user's own buffered follow may put them on this list.
+    writes.buffer.settle(g.user.id, writes.FOLLOW)
+    rows, cursor = queries.followers(
+        user_id,
+        after=_cursor_arg('after', queries.decode_id_cursor),
+        limit=_limit_arg())
+
+    return json_response(page(rows, cursor, serialize_user_card))
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    """Users this user follows."""
+
+    if user_id == g.user.id:
+        writes.buffer.settle(user_id, writes.FOLLOW)
+    rows, cursor = queries.following(
+        user_id,
+        after=_cursor_arg('after', queries.decode_id_cursor),
+        limit=_limit_arg())
+
+    return json_response(page(rows, cursor, serialize_user_card))
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Messages this user liked, most recent like first."""
+
+    rows, cursor = queries.liked_messages(
+        user_id,
+        before=_cursor_arg('before', queries.decode_id_cursor),
+        limit=_limit_arg())
+
+    return json_response(page(rows, cursor, serialize_message))
+
+
+@api.route('/messages/<int:message_id>')
+def message_detail(message_id):
+    """A single message with its author."""
+
+    row = queries.message_detail(message_id)
+    if row is None:
+        return json_error('Not found.', 404)
+
+    return json_response(serialize_message(row))
+
+
+@api.route('/notifications')
+def notification_list():
+    """The logged-in user's notifications, newest first, with their
+    unread count. Reading them doesn't mark them read."""
+
+    rows, cursor = queries.notifications(
+        g.user.id, before=_cursor_arg('before', queries.decode_id_cursor),
+        limit=_limit_arg())
+
+    payload = page(rows, cursor, serialize_notification)
+    payload['unread'] = notifications.unread.get(g.user.id)
+    return json_response(payload)
+
+
+@api.route('/notifications/read', methods=['POST'])
+def notifications_read():
+    """Mark all the logged-in user's notifications read."""
+
+    notifications.mark_read(g.user.id)
+
+    return json_response({'unread': 0})
+
+
+@api.route('/trending')
+def trending_now():
+    """Hashtags, mentions and messages trending this hour."""
+
+    limit = min(queries.page_size(request.args.get('limit') or 10), 50)
+    current = trending.current(limit)
+
+    return json_response({
+        'hashtags': [{'tag': tag, 'count': count}
+                     for tag, count in current['hashtags']],
+        'mentions': [dict(serialize_user_card(card), count=count)
+                     for card, count in current['mentions']],
+        'messages': [dict(serialize_message(row), count=count)
+                     for row, count in current['messages']],
+    })
+
+
+@api.route('/users/<int:user_id>/relationship')
+def relationship(user_id):
+    """How the logged-in user and `user_id` are connected.
+
+    Answered from the in-memory follow graph, without the database, when
+    GRAPH_INDEX is on; otherwise in three queries.
+    """
+
+    if current_app.config['GRAPH_INDEX']:
+        index = graph.index
+        common = index.common_following(g.user.id, user_id)
+        following = index.is_following(g.user.id, user_id)
+        followed_by = index.is_following(user_id, g.user.id)
+        followers_count = index.followers_count(user_id)
+        following_count = index.following_count(user_id)
+    else:
+        mine = queries.following_ids(g.user.id)
+        theirs = queries.following_ids(user_id)
+        counts = queries.user_counts(user_id)
+        common = sorted(mine & theirs)
+        following = user_id in mine
+        followed_by = g.user.id in theirs
+        followers_count = counts.followers_count
+        following_count = counts.following_count
+
+    return json_response({
+        'following': following,
+        'followed_by': followed_by,
+        'followers_count': followers_count,
+        'following_count': following_count,
+        'common_following_count': len(common),
+        'common_following': common[:queries.PAGE_SIZE],
+    })
+
+
+@api.route('/suggestions')
+def suggestions():
+    """Who to follow: friends-of-friends of the logged-in user."""
+
+    limit = min(queries.page_size(request.args.get('limit') or 5), 20)
+    scored = recommendations.engine.suggest(g.user.id, k=limit)
+    scores = dict(scored)
+    cards = queries.user_cards([user_id for user_id, score in scored])
+
+    return json_response({'data': [
+        dict(serialize_user_card(card), score=round(scores[card.id], 3))
+        for card in cards
+    ]})
+
+
+@api.route('/following', methods=['POST'])
+def follow_many():
+    """Follow every user in `{"user_ids": [...]}` in one statement."""
+
+    user_ids = _user_ids_body()
+    results = Follows.follow_many(g.user.id, user_ids)
+    db.session.commit()
+
+    return _bulk_follow_response(
+        user_ids, results, 'followed', 'follows_added')
+
+
+@api.route('/following', methods=['DELETE'])
+def unfollow_many():
+    """Stop following every user in `{"user_ids": [...]}`."""
+
+    user_ids = _user_ids_body()
+    results = Follows.unfollow_many(g.user.id, user_ids)
+    db.session.commit()
+
+    return _bulk_follow_response(
+        user_ids, results, 'unfollowed', 'follows_removed')
+
+
+def _bulk_follow_response(user_ids, results, changed, event):
+    """Publish one event for the changed edges; report per-id results."""
+
+    changed_ids = [
+        user_id for user_id in user_ids if results[user_id] == changed]
+
+    if changed_ids:
+        jobs.publish(event, user_id=g.user.id, followed_ids=changed_ids)
+
+    return json_response({'data': [
+        {'id': user_id, 'result': results[user_id]} for user_id in user_ids
+    ]})
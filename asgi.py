@@ -0,0 +1,751 @@
+"""Optional ASGI entry point for Warbler.
+
+Serves the hot read routes on an asyncpg connection pool, so a request
+waiting on the database doesn't hold a worker thread and a page's
+independent queries run concurrently:
+
+- the home page, profiles, messages and the follower lists, for a
+  logged-in viewer;
+- their JSON API twins (home timeline, profile, message detail and
+  follower lists).
+
+Every other path is handed to the regular Flask app through asgiref's
+WSGI adapter. So are the pages above for anonymous visitors, whom the
+page cache (see `pagecache`) serves without querying at all, and pages
+the async route can't answer (a missing user or message, a bad cursor),
+so they render their error pages as usual.
+
+An async page fetches its data on the pool, then renders its template in
+a worker thread, inside a Flask request context built from the ASGI
+request: the session, `g.user`, CSRF tokens, flashed messages and the
+request hooks work as in a WSGI request. The other blocking calls (the
+session store, writing the viewer's buffered likes and follows, the
+follow graph) run in worker threads too, never on the event loop.
+
+Like the WSGI views, the async routes write the viewer's buffered
+follows before the lists that depend on them, and overlay the viewer's
+unflushed likes and follows on what the database says (see `writes`).
+
+It also serves the `/api/v1/stream` Server-Sent Events stream (see
+`stream`): an idle subscriber is a suspended coroutine, not a thread.
+
+The async routes share their business logic with the sync ones: the
+SQL comes from the same `queries` builders, the pages from the same
+templates and the payloads from the same `api` serializers.
+
+Run with any ASGI server, e.g.:
+
+    WARBLER_PROFILE=production uvicorn asgi:application
+
+Needs the optional `asyncpg` (and, for the WSGI fallback, `asgiref`)
+packages and a Postgres database.
+"""
+
+import asyncio
+import re
+from urllib.parse import parse_qs
+
+from flask import g, render_template
+from sqlalchemy.dialects.postgresql.base import PGDialect
+from werkzeug.test import EnvironBuilder
+
+import graph
+import partitions
+import queries
+import stream
+import views
+import writes
+from api import (dumps, page, profile_payload, serialize_message,
+                 serialize_user_card)
+from app import app, CURR_USER_KEY
+from models import Follows, Message
+from readmodels import Counts, MessageRow, ProfileRow, UserCard
+
+try:
+    import asyncpg
+except ImportError:  # pragma: no cover - optional dependency
+    asyncpg = None
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:  # pragma: no cover - optional dependency
+    WsgiToAsgi = None
+
+
+##############################################################################
+# SQL compilation
+
+
+# asyncpg takes `$1` style positional parameters; compile with the
+# numeric (`:1`) paramstyle and swap the prefix.
+_dialect = PGDialect(paramstyle='numeric')
+_numeric_param = re.compile(r'(?<!:):(\d+)')
+
+
+def compile_query(query):
+    """Compile a `queries` builder result to (sql, args) for asyncpg."""
+
+    compiled = query.statement.compile(dialect=_dialect)
+    sql = _numeric_param.sub(r'$\1', compiled.string)
+    args = [compiled.params[name] for name in compiled.positiontup]
+
+    return sql, args
+
+
+class Row(dict):
+    """asyncpg record with attribute access, as the serializers expect."""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+##############################################################################
+# Responses
+
+
+class HTTPError(Exception):
+    """Abort the current async request with a JSON error."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+async def send_json(send, payload, status=200):
+    body = dumps(payload)
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode('ascii')),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_response(send, response, head=False):
+    """Send a Flask response; just its headers for a HEAD request."""
+
+    await send({
+        'type': 'http.response.start',
+        'status': response.status_code,
+        'headers': [
+            (key.lower().encode('latin-1'), value.encode('latin-1'))
+            for key, value in response.headers.to_wsgi_list()
+        ],
+    })
+    await send({'type': 'http.response.body',
+                'body': b'' if head else response.get_data()})
+
+
+##############################################################################
+# Application
+
+
+class AsyncWarbler:
+    """ASGI application: async hot reads, Flask for everything else."""
+
+    def __init__(self, flask_app, dsn=None, min_size=2, max_size=20,
+                 executor=None):
+        self.flask_app = flask_app
+        # Runs the blocking calls; None is the event loop's default.
+        self.executor = executor
+        self.dsn = dsn or flask_app.config['SQLALCHEMY_DATABASE_URI']
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self._pool_lock = None
+        self.fallback = WsgiToAsgi(flask_app) if WsgiToAsgi else None
+
+        prefix = '/api/v1'
+        self.routes = [
+            (re.compile(rf'^{prefix}/timeline$'), self.timeline),
+            (re.compile(rf'^{prefix}/users/(\d+)$'), self.user_profile),
+            (re.compile(rf'^{prefix}/users/(\d+)/followers$'),
+             self.user_followers),
+            (re.compile(rf'^{prefix}/users/(\d+)/following$'),
+             self.user_following),
+            (re.compile(rf'^{prefix}/messages/(\d+)$'), self.message_detail),
+        ]
+        self.streams = [
+            (re.compile(rf'^{prefix}/stream$'), self.stream),
+        ]
+        self.pages = [
+            (re.compile(r'^/$'), self.homepage),
+            (re.compile(r'^/users/(\d+)$'), self.users_show),
+            (re.compile(r'^/users/(\d+)/following$'), self.show_following),
+            (re.compile(r'^/users/(\d+)/followers$'), self.users_followers),
+            (re.compile(r'^/messages/(\d+)$'), self.messages_show),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and scope['method'] == 'GET':
+            for pattern, handler in self.streams:
+                if pattern.match(scope['path']):
+                    return await handler(
+                        AsyncRequest(self.flask_app, scope, self.executor),
+                        receive, send)
+
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+            for pattern, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match:
+                    return await self.dispatch(
+                        handler, scope, send, *map(int, match.groups()))
+
+            for pattern, handler in self.pages:
+                match = pattern.match(scope['path'])
+                if match:
+                    return await self.render_page(
+                        handler, scope, receive, send,
+                        *map(int, match.groups()))
+
+        return await self.fall_back(scope, receive, send)
+
+    async def fall_back(self, scope, receive, send):
+        """Hand the request to the Flask app."""
+
+        if self.fallback is None:
+            return await send_json(send, {'error': 'Not found.'}, 404)
+
+        return await self.fallback(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                await self.get_pool()
+                await send({'type': 'lifespan.startup.complete'})
+
+            elif message['type'] == 'lifespan.shutdown':
+                if self.pool is not None:
+                    await self.pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def get_pool(self):
+        """Create the connection pool on first use."""
+
+        if self.pool is None:
+            if asyncpg is None:
+                raise RuntimeError("ASGI mode needs the asyncpg package.")
+
+            # Created here rather than in __init__ so it binds to the
+            # server's event loop.
+            if self._pool_lock is None:
+                self._pool_lock = asyncio.Lock()
+
+            async with self._pool_lock:
+                if self.pool is None:
+                    self.pool = await asyncpg.create_pool(
+                        self.dsn, min_size=self.min_size,
+                        max_size=self.max_size)
+
+        return self.pool
+
+    async def dispatch(self, handler, scope, send, *args):
+        request = AsyncRequest(self.flask_app, scope, self.executor)
+
+        try:
+            payload = await handler(request, *args)
+        except HTTPError as error:
+            return await send_json(
+                send, {'error': error.message}, error.status)
+
+        await send_json(send, payload)
+
+    async def render_page(self, handler, scope, receive, send, *args):
+        """Fetch a page's data here and render it in a worker thread.
+
+        Anonymous visitors, and pages `handler` can't answer (it returns
+        None or raises `HTTPError`), go to the Flask app.
+        """
+
+        request = AsyncRequest(self.flask_app, scope, self.executor)
+        found = None
+
+        try:
+            if await request.load_user():
+                found = await handler(request, *args)
+        except HTTPError:
+            found = None
+
+        if found is None:
+            return await self.fall_back(scope, receive, send)
+
+        template, context = found
+        response = await self.run_sync(self.render, request, template, context)
+
+        await send_response(send, response, head=scope['method'] == 'HEAD')
+
+    def render(self, request, template, context):
+        """Render `template` in a Flask request context for `request`,
+        with the app's request hooks; returns the response."""
+
+        flask_app = self.flask_app
+
+        with flask_app.request_context(request.environ()):
+            try:
+                flask_app.try_trigger_before_first_request_functions()
+                rv = flask_app.preprocess_request()
+                if rv is None and g.user and g.user.id == request.user_id:
+                    rv = render_template(template, **context)
+                elif rv is None:
+                    # Logged out since the data was fetched: the view
+                    # renders what's shown to anonymous visitors.
+                    rv = flask_app.dispatch_request()
+            except Exception as error:
+                rv = flask_app.handle_user_exception(error)
+
+            return flask_app.finalize_request(rv)
+
+    async def run_sync(self, func, *args):
+        """Run blocking `func` in a worker thread, in an app context."""
+
+        def call():
+            with self.flask_app.app_context():
+                return func(*args)
+
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, call)
+
+    ##########################################################################
+    # Query helpers
+
+    def build(self, builder, args, kwargs, limit=None, since=None):
+        """Build and compile a `queries` statement inside an app context."""
+
+        with self.flask_app.app_context():
+            query = builder(*args, **kwargs)
+            if since is not None:
+                query = query.filter(Message.timestamp >= since)
+            if limit is not None:
+                query = query.limit(limit)
+
+            return compile_query(query)
+
+    async def fetch(self, builder, *args, row_type=None, **kwargs):
+        """Run a `queries` builder on the pool; return its rows.
+
+        Rows are `Row`s, or `row_type` read models as `queries.fetch()`
+        returns them.
+        """
+
+        return await self._fetch(self.build(builder, args, kwargs), row_type)
+
+    async def fetch_page(self, builder, limit, cursor_for, *args,
+                         row_type=None, **kwargs):
+        """Async twin of the `queries` paginators."""
+
+        rows = await self._fetch(
+            self.build(builder, args, kwargs, limit=limit + 1), row_type)
+
+        return queries.split_page(rows, limit, cursor_for)
+
+    async def fetch_messages_page(self, builder, limit, *args, row_type=None,
+                                  **kwargs):
+        """Async twin of `queries.recent_rows()` paging: recent months
+        first, then the whole table if they don't fill the page."""
+
+        with self.flask_app.app_context():
+            since = partitions.hot_since()
+
+        if since is not None:
+            rows = await self._fetch(
+                self.build(builder, args, kwargs, limit=limit + 1,
+                           since=since), row_type)
+            if len(rows) > limit:
+                return queries.split_page(rows, limit, queries.message_cursor)
+
+        return await self.fetch_page(
+            builder, limit, queries.message_cursor, *args, row_type=row_type,
+            **kwargs)
+
+    async def _fetch(self, compiled, row_type=None):
+        sql, params = compiled
+        pool = await self.get_pool()
+        records = await pool.fetch(sql, *params)
+
+        if row_type is None:
+            return [Row(record) for record in records]
+
+        return [row_type._make(record.values()) for record in records]
+
+    ##########################################################################
+    # The viewer's buffered writes and relationships
+
+    async def settle(self, user_id, kind=None):
+        """Async `writes.buffer.settle()`: the flush, if there's anything
+        to write, runs in a worker thread."""
+
+        if writes.buffer.has_writes(user_id):
+            await self.run_sync(writes.buffer.settle, user_id, kind)
+
+    async def followed_by(self, viewer_id, user_ids):
+        """Async `views.followed_by_viewer()`."""
+
+        if self.flask_app.config['GRAPH_INDEX']:
+            followed = await self.run_sync(
+                graph.index.following_among, viewer_id, user_ids)
+        elif user_ids:
+            followed = {row.user_being_followed_id for row in await self.fetch(
+                Follows.followed_among_query, viewer_id, user_ids)}
+        else:
+            followed = set()
+
+        return writes.buffer.overlay(
+            viewer_id, writes.FOLLOW, followed, user_ids)
+
+    async def liked_by(self, viewer_id, message_ids):
+        """Async `views.liked_by_viewer()`."""
+
+        liked = set()
+        if message_ids:
+            liked = {row.message_id for row in await self.fetch(
+                queries.liked_message_ids_query, viewer_id, message_ids)}
+
+        return writes.buffer.overlay(
+            viewer_id, writes.LIKE, liked, message_ids)
+
+    async def user_cards(self, user_ids):
+        """Async `queries.user_cards()`."""
+
+        if not user_ids:
+            return []
+
+        rows = await self.fetch(queries.user_cards_query, user_ids,
+                                row_type=UserCard)
+
+        return queries.ordered_by_ids(rows, user_ids)
+
+    ##########################################################################
+    # Routes
+
+    async def timeline(self, request):
+        await request.require_login()
+
+        # Whose messages it shows depends on the user's buffered follows.
+        await self.settle(request.user_id, writes.FOLLOW)
+        rows, cursor = await self.fetch_messages_page(
+            queries.timeline_query, request.limit(), request.user_id,
+            before=request.cursor('before', queries.decode_message_cursor))
+
+        return page(rows, cursor, serialize_message)
+
+    async def user_profile(self, request, user_id):
+        # The header and the first page of messages don't depend on each
+        # other, so they run on two pooled connections at once.
+        profile_rows, (rows, cursor) = await asyncio.gather(
+            self.fetch(queries.profile_query, user_id),
+            self.fetch_messages_page(queries.user_messages_query,
+                                     request.limit(), user_id),
+        )
+
+        if not profile_rows:
+            raise HTTPError(404, 'Not found.')
+
+        return profile_payload(
+            profile_rows[0], page(rows, cursor, serialize_message))
+
+    async def user_followers(self, request, user_id):
+        await request.require_login()
+
+        # The user's own buffered follow may put them on this list.
+        await self.settle(request.user_id, writes.FOLLOW)
+        rows, cursor = await self.fetch_page(
+            queries.followers_query, request.limit(), queries.id_cursor,
+            user_id, after=request.cursor('after', queries.decode_id_cursor))
+
+        return page(rows, cursor, serialize_user_card)
+
+    async def user_following(self, request, user_id):
+        await request.require_login()
+
+        if user_id == request.user_id:
+            await self.settle(user_id, writes.FOLLOW)
+        rows, cursor = await self.fetch_page(
+            queries.following_query, request.limit(), queries.id_cursor,
+            user_id, after=request.cursor('after', queries.decode_id_cursor))
+
+        return page(rows, cursor, serialize_user_card)
+
+    async def message_detail(self, request, message_id):
+        rows = await self.fetch(queries.message_detail_query, message_id)
+
+        if not rows:
+            raise HTTPError(404, 'Not found.')
+
+        return serialize_message(rows[0])
+
+    ##########################################################################
+    # Pages
+    #
+    # Each returns `(template, context)` for `render_page`, as its view in
+    # `views` would render it for the logged-in `request.user_id`, or None
+    # to let the view itself answer.
+
+    async def homepage(self, request):
+        user_id = request.user_id
+
+        # The timeline needs the follows; likes are overlaid below.
+        await self.settle(user_id, writes.FOLLOW)
+        (messages, _), counts, suggested = await asyncio.gather(
+            self.fetch_messages_page(queries.timeline_query, 100, user_id,
+                                     row_type=MessageRow),
+            self.fetch(queries.user_counts_query, user_id, row_type=Counts),
+            self.run_sync(views.suggested_ids, user_id),
+        )
+        likes, suggestions = await asyncio.gather(
+            self.liked_by(user_id, [msg.id for msg in messages]),
+            self.user_cards(suggested),
+        )
+
+        return 'home.html', {'messages': messages, 'likes': likes,
+                             'counts': counts[0], 'suggestions': suggestions}
+
+    async def users_show(self, request, user_id):
+        if user_id == request.user_id:
+            await self.settle(user_id)
+
+        profile_rows, (messages, _), followed_ids = await asyncio.gather(
+            self.fetch(queries.profile_query, user_id, row_type=ProfileRow),
+            self.fetch_messages_page(queries.user_messages_query, 100,
+                                     user_id, row_type=MessageRow),
+            self.followed_by(request.user_id, [user_id]),
+        )
+
+        if not profile_rows:
+            return None
+
+        return 'users/show.html', {'user': profile_rows[0],
+                                   'messages': messages,
+                                   'followed_ids': followed_ids}
+
+    async def show_following(self, request, user_id):
+        if user_id == request.user_id:
+            await self.settle(user_id)
+
+        return await self.user_list(
+            request, user_id, queries.following_query, 'users/following.html')
+
+    async def users_followers(self, request, user_id):
+        # The viewer's own buffered follow may put them on this list.
+        await self.settle(request.user_id, writes.FOLLOW)
+
+        return await self.user_list(
+            request, user_id, queries.followers_query, 'users/followers.html')
+
+    async def user_list(self, request, user_id, builder, template):
+        """A page of a user's followers or following."""
+
+        profile_rows, (users, next_cursor) = await asyncio.gather(
+            self.fetch(queries.profile_query, user_id, row_type=ProfileRow),
+            self.fetch_page(
+                builder, queries.PAGE_SIZE, queries.id_cursor, user_id,
+                after=request.cursor('after', queries.decode_id_cursor),
+                row_type=UserCard),
+        )
+
+        if not profile_rows:
+            return None
+
+        followed_ids = await self.followed_by(
+            request.user_id, [user_id] + [user.id for user in users])
+
+        return template, {'user': profile_rows[0], 'users': users,
+                          'next_cursor': next_cursor,
+                          'followed_ids': followed_ids}
+
+    async def messages_show(self, request, message_id):
+        rows = await self.fetch(queries.message_detail_query, message_id,
+                                row_type=MessageRow)
+
+        if not rows:
+            return None
+
+        message = rows[0]
+        followed_ids = await self.followed_by(
+            request.user_id, [message.user_id])
+
+        return 'messages/show.html', {'message': message,
+                                      'followed_ids': followed_ids}
+
+    ##########################################################################
+    # Streams
+
+    async def stream(self, request, receive, send):
+        """New messages from the users the viewer follows, as SSE."""
+
+        try:
+            await request.require_login()
+            last_event_id = request.last_event_id()
+        except HTTPError as error:
+            return await send_json(
+                send, {'error': error.message}, error.status)
+
+        user_id = request.user_id
+        await self.settle(user_id, writes.FOLLOW)
+        authors = {row.user_being_followed_id for row in
+                   await self.fetch(queries.following_ids_query, user_id)}
+        authors.add(user_id)
+
+        config = self.flask_app.config
+        subscriber = stream.Subscriber(
+            user_id, authors, asyncio.get_event_loop(),
+            config['STREAM_QUEUE_SIZE'])
+        replay, complete = stream.hub.subscribe(subscriber, last_event_id)
+
+        disconnected = asyncio.ensure_future(_disconnected(receive))
+        event = None
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', b'text/event-stream'),
+                    (b'cache-control', b'no-cache'),
+                    (b'x-accel-buffering', b'no'),
+                ],
+            })
+
+            body = b'' if complete else stream.RESET
+            body += b''.join(stream.encode(event) for event in replay)
+            await send({'type': 'http.response.body', 'body': body,
+                        'more_body': True})
+
+            while True:
+                if event is None:
+                    event = asyncio.ensure_future(subscriber.queue.get())
+
+                done, _ = await asyncio.wait(
+                    [event, disconnected], timeout=config['STREAM_HEARTBEAT'],
+                    return_when=asyncio.FIRST_COMPLETED)
+
+                if disconnected in done:
+                    return
+
+                if event not in done:
+                    body = stream.KEEPALIVE
+                elif event.result() is stream.OVERFLOW:
+                    # Too far behind: end the stream; the client
+                    # reconnects and catches up from the replay buffer.
+                    break
+                else:
+                    body = stream.encode(event.result())
+                    event = None
+
+                await send({'type': 'http.response.body', 'body': body,
+                            'more_body': True})
+
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if event is not None:
+                event.cancel()
+            disconnected.cancel()
+            stream.hub.unsubscribe(subscriber)
+
+
+async def _disconnected(receive):
+    """Return once the client has gone away."""
+
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class AsyncRequest:
+    """The bits of an ASGI request the async routes need."""
+
+    def __init__(self, flask_app, scope, executor=None):
+        self.flask_app = flask_app
+        self.scope = scope
+        self.executor = executor
+        self.args = {
+            key: values[0] for key, values in
+            parse_qs(scope.get('query_string', b'').decode('latin-1')).items()
+        }
+        self.user_id = None
+        self._session_loaded = False
+
+    def environ(self):
+        """A WSGI environ for this request, for Flask's request machinery."""
+
+        headers = {
+            key.decode('latin-1'): value.decode('latin-1')
+            for key, value in self.scope.get('headers', [])
+        }
+        base_url = '{}://{}{}'.format(self.scope.get('scheme', 'http'),
+                                      headers.get('host', 'localhost'),
+                                      self.scope.get('root_path', ''))
+        builder = EnvironBuilder(
+            path=self.scope['path'], base_url=base_url,
+            method=self.scope.get('method', 'GET'),
+            query_string=self.scope.get('query_string', b'').decode('latin-1'),
+            headers=headers)
+
+        return builder.get_environ()
+
+    async def load_user(self):
+        """Logged-in user id, read through the Flask session interface.
+
+        The session store may block (Redis), so it's read in a worker
+        thread. Only the id stored at login is needed here, so unlike the
+        sync `add_user_to_g` this doesn't query the users table.
+        """
+
+        if not self._session_loaded:
+            self.user_id = await asyncio.get_event_loop().run_in_executor(
+                self.executor, self._session_user_id)
+            self._session_loaded = True
+
+        return self.user_id
+
+    def _session_user_id(self):
+        flask_request = self.flask_app.request_class(self.environ())
+        session = self.flask_app.session_interface.open_session(
+            self.flask_app, flask_request)
+
+        return session.get(CURR_USER_KEY) if session is not None else None
+
+    async def require_login(self):
+        if not await self.load_user():
+            raise HTTPError(401, 'Access unauthorized.')
+
+    def limit(self):
+        return queries.page_size(self.args.get('limit'))
+
+    def last_event_id(self):
+        """The SSE `Last-Event-ID` a reconnecting client sends, if any."""
+
+        for key, value in self.scope.get('headers', []):
+            if key.lower() == b'last-event-id':
+                try:
+                    return int(value)
+                except ValueError:
+                    raise HTTPError(400, 'Invalid Last-Event-ID.')
+
+        return None
+
+    def cursor(self, name, decoder):
+        token = self.args.get(name)
+        if not token:
+            return None
+
+        try:
+            return decoder(token)
+        except ValueError:
+            raise HTTPError(400, 'Invalid cursor.')
+
+
+application = AsyncWarbler(app)
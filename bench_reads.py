@@ -0,0 +1,162 @@
+"""Per-request cost of ORM hydration versus read models.
+
+    python bench_reads.py [--users 200] [--messages 20000] [--requests 50]
+
+Seeds a throwaway SQLite database, then runs each hot page's data
+loading both ways: the way the views used to (`Message.query...all()`
+and friends, touching the attributes the templates print) and through
+`queries`' read models. For each it reports the median CPU time of one
+request and the peak memory it allocated, measured by tracemalloc.
+
+- timeline: 100 messages of the users someone follows, with authors
+- profile: the profile header and its first 100 messages
+- followers: one page of a popular user's followers
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+
+def seed(db, users, messages):
+    from models import User, Message, Follows
+
+    now = datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'username': f"user{n}", 'email': f"user{n}@example.com",
+         'password': 'x', 'bio': "Lorem ipsum dolor sit amet. " * 4,
+         'location': "Somewhere", 'header_image_url': '/static/h.png'}
+        for n in range(1, users + 1)])
+    db.session.execute(Message.__table__.insert(), [
+        {'text': f"Message number {n}", 'user_id': random.randint(1, users),
+         'timestamp': now - timedelta(minutes=n)}
+        for n in range(messages)])
+    db.session.execute(Follows.__table__.insert(), [
+        {'user_following_id': follower, 'user_being_followed_id': followed}
+        for follower in range(1, users + 1)
+        for followed in random.sample(range(1, users + 1), users // 5)
+        if followed != follower])
+    db.session.commit()
+
+
+def orm_timeline(user_id):
+    from sqlalchemy import or_
+    from models import Message
+    import queries
+
+    messages = (Message
+                .query
+                .filter(or_(Message.user_id.in_(
+                                queries.following_ids_select(user_id)),
+                            Message.user_id == user_id))
+                .order_by(Message.timestamp.desc())
+                .limit(100)
+                .all())
+    return [(m.id, m.text, m.timestamp, m.user.id, m.user.username,
+             m.user.image_url) for m in messages]
+
+
+def orm_profile(user_id):
+    from models import User, Message
+
+    user = User.query.get(user_id)
+    header = (user.username, user.image_url, user.header_image_url, user.bio,
+              user.location, len(user.messages), len(user.following),
+              len(user.followers), len(user.likes))
+    messages = (Message.query.filter_by(user_id=user_id)
+                .order_by(Message.timestamp.desc()).limit(100).all())
+    return header, [(m.id, m.text, m.timestamp) for m in messages]
+
+
+def orm_followers(user_id):
+    from models import User
+
+    return [(u.id, u.username, u.image_url, u.bio)
+            for u in User.query.get(user_id).followers[:50]]
+
+
+def read_timeline(user_id):
+    import queries
+
+    return queries.timeline(user_id, limit=100)[0]
+
+
+def read_profile(user_id):
+    import queries
+
+    return queries.profile(user_id), queries.user_messages(user_id,
+                                                           limit=100)[0]
+
+
+def read_followers(user_id):
+    import queries
+
+    return queries.followers(user_id)[0]
+
+
+CASES = [
+    ('timeline', orm_timeline, read_timeline),
+    ('profile', orm_profile, read_profile),
+    ('followers', orm_followers, read_followers),
+]
+
+
+def measure(app, db, func, user_ids):
+    """Median CPU ms and peak allocated KB of `func` over `user_ids`."""
+
+    cpu, peak = [], []
+    for user_id in user_ids:
+        with app.app_context():
+            tracemalloc.start()
+            started = time.process_time()
+            func(user_id)
+            cpu.append((time.process_time() - started) * 1000)
+            peak.append(tracemalloc.get_traced_memory()[1] / 1024)
+            tracemalloc.stop()
+            db.session.remove()
+
+    return statistics.median(cpu), statistics.median(peak)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as database:
+        os.environ['DATABASE_URL'] = f"sqlite:///{database.name}"
+
+        import warbler
+        from models import db
+
+        app = warbler.create_app('production', SECRET_KEY='bench')
+        with app.app_context():
+            db.create_all()
+            seed(db, args.users, args.messages)
+
+        user_ids = [random.randint(1, args.users)
+                    for _ in range(args.requests)]
+
+        print(f"Median of {args.requests} requests:")
+        print(f"{'page':<10} {'ORM ms':>8} {'rows ms':>8} "
+              f"{'ORM KB':>8} {'rows KB':>8}")
+        for name, orm, read in CASES:
+            # One warm-up run each, so both pay for compiled queries.
+            measure(app, db, orm, user_ids[:1])
+            measure(app, db, read, user_ids[:1])
+
+            orm_ms, orm_kb = measure(app, db, orm, user_ids)
+            read_ms, read_kb = measure(app, db, read, user_ids)
+            print(f"{name:<10} {orm_ms:>8.2f} {read_ms:>8.2f} "
+                  f"{orm_kb:>8.0f} {read_kb:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
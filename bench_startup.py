@@ -0,0 +1,151 @@
+"""Startup time and per-worker memory of each app profile.
+
+    python bench_startup.py [--runs 5] [--workers 4]
+
+For each profile, starts fresh interpreters that import Warbler, build
+the app and serve one anonymous request for the home page, and reports
+the median time of each step and the resulting RSS. That's what every
+worker pays when the server doesn't preload.
+
+Then it builds a production app in this process and forks workers from
+it, as `gunicorn --preload` does, and reports each worker's RSS after
+one request and how much of it is private to the worker rather than
+shared with the master.
+
+Uses a throwaway SQLite database; the requests don't touch it. Memory
+figures come from /proc, so they need Linux.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+PROFILES = ('development', 'testing', 'production')
+
+CHILD = """
+import json, os, sys, time
+started = time.time()
+import warbler
+imported = time.time()
+app = warbler.create_app(sys.argv[1])
+created = time.time()
+app.test_client().get('/')
+served = time.time()
+import bench_startup
+print(json.dumps(dict(
+    bench_startup.memory(),
+    import_ms=(imported - started) * 1000,
+    create_ms=(created - imported) * 1000,
+    request_ms=(served - created) * 1000,
+)))
+"""
+
+
+def memory():
+    """RSS and private memory of this process, in KB."""
+
+    usage = {}
+    for path in ('/proc/self/smaps_rollup', '/proc/self/status'):
+        try:
+            with open(path) as f:
+                for line in f:
+                    name, _, value = line.partition(':')
+                    if value.strip().endswith('kB'):
+                        usage.setdefault(name, int(value.split()[0]))
+        except OSError:
+            continue
+
+    return {
+        'rss_kb': usage.get('Rss', usage.get('VmRSS', 0)),
+        'private_kb': (usage.get('Private_Clean', 0)
+                       + usage.get('Private_Dirty', 0)),
+    }
+
+
+def environment(database):
+    env = dict(os.environ,
+               DATABASE_URL=f"sqlite:///{database}",
+               SECRET_KEY='bench')
+    env.pop('WARBLER_PROFILE', None)
+    return env
+
+
+def cold_start(profile, runs, env):
+    """Median timings and memory of `runs` fresh processes."""
+
+    results = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', CHILD, profile], env=env,
+            stdout=subprocess.PIPE, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        results.append(json.loads(out.stdout.decode().splitlines()[-1]))
+
+    return {key: statistics.median(result[key] for result in results)
+            for key in results[0]}
+
+
+def preforked(workers):
+    """Memory of `workers` processes forked from a preloaded app."""
+
+    import warbler
+
+    app = warbler.create_app('production')
+    app.test_client().get('/')
+    master = memory()
+
+    pipes = []
+    for _ in range(workers):
+        read, write = os.pipe()
+        if os.fork() == 0:
+            os.close(read)
+            app.test_client().get('/')
+            os.write(write, json.dumps(memory()).encode())
+            os._exit(0)
+        os.close(write)
+        pipes.append(read)
+
+    results = []
+    for read in pipes:
+        with os.fdopen(read) as f:
+            results.append(json.loads(f.read()))
+    for _ in pipes:
+        os.wait()
+
+    return master, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as database:
+        env = environment(database.name)
+
+        print(f"Cold start, median of {args.runs} processes:")
+        print(f"{'profile':<12} {'import ms':>10} {'create ms':>10} "
+              f"{'1st req ms':>10} {'RSS MB':>8}")
+        for profile in PROFILES:
+            r = cold_start(profile, args.runs, env)
+            print(f"{profile:<12} {r['import_ms']:>10.1f} "
+                  f"{r['create_ms']:>10.1f} {r['request_ms']:>10.1f} "
+                  f"{r['rss_kb'] / 1024:>8.1f}")
+
+        os.environ.update(env)
+        master, workers = preforked(args.workers)
+
+    print(f"\nPreloaded production app, {args.workers} forked workers:")
+    print(f"master RSS {master['rss_kb'] / 1024:.1f} MB")
+    for n, worker in enumerate(workers, 1):
+        print(f"worker {n}: RSS {worker['rss_kb'] / 1024:.1f} MB, "
+              f"private {worker['private_kb'] / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
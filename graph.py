@@ -0,0 +1,554 @@
+"""In-memory index of the follow graph.
+
+Answers "does A follow B?", follower and following counts, common
+follows and paginated id listings without touching the database.
+
+Each direction of the graph is stored as compressed sparse rows (CSR):
+three flat int32 arrays holding the sorted ids that have edges, where
+each one's list starts, and the sorted neighbor lists back to back. A
+user's followers or followees are then one slice, membership is a
+binary search and counts are a subtraction.
+
+With GRAPH_SNAPSHOT_PATH set, the arrays are written to a snapshot file
+that every worker process memory-maps read-only, so they share one copy
+in the page cache. Follows and unfollows are appended to a small delta
+log next to the snapshot, which each process replays on top of it; a
+process that finds the snapshot too old rebuilds it from the `follows`
+table while holding a file lock, and the others pick up the new file.
+Without a path the index is built in each process's memory and deltas
+are applied directly. Deltas are recorded by the job handlers at the
+bottom of this module, in whichever process runs the job, so the other
+processes' indexes miss them until their next rebuild: with several
+processes and no path, counts and follow checks may be up to
+GRAPH_MAX_AGE seconds out of date. Set GRAPH_SNAPSHOT_PATH on any
+deployment with more than one process.
+
+Only the first build happens in the request that needs the index.
+Later rebuilds run in a background thread, and readers keep using the
+current arrays until the new ones are swapped in.
+
+Config:
+
+- GRAPH_INDEX: answer follow checks on pages from the index instead of
+  the database (default False).
+- GRAPH_SNAPSHOT_PATH: snapshot file shared between processes (default
+  None: per-process index).
+- GRAPH_MAX_AGE: seconds before the snapshot is rebuilt (default 600).
+- GRAPH_CHECK_INTERVAL: seconds between checks for a newer snapshot and
+  new deltas (default 1.0).
+- GRAPH_BACKGROUND: rebuild in a background thread rather than in the
+  request that finds the index too old (default: on, except when
+  testing).
+"""
+
+import fcntl
+import glob
+import mmap
+import os
+import secrets
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+from flask import current_app
+
+import jobs
+from models import db, Follows
+
+SNAPSHOT_MAGIC = b'WRBLGRPH'
+SNAPSHOT_VERSION = 1
+# magic, version, log id, then (nodes, edges) for following and followers
+HEADER = struct.Struct('<8sIQQQQQ')
+
+DELTA = struct.Struct('<bii')
+FOLLOW, UNFOLLOW = 1, -1
+
+
+##############################################################################
+# Compressed sparse rows
+
+
+class CSR:
+    """Sorted adjacency lists packed into three int32 sequences.
+
+    `nodes` holds the ids with any edges, sorted. The neighbors of
+    `nodes[i]` are `targets[starts[i]:starts[i + 1]]`, also sorted. The
+    sequences are arrays when built in memory and memoryviews into the
+    mapped file when loaded from a snapshot.
+    """
+
+    def __init__(self, nodes, starts, targets):
+        self.nodes = nodes
+        self.starts = starts
+        self.targets = targets
+
+    @classmethod
+    def from_edges(cls, edges):
+        """Build from `(source, target)` pairs sorted by source, target."""
+
+        nodes, starts, targets = array('i'), array('i'), array('i')
+
+        last = None
+        for source, target in edges:
+            if source != last:
+                nodes.append(source)
+                starts.append(len(targets))
+                last = source
+            targets.append(target)
+
+        starts.append(len(targets))
+
+        return cls(nodes, starts, targets)
+
+    def neighbors(self, node):
+        """Sorted neighbor ids of `node` (empty if it has none)."""
+
+        i = bisect_left(self.nodes, node)
+        if i == len(self.nodes) or self.nodes[i] != node:
+            return self.targets[0:0]
+
+        return self.targets[self.starts[i]:self.starts[i + 1]]
+
+    def degrees(self):
+        """`(node, neighbor count)` for every node."""
+
+        starts = self.starts
+        return ((node, starts[i + 1] - starts[i])
+                for i, node in enumerate(self.nodes))
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def contains(sorted_ids, value):
+    i = bisect_left(sorted_ids, value)
+    return i < len(sorted_ids) and sorted_ids[i] == value
+
+
+##############################################################################
+# Index
+
+
+class GraphIndex:
+    """Followers and following of every user, plus pending deltas."""
+
+    def __init__(self):
+        self.following = None
+        self.followers = None
+        self.generation = 0
+        self.built_at = 0
+
+        # Changes not yet in the snapshot, by direction:
+        # {user id: {other id, ...}}
+        self._added = (defaultdict(set), defaultdict(set))
+        self._removed = (defaultdict(set), defaultdict(set))
+
+        self._lock = threading.RLock()
+        self._rebuilding = threading.Lock()
+        self._checked_at = 0
+        self._snapshot_stat = None
+        self._log_id = None
+        self._log_offset = 0
+        self._pending = []
+
+    ##########################################################################
+    # Configuration
+
+    @property
+    def path(self):
+        return current_app.config.get('GRAPH_SNAPSHOT_PATH')
+
+    def _log_path(self, log_id):
+        return f"{self.path}.{log_id:016x}.log"
+
+    ##########################################################################
+    # Building and loading
+
+    def _read_edges(self, source, target):
+        return (db.session
+                .query(source, target)
+                .order_by(source, target)
+                .yield_per(10000))
+
+    def rebuild(self):
+        """Rebuild from the `follows` table.
+
+        With a snapshot path, only one process rebuilds at a time; the
+        others keep their current snapshot and return False.
+        """
+
+        if not self.path:
+            return self._rebuild_in_memory()
+
+        with open(f"{self.path}.lock", 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+
+            # Start the new delta log before reading the table, so any
+            # change the read might miss lands in the new log. Replaying
+            # a change the read already saw is harmless.
+            log_id = secrets.randbits(63)
+            open(self._log_path(log_id), 'ab').close()
+            self._write_atomic(f"{self.path}.current",
+                               f"{log_id:016x}".encode('ascii'))
+
+            following = CSR.from_edges(self._read_edges(
+                Follows.user_following_id, Follows.user_being_followed_id))
+            followers = CSR.from_edges(self._read_edges(
+                Follows.user_being_followed_id, Follows.user_following_id))
+            db.session.rollback()
+
+            self._write_snapshot(log_id, following, followers)
+            self._remove_old_logs(log_id)
+
+        with self._lock:
+            self._load_snapshot()
+
+        return True
+
+    def _rebuild_in_memory(self):
+        with self._lock:
+            pending_from = len(self._pending)
+
+        following = CSR.from_edges(self._read_edges(
+            Follows.user_following_id, Follows.user_being_followed_id))
+        followers = CSR.from_edges(self._read_edges(
+            Follows.user_being_followed_id, Follows.user_following_id))
+        db.session.rollback()
+
+        with self._lock:
+            replay = self._pending[pending_from:]
+            self._install(following, followers)
+            for delta in replay:
+                self._apply(*delta)
+
+        return True
+
+    def _install(self, following, followers):
+        self.following = following
+        self.followers = followers
+        self.generation += 1
+        self.built_at = time.time()
+        self._pending = []
+        for overlay in self._added + self._removed:
+            overlay.clear()
+
+    def _write_atomic(self, path, data):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def _write_snapshot(self, log_id, following, followers):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+
+        with open(tmp, 'wb') as f:
+            f.write(HEADER.pack(
+                SNAPSHOT_MAGIC, SNAPSHOT_VERSION, log_id,
+                len(following.nodes), len(following.targets),
+                len(followers.nodes), len(followers.targets)))
+            for csr in (following, followers):
+                csr.nodes.tofile(f)
+                csr.starts.tofile(f)
+                csr.targets.tofile(f)
+
+        os.replace(tmp, self.path)
+
+    def _remove_old_logs(self, keep_id):
+        # Keep the previous log too: other processes may still be
+        # replaying it until they notice the new snapshot.
+        logs = sorted(glob.glob(f"{glob.escape(self.path)}.*.log"),
+                      key=os.path.getmtime)
+        keep = {self._log_path(keep_id)}
+        for log in logs[:-2]:
+            if log not in keep:
+                os.remove(log)
+
+    def _load_snapshot(self):
+        with open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, log_id, following_nodes, following_edges,
+         followers_nodes, followers_edges) = HEADER.unpack_from(mapped)
+
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError(f"{self.path} is not a graph snapshot.")
+
+        ints = memoryview(mapped)[HEADER.size:].cast('i')
+        offset = 0
+        csrs = []
+        for nodes, edges in ((following_nodes, following_edges),
+                             (followers_nodes, followers_edges)):
+            sizes = (nodes, nodes + 1, edges)
+            parts = []
+            for size in sizes:
+                parts.append(ints[offset:offset + size])
+                offset += size
+            csrs.append(CSR(*parts))
+
+        self._install(*csrs)
+        self.built_at = stat.st_mtime
+        self._snapshot_stat = (stat.st_ino, stat.st_mtime)
+        self._log_id = log_id
+        self._log_offset = 0
+        self._replay_log()
+
+    def _replay_log(self):
+        try:
+            with open(self._log_path(self._log_id), 'rb') as log:
+                log.seek(self._log_offset)
+                data = log.read()
+        except FileNotFoundError:
+            return
+
+        usable = len(data) - len(data) % DELTA.size
+        for op, user_id, followed_id in DELTA.iter_unpack(data[:usable]):
+            self._apply(op, user_id, followed_id)
+        self._log_offset += usable
+
+    @property
+    def ready(self):
+        """Whether the index has been built or loaded."""
+
+        return self.following is not None
+
+    def refresh(self, wait=True):
+        """Load, reload or rebuild the index as needed.
+
+        Cheap to call on every access: the file checks happen at most
+        once per GRAPH_CHECK_INTERVAL. Without `wait`, even the first
+        build goes to the background; check `ready` before reading.
+        """
+
+        config = current_app.config
+        now = time.time()
+
+        if (self.following is not None and now - self._checked_at
+                < config.get('GRAPH_CHECK_INTERVAL', 1.0)):
+            return
+
+        with self._lock:
+            self._checked_at = now
+
+            if not self.path:
+                if self.following is None and wait:
+                    self._rebuild_in_memory()
+                elif (self.following is None or now - self.built_at
+                      > config.get('GRAPH_MAX_AGE', 600)):
+                    self._rebuild_later()
+                return
+
+            try:
+                stat = os.stat(self.path)
+            except FileNotFoundError:
+                stat = None
+
+            if stat is None:
+                if self.following is None and wait:
+                    self.rebuild()
+                else:
+                    self._rebuild_later()
+                return
+
+            if (stat.st_ino, stat.st_mtime) != self._snapshot_stat:
+                self._load_snapshot()
+            else:
+                self._replay_log()
+
+            if now - self.built_at > config.get('GRAPH_MAX_AGE', 600):
+                self._rebuild_later()
+
+    def _rebuild_later(self):
+        """Rebuild in a background thread, unless one is running."""
+
+        app = current_app._get_current_object()
+        if not app.config.get('GRAPH_BACKGROUND', not app.testing):
+            self.rebuild()
+            return
+
+        if self._rebuilding.acquire(blocking=False):
+            threading.Thread(target=self._rebuild_in_background,
+                             args=(app,), daemon=True,
+                             name='warbler-graph-rebuild').start()
+
+    def _rebuild_in_background(self, app):
+        try:
+            with app.app_context():
+                self.rebuild()
+        finally:
+            self._rebuilding.release()
+
+    ##########################################################################
+    # Deltas
+
+    def _apply(self, op, user_id, followed_id):
+        for direction, (owner, other) in enumerate(
+                ((user_id, followed_id), (followed_id, user_id))):
+            if op == FOLLOW:
+                self._removed[direction][owner].discard(other)
+                self._added[direction][owner].add(other)
+            else:
+                self._added[direction][owner].discard(other)
+                self._removed[direction][owner].add(other)
+
+    def record(self, op, user_id, followed_ids):
+        """Record `user_id` following (FOLLOW) or unfollowing (UNFOLLOW)
+        each of `followed_ids`, for every process using the index."""
+
+        if not self.path:
+            with self._lock:
+                for followed_id in followed_ids:
+                    self._pending.append((op, user_id, followed_id))
+                    self._apply(op, user_id, followed_id)
+            return
+
+        try:
+            with open(f"{self.path}.current", 'rb') as pointer:
+                log_id = int(pointer.read(), 16)
+        except FileNotFoundError:
+            # No snapshot yet; whoever builds it will read the table.
+            return
+
+        data = b''.join(DELTA.pack(op, user_id, followed_id)
+                        for followed_id in followed_ids)
+        fd = os.open(self._log_path(log_id),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+        # Let this process see its own change right away.
+        self._checked_at = 0
+
+    ##########################################################################
+    # Queries
+
+    def _ids(self, direction, user_id):
+        # Copied under the lock: `record` and `refresh` change the
+        # overlays, and swap the snapshot, from other threads.
+        with self._lock:
+            csr = (self.following, self.followers)[direction]
+            base = csr.neighbors(user_id)
+            added = set(self._added[direction].get(user_id, ()))
+            removed = set(self._removed[direction].get(user_id, ()))
+
+        return base, added, removed
+
+    def _set(self, direction, user_id):
+        self.refresh()
+        base, added, removed = self._ids(direction, user_id)
+
+        return (set(base) | added) - removed
+
+    def _count(self, direction, user_id):
+        self.refresh()
+        base, added, removed = self._ids(direction, user_id)
+
+        return (len(base)
+                - sum(1 for other in removed if contains(base, other))
+                + sum(1 for other in added if not contains(base, other)))
+
+    def _page(self, direction, user_id, after, limit):
+        self.refresh()
+        base, added, removed = self._ids(direction, user_id)
+
+        start = bisect_right(base, after) if after is not None else 0
+        extra = sorted(other for other in added
+                       if (after is None or other > after)
+                       and not contains(base, other))
+
+        page = []
+        i = j = 0
+        while len(page) < limit and (start + i < len(base) or j < len(extra)):
+            if j == len(extra) or (start + i < len(base)
+                                   and base[start + i] < extra[j]):
+                other = base[start + i]
+                i += 1
+            else:
+                other = extra[j]
+                j += 1
+            if other not in removed:
+                page.append(other)
+
+        return page
+
+    def following_ids(self, user_id):
+        """Set of ids `user_id` follows."""
+
+        return self._set(0, user_id)
+
+    def follower_ids(self, user_id):
+        """Set of ids following `user_id`."""
+
+        return self._set(1, user_id)
+
+    def following_count(self, user_id):
+        return self._count(0, user_id)
+
+    def followers_count(self, user_id):
+        return self._count(1, user_id)
+
+    def following_page(self, user_id, after=None, limit=50):
+        """Sorted ids `user_id` follows, greater than `after`."""
+
+        return self._page(0, user_id, after, limit)
+
+    def followers_page(self, user_id, after=None, limit=50):
+        """Sorted ids following `user_id`, greater than `after`."""
+
+        return self._page(1, user_id, after, limit)
+
+    def is_following(self, user_id, other_id):
+        self.refresh()
+        base, added, removed = self._ids(0, user_id)
+
+        if other_id in removed:
+            return False
+        return other_id in added or contains(base, other_id)
+
+    def following_among(self, user_id, other_ids):
+        """Which of `other_ids` does `user_id` follow? Returns a set."""
+
+        return {other_id for other_id in other_ids
+                if self.is_following(user_id, other_id)}
+
+    def common_following(self, user_id, other_id):
+        """Sorted ids both users follow."""
+
+        return sorted(self.following_ids(user_id)
+                      & self.following_ids(other_id))
+
+    def mutuals(self, user_id):
+        """Sorted ids that follow `user_id` and are followed back."""
+
+        return sorted(self.following_ids(user_id)
+                      & self.follower_ids(user_id))
+
+    def most_followed(self, n):
+        """Ids of the `n` users with the most followers in the snapshot."""
+
+        self.refresh()
+        degrees = sorted(self.followers.degrees(),
+                         key=lambda pair: (-pair[1], pair[0]))
+
+        return [user_id for user_id, count in degrees[:n]]
+
+
+index = GraphIndex()
+
+
+@jobs.on('follows_added')
+def record_follows(user_id, followed_ids):
+    index.record(FOLLOW, user_id, followed_ids)
+
+
+@jobs.on('follows_removed')
+def record_unfollows(user_id, followed_ids):
+    index.record(UNFOLLOW, user_id, followed_ids)
@@ -0,0 +1,411 @@
+"""Image proxy serving resized avatars and headers.
+
+Profile images are arbitrary external URLs, often full-size photos shown
+at 48px. Templates pass them through the `thumbnail` filter instead:
+
+    <img src="{{ user.image_url | thumbnail('avatar') }}">
+
+which points at `/img/<size>/<token>`, the token being the original URL
+signed with the app's secret key, so the proxy only fetches URLs the
+site itself rendered. The first request fetches the original, resizes
+and crops it to the size's fixed dimensions (`SIZES`) and stores the
+result on disk; every later request is served from there, with headers
+that let browsers keep it for a year. Local images (`/static/...`) are
+left alone.
+
+Thumbnails are stored under the hash of their content, plus a small
+reference file per (size, URL) naming that hash, so identical images
+share one file. When the cache outgrows IMAGE_CACHE_MAX_BYTES, the
+least recently served thumbnails are deleted.
+
+Origins must be public addresses. Each hop of a redirect is checked
+again, and the proxy connects to the very address it checked.
+
+Resizing needs the `Pillow` package (in requirements.txt); without it
+the proxy refuses to make thumbnails rather than serve full-size
+originals.
+
+Config:
+
+- IMAGE_CACHE_DIR: where thumbnails are kept (default: `image-cache` in
+  the app's instance folder).
+- IMAGE_CACHE_MAX_BYTES: size of the cache (default 256MB).
+- IMAGE_FETCH_TIMEOUT: seconds to wait for an origin (default 5).
+- IMAGE_MAX_BYTES: largest original fetched (default 5MB).
+- IMAGE_PROXY_ALLOW_PRIVATE: allow origins on private or loopback
+  addresses (default False).
+"""
+
+import hashlib
+import http.client
+import io
+import ipaddress
+import mimetypes
+import os
+import socket
+import tempfile
+import threading
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+from flask import (
+    Blueprint, abort, current_app, redirect, request, send_file, url_for)
+from itsdangerous import BadSignature, URLSafeSerializer
+
+from singleflight import Group
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - see make_thumbnail
+    Image = None
+
+# (width, height) of each thumbnail size: twice the largest size they're
+# shown at, for high-density screens.
+SIZES = {
+    'avatar': (96, 96),
+    'header': (960, 320),
+}
+
+# Shown when an original can't be fetched.
+FALLBACKS = {
+    'avatar': '/static/images/default-pic.png',
+    'header': '/static/images/warbler-hero.jpg',
+}
+
+ONE_YEAR = 365 * 24 * 3600
+
+images = Blueprint('images', __name__, url_prefix='/img')
+
+
+class ImageError(Exception):
+    """The original couldn't be fetched or isn't an image."""
+
+
+##############################################################################
+# Cache
+
+
+class ThumbnailCache:
+    """Content-addressed thumbnails on disk, evicted least recently used.
+
+    Several processes may share `root`: files are written under temporary
+    names and renamed into place, and a reference to an evicted file
+    counts as a miss.
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _ref_path(self, url, size):
+        key = hashlib.sha256(f"{size}:{url}".encode('utf-8')).hexdigest()
+        return os.path.join(self.root, 'refs', key[:2], key)
+
+    def _blob_path(self, name):
+        return os.path.join(self.root, 'blobs', name[:2], name)
+
+    def get(self, url, size):
+        """Path of the thumbnail of `url` at `size`, or None."""
+
+        ref = self._ref_path(url, size)
+        try:
+            with open(ref) as f:
+                name = f.read().strip()
+        except OSError:
+            return None
+
+        path = self._blob_path(name)
+        try:
+            # The modification time records the last use, for eviction.
+            os.utime(path)
+        except OSError:
+            _remove(ref)
+            return None
+
+        return path
+
+    def put(self, url, size, data, extension):
+        """Store `data` as the thumbnail of `url` at `size`; its path."""
+
+        name = hashlib.sha256(data).hexdigest() + extension
+        path = self._blob_path(name)
+
+        if not os.path.exists(path):
+            _write(path, data)
+            with self._lock:
+                if self._size is not None:
+                    self._size += len(data)
+
+        _write(self._ref_path(url, size), name.encode('ascii'))
+        self.evict()
+
+        return path
+
+    def evict(self):
+        """Delete the least recently used thumbnails over `max_bytes`."""
+
+        with self._lock:
+            if self._size is not None and self._size <= self.max_bytes:
+                return
+
+            blobs = []
+            for dirpath, dirnames, filenames in os.walk(
+                    os.path.join(self.root, 'blobs')):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, path))
+
+            self._size = sum(size for mtime, size, path in blobs)
+            for mtime, size, path in sorted(blobs):
+                if self._size <= self.max_bytes:
+                    break
+                _remove(path)
+                self._size -= size
+
+
+def _write(path, data):
+    """Write `data` to `path` atomically."""
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        _remove(tmp)
+        raise
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+##############################################################################
+# Fetching and resizing
+
+
+def _public_address(host, port):
+    """An address of `host` to connect to; ImageError unless every
+    address it resolves to is public."""
+
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as error:
+        raise ImageError(str(error))
+
+    for family, type_, proto, canonname, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if not address.is_global:
+            raise ImageError(f"Not a public address: {host}")
+
+    return addresses[0][4][0]
+
+
+def _check_origin(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError(f"Not an http(s) URL: {url}")
+
+    if not current_app.config['IMAGE_PROXY_ALLOW_PRIVATE']:
+        _public_address(parts.hostname, parts.port)
+
+
+class _PublicConnection:
+    """Connects to the address it has just checked, so a DNS answer that
+    changes between the check and the connect can't point it at a
+    private address."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = self._connect_public
+
+    @staticmethod
+    def _connect_public(address, *args, **kwargs):
+        host, port = address
+        return socket.create_connection(
+            (_public_address(host, port), port), *args, **kwargs)
+
+
+class _PublicHTTPConnection(_PublicConnection, http.client.HTTPConnection):
+    pass
+
+
+class _PublicHTTPSConnection(_PublicConnection, http.client.HTTPSConnection):
+    pass
+
+
+class _PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_PublicHTTPConnection, req)
+
+
+class _PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_PublicHTTPSConnection, req,
+                            context=self._context)
+
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    """Checks every redirect's target as it checked the original."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_origin(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def _opener():
+    if current_app.config['IMAGE_PROXY_ALLOW_PRIVATE']:
+        return urllib.request.build_opener(_CheckedRedirectHandler)
+
+    return urllib.request.build_opener(
+        _PublicHTTPHandler, _PublicHTTPSHandler, _CheckedRedirectHandler)
+
+
+def fetch(url):
+    """`(bytes, content type)` of the original at `url`."""
+
+    _check_origin(url)
+
+    config = current_app.config
+    limit = config['IMAGE_MAX_BYTES']
+    req = urllib.request.Request(
+        url, headers={'User-Agent': 'Warbler image proxy'})
+
+    try:
+        with _opener().open(req, timeout=config['IMAGE_FETCH_TIMEOUT']) \
+                as resp:
+            content_type = resp.headers.get_content_type()
+            data = resp.read(limit + 1)
+    except (OSError, ValueError) as error:
+        raise ImageError(f"Fetching {url} failed: {error}")
+
+    if not content_type.startswith('image/'):
+        raise ImageError(f"{url} is {content_type}, not an image")
+    if len(data) > limit:
+        raise ImageError(f"{url} is over {limit} bytes")
+
+    return data, content_type
+
+
+def resize(data, size):
+    """JPEG of the image in `data`, cropped and scaled to `SIZES[size]`."""
+
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except (OSError, ValueError) as error:
+        raise ImageError(f"Unreadable image: {error}")
+
+    if image.mode in ('RGBA', 'LA', 'P'):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        image = background
+    else:
+        image = image.convert('RGB')
+
+    thumb = ImageOps.fit(image, SIZES[size], Image.LANCZOS)
+
+    out = io.BytesIO()
+    thumb.save(out, 'JPEG', quality=85, optimize=True)
+    return out.getvalue()
+
+
+def make_thumbnail(url, size):
+    """Fetch, resize and cache `url` at `size`; the cached path."""
+
+    if Image is None:
+        raise RuntimeError("Making thumbnails needs Pillow; "
+                           "pip install Pillow")
+
+    data, content_type = fetch(url)
+    return cache().put(url, size, resize(data, size), '.jpg')
+
+
+##############################################################################
+# Views and templates
+
+
+# Concurrent requests for a thumbnail not cached yet share one fetch.
+fetches = Group('image_proxy')
+
+
+def signer():
+    return URLSafeSerializer(current_app.secret_key, salt='image-proxy')
+
+
+def cache():
+    return current_app.extensions['images']
+
+
+def thumbnail_url(url, size):
+    """Proxy URL of `url`'s thumbnail at `size`; local URLs as they are."""
+
+    if not url or url.startswith('/'):
+        return url or FALLBACKS[size]
+
+    return url_for('images.thumbnail', size=size, token=signer().dumps(url))
+
+
+@images.route('/<size>/<token>')
+def thumbnail(size, token):
+    """Serve the thumbnail, making it on the first request."""
+
+    if size not in SIZES:
+        abort(404)
+
+    try:
+        url = signer().loads(token)
+    except BadSignature:
+        abort(404)
+
+    path = cache().get(url, size)
+    if path is None:
+        try:
+            path, shared = fetches.do(
+                f"{size}:{url}", lambda: make_thumbnail(url, size))
+        except ImageError as error:
+            current_app.logger.info("Image proxy: %s", error)
+            return redirect(FALLBACKS[size])
+
+    etag = os.path.basename(path)
+    if etag in request.if_none_match:
+        response = current_app.response_class(status=304)
+    else:
+        response = send_file(
+            path, mimetype=mimetypes.guess_type(path)[0]
+            or 'application/octet-stream')
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = \
+        f"public, max-age={ONE_YEAR}, immutable"
+    response.expires = time.time() + ONE_YEAR
+
+    return response
+
+
+def init_app(app):
+    app.config.setdefault(
+        'IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'image-cache'))
+    app.config.setdefault('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+    app.config.setdefault('IMAGE_FETCH_TIMEOUT', 5)
+    app.config.setdefault('IMAGE_MAX_BYTES', 5 * 1024 * 1024)
+    app.config.setdefault('IMAGE_PROXY_ALLOW_PRIVATE', False)
+
+    app.extensions['images'] = ThumbnailCache(
+        app.config['IMAGE_CACHE_DIR'], app.config['IMAGE_CACHE_MAX_BYTES'])
+    app.add_template_filter(thumbnail_url, 'thumbnail')
+    app.register_blueprint(images)
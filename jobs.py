@@ -0,0 +1,459 @@
+"""Background jobs for Warbler.
+
+Write endpoints commit their primary change and then `publish()` an
+event. Every task subscribed to that event with `@on(...)` becomes a
+job which a pool of worker threads runs after the response has gone
+out, retrying failures with exponential backoff.
+
+Jobs live in an in-process queue by default. With JOBS_PERSISTENT set
+they're stored in the `jobs` table instead, so they survive restarts
+and can be handled by a separate worker process:
+
+    FLASK_APP=app.py flask jobs-worker
+
+A worker claims a stored job for JOBS_LEASE seconds: the row is marked
+`running` and its `run_at` becomes the end of the lease. If the worker
+dies before finishing (OOM, a killed deploy), the lease runs out and
+another worker claims the job again, counting the lost run as a
+failed attempt. A job that outruns its lease may therefore run twice,
+so the lease should be well beyond the slowest job.
+
+Config:
+
+- JOBS_WORKERS: worker threads started in each process (default 2).
+  Set to 0 in web processes when a `jobs-worker` does the work.
+- JOBS_PERSISTENT: queue jobs in the database (default False).
+- JOBS_EAGER: run jobs inline as they're published (default: on when
+  the app is TESTING).
+- JOBS_MAX_ATTEMPTS: tries before a job is given up on (default 5).
+- JOBS_BACKOFF: seconds before the first retry; doubles each retry
+  (default 1.0).
+- JOBS_POLL_INTERVAL: how often persistent workers look for due jobs,
+  in seconds (default 1.0).
+- JOBS_LEASE: seconds a persistent worker may hold a job before it's
+  presumed dead and the job is claimed again (default 600).
+"""
+
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Job
+
+# How many idempotency keys the in-memory queue remembers.
+SEEN_KEYS_LIMIT = 10000
+
+_tasks = {}
+_subscribers = defaultdict(list)
+
+PendingJob = namedtuple('PendingJob', 'id name payload key attempts')
+
+
+##############################################################################
+# Task registration
+
+
+def task_name(func):
+    return f"{func.__module__}.{func.__name__}"
+
+
+def on(event):
+    """Decorator: run the decorated function as a job for each `event`.
+
+    The function is called with the keyword arguments given to
+    `publish()`, inside an app context.
+    """
+
+    def register(func):
+        _tasks[task_name(func)] = func
+        _subscribers[event].append(func)
+        return func
+
+    return register
+
+
+def publish(event, key=None, **payload):
+    """Queue a job for every task subscribed to `event`.
+
+    `key` is an idempotency key: a job whose key was already queued
+    isn't queued again. Payload values must be JSON serializable.
+    """
+
+    for func in _subscribers[event]:
+        queue.enqueue(task_name(func), payload,
+                      key=f"{key}:{task_name(func)}" if key else None)
+
+
+##############################################################################
+# Queue backends
+
+
+class MemoryBackend:
+    """Due-time ordered heap of jobs held in this process."""
+
+    def __init__(self):
+        self._heap = []
+        self._ids = itertools.count(1)
+        self._seen = OrderedDict()
+        self._cond = threading.Condition()
+        self._stopping = False
+
+    @property
+    def stopping(self):
+        return self._stopping
+
+    def remember(self, key):
+        """Record idempotency `key`; False if it was already seen."""
+
+        with self._cond:
+            if key in self._seen:
+                return False
+
+            self._seen[key] = True
+            if len(self._seen) > SEEN_KEYS_LIMIT:
+                self._seen.popitem(last=False)
+
+        return True
+
+    def push(self, name, payload, key, run_at, attempts=0):
+        if key is not None and not self.remember(key):
+            return False
+
+        with self._cond:
+            job_id = next(self._ids)
+            heapq.heappush(self._heap, (
+                run_at, job_id, PendingJob(job_id, name, payload, key,
+                                           attempts)))
+            self._cond.notify()
+
+        return True
+
+    def pop(self, timeout):
+        """Next due job, waiting up to `timeout` seconds; else None."""
+
+        deadline = time.time() + timeout
+
+        with self._cond:
+            while not self._stopping:
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+                if now >= deadline:
+                    return None
+
+                wait = deadline - now
+                if self._heap:
+                    wait = min(wait, self._heap[0][0] - now)
+                self._cond.wait(wait)
+
+        return None
+
+    def done(self, job):
+        pass
+
+    def retry(self, job, run_at, error):
+        with self._cond:
+            heapq.heappush(self._heap, (run_at, job.id, job._replace(
+                attempts=job.attempts + 1)))
+            self._cond.notify()
+
+    def fail(self, job, error):
+        pass
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class DatabaseBackend:
+    """Jobs stored in the `jobs` table, claimed with SKIP LOCKED.
+
+    A claimed job is `running` until `run_at`, the end of its lease;
+    after that it's up for claiming again.
+    """
+
+    def __init__(self, poll_interval, lease, max_attempts):
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._stopping = threading.Event()
+
+    @property
+    def stopping(self):
+        return self._stopping.is_set()
+
+    def push(self, name, payload, key, run_at, attempts=0):
+        # Inserted on its own connection so a duplicate key never
+        # disturbs the caller's session.
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(Job.__table__.insert().values(
+                    name=name,
+                    payload=json.dumps(payload),
+                    key=key,
+                    status='pending',
+                    attempts=attempts,
+                    run_at=datetime.utcfromtimestamp(run_at),
+                ))
+        except IntegrityError:
+            return False
+
+        return True
+
+    def pop(self, timeout):
+        deadline = time.time() + timeout
+
+        while not self._stopping.is_set():
+            job = self._claim()
+            if job is not None or time.time() >= deadline:
+                return job
+            self._stopping.wait(
+                min(self.poll_interval, max(deadline - time.time(), 0)))
+
+        return None
+
+    def _claim(self):
+        while True:
+            now = datetime.utcnow()
+            row = (Job.query
+                   .filter(Job.status.in_(('pending', 'running')),
+                           Job.run_at <= now)
+                   .order_by(Job.run_at)
+                   .with_for_update(skip_locked=True)
+                   .first())
+
+            if row is None:
+                db.session.rollback()
+                return None
+
+            if row.status == 'running':
+                # Its lease ran out: the worker running it died.
+                row.attempts += 1
+                row.last_error = "Abandoned by its worker"
+                if row.attempts >= self.max_attempts:
+                    row.status = 'failed'
+                    db.session.commit()
+                    continue
+
+            row.status = 'running'
+            row.run_at = now + timedelta(seconds=self.lease)
+            job = PendingJob(row.id, row.name, json.loads(row.payload),
+                             row.key, row.attempts)
+            db.session.commit()
+
+            return job
+
+    def _update(self, job, **values):
+        (Job.query
+         .filter(Job.id == job.id)
+         .update(values, synchronize_session=False))
+        db.session.commit()
+
+    def done(self, job):
+        self._update(job, status='done', attempts=job.attempts + 1)
+
+    def retry(self, job, run_at, error):
+        self._update(job, status='pending', attempts=job.attempts + 1,
+                     run_at=datetime.utcfromtimestamp(run_at),
+                     last_error=error)
+
+    def fail(self, job, error):
+        self._update(job, status='failed', attempts=job.attempts + 1,
+                     last_error=error)
+
+    def stop(self):
+        self._stopping.set()
+
+    def __len__(self):
+        return Job.query.filter(Job.status == 'pending').count()
+
+
+##############################################################################
+# Queue
+
+
+class JobQueue:
+    """Runs published jobs on worker threads, retrying failures."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._eager_keys = MemoryBackend()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_WORKERS', 2)
+        app.config.setdefault('JOBS_PERSISTENT', False)
+        app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOBS_BACKOFF', 1.0)
+        app.config.setdefault('JOBS_POLL_INTERVAL', 1.0)
+        app.config.setdefault('JOBS_LEASE', 600)
+
+        self.app = app
+        app.cli.add_command(worker_command)
+
+    @property
+    def eager(self):
+        return self.app.config.get('JOBS_EAGER', self.app.testing)
+
+    def _backend(self):
+        if self.backend is None:
+            if self.app.config['JOBS_PERSISTENT']:
+                self.backend = DatabaseBackend(
+                    self.app.config['JOBS_POLL_INTERVAL'],
+                    self.app.config['JOBS_LEASE'],
+                    self.app.config['JOBS_MAX_ATTEMPTS'])
+            else:
+                self.backend = MemoryBackend()
+
+        return self.backend
+
+    def enqueue(self, name, payload, key=None, delay=0):
+        """Queue task `name`; returns False if `key` was already queued."""
+
+        if self.eager:
+            return self._run_eagerly(name, payload, key)
+
+        queued = self._backend().push(name, payload, key, time.time() + delay)
+        self.start()
+
+        return queued
+
+    def _run_eagerly(self, name, payload, key):
+        if key is not None and not self._eager_keys.remember(key):
+            return False
+
+        _tasks[name](**payload)
+        return True
+
+    def start(self, workers=None):
+        """Start worker threads in this process if not already running.
+
+        Threads don't survive a fork, so a forked web worker starts its
+        own pool on its first enqueue.
+        """
+
+        if workers is None:
+            workers = self.app.config['JOBS_WORKERS']
+
+        with self._lock:
+            if self._pid == os.getpid() or not workers:
+                return
+
+            self._pid = os.getpid()
+            self._threads = [
+                threading.Thread(target=self._work, daemon=True,
+                                 name=f"warbler-jobs-{n}")
+                for n in range(workers)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self, timeout=None):
+        """Ask workers to finish their current job and exit.
+
+        Jobs and idempotency keys held in memory are dropped.
+        """
+
+        if self.backend is not None:
+            self.backend.stop()
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._pid = None
+        self._threads = []
+        self.backend = None
+        self._eager_keys = MemoryBackend()
+
+    def _work(self):
+        backend = self._backend()
+
+        while True:
+            with self.app.app_context():
+                job = backend.pop(self.app.config['JOBS_POLL_INTERVAL'])
+                if job is None:
+                    if backend.stopping:
+                        return
+                    continue
+
+                self.run(job)
+
+    def run(self, job):
+        """Run one job; on failure schedule a retry or give up."""
+
+        backend = self._backend()
+
+        try:
+            _tasks[job.name](**job.payload)
+
+        except Exception as error:
+            db.session.rollback()
+            attempts = job.attempts + 1
+
+            if attempts >= self.app.config['JOBS_MAX_ATTEMPTS']:
+                self.app.logger.exception(
+                    "Job %s gave up after %d attempts", job.name, attempts)
+                backend.fail(job, repr(error))
+            else:
+                delay = self.app.config['JOBS_BACKOFF'] * 2 ** job.attempts
+                backend.retry(job, time.time() + delay, repr(error))
+
+        else:
+            backend.done(job)
+
+    def run_pending(self):
+        """Run every job that's due now, in this thread; return the count."""
+
+        backend = self._backend()
+        count = 0
+
+        while True:
+            job = backend.pop(0)
+            if job is None:
+                return count
+
+            self.run(job)
+            count += 1
+
+
+queue = JobQueue()
+
+
+@click.command('jobs-worker')
+@click.option('--workers', default=4, help="Worker threads to run.")
+@with_appcontext
+def worker_command(workers):
+    """Process queued background jobs until interrupted."""
+
+    if not queue.app.config['JOBS_PERSISTENT']:
+        raise click.UsageError(
+            "jobs-worker needs JOBS_PERSISTENT; in-memory jobs run in the "
+            "web process.")
+
+    queue.start(workers)
+    click.echo(f"Running {workers} job workers. Ctrl-C to stop.")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        queue.stop()
@@ -4,6 +4,7 @@ from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -13,6 +14,12 @@ class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # The primary key leads with the followed user; this serves
+        # "who does this user follow".
+        db.Index('ix_follows_user_following_id', 'user_following_id',
+                 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -26,11 +33,105 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def follow_many(cls, user_id, user_ids):
+        """Make `user_id` follow every user in `user_ids`.
+
+        Does one lookup for the users and existing edges and one
+        set-based insert, however many ids are given. Doesn't commit.
+
+        Returns a dict mapping each requested id to one of 'followed',
+        'already_following', 'not_found' or 'self'.
+        """
+
+        user_ids = set(user_ids)
+        results = {}
+
+        if user_id in user_ids:
+            results[user_id] = 'self'
+            user_ids.discard(user_id)
+
+        if not user_ids:
+            return results
+
+        existing = {
+            row.id for row in
+            db.session.query(User.id).filter(User.id.in_(user_ids),
+                                             User.deleted_at.is_(None))
+        }
+        already = cls.followed_among(user_id, existing)
+
+        new_ids = existing - already
+        insert_ignore(cls.__table__, [
+            {'user_following_id': user_id, 'user_being_followed_id': new_id}
+            for new_id in new_ids
+        ])
+
+        for requested in user_ids:
+            if requested not in existing:
+                results[requested] = 'not_found'
+            elif requested in already:
+                results[requested] = 'already_following'
+            else:
+                results[requested] = 'followed'
+
+        return results
+
+    @classmethod
+    def unfollow_many(cls, user_id, user_ids):
+        """Make `user_id` stop following every user in `user_ids`.
+
+        One lookup and one set-based delete. Doesn't commit.
+
+        Returns a dict mapping each requested id to 'unfollowed' or
+        'not_following'.
+        """
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return {}
+
+        followed = cls.followed_among(user_id, user_ids)
+
+        if followed:
+            (cls.query
+             .filter(cls.user_following_id == user_id,
+                     cls.user_being_followed_id.in_(followed))
+             .delete(synchronize_session=False))
+
+        return {
+            requested: 'unfollowed' if requested in followed
+            else 'not_following'
+            for requested in user_ids
+        }
+
+    @classmethod
+    def followed_among_query(cls, user_id, user_ids):
+        """The ids among `user_ids` that `user_id` follows."""
+
+        return (db.session
+                .query(cls.user_being_followed_id)
+                .filter(cls.user_following_id == user_id,
+                        cls.user_being_followed_id.in_(user_ids)))
+
+    @classmethod
+    def followed_among(cls, user_id, user_ids):
+        """Which of `user_ids` does `user_id` follow? Returns a set."""
+
+        if not user_ids:
+            return set()
+
+        return {row.user_being_followed_id
+                for row in cls.followed_among_query(user_id, user_ids)}
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -45,7 +146,7 @@ class Likes(db.Model):
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        index=True
     )
 
 
@@ -94,26 +195,37 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Set when the account is deleted; its rows are purged in the
+    # background and the user is hidden in the meantime.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Related rows go with the user through ON DELETE CASCADE, so
+    # deleting a user never loads these collections.
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True
     )
 
     likes = db.relationship(
         'Message',
         secondary="likes",
-        backref='user_likes'
+        backref=db.backref('user_likes', passive_deletes=True),
+        passive_deletes=True
     )
 
     def __repr__(self):
@@ -162,7 +274,9 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = (cls.query
+                .filter_by(username=username, deleted_at=None)
+                .first())
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -176,6 +290,9 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -190,7 +307,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -202,6 +319,269 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class Job(db.Model):
+    """A deferred background job, when jobs are queued in the database."""
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='pending',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name}, {self.status}>"
+
+
+class TrendingSummary(db.Model):
+    """A trending item's count over the window ending at `window_end`, as
+    counted by the process `source`."""
+
+    __tablename__ = 'trending'
+    __table_args__ = (
+        db.Index('ix_trending_kind_window_end_source',
+                 'kind', 'window_end', 'source'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    source = db.Column(
+        db.Text,
+        nullable=False,
+        server_default='',
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    key = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    window_end = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    def __repr__(self):
+        return f"<TrendingSummary {self.kind} {self.key}: {self.count}>"
+
+
+class MonthlyActivity(db.Model):
+    """Messages posted and likes received by a user in one month.
+
+    `likes_received` counts likes on the messages posted that month.
+    """
+
+    __tablename__ = 'monthly_activity'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    month = db.Column(
+        db.Date,
+        primary_key=True,
+    )
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    likes_received = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    @classmethod
+    def bump(cls, user_id, month, messages=0, likes=0):
+        """Add to `user_id`'s counts for `month`. Doesn't commit.
+
+        Creates the row if needed, then increments it in the database,
+        so concurrent bumps never lose an update.
+        """
+
+        insert_ignore(cls.__table__, [{
+            'user_id': user_id, 'month': month,
+            'messages_count': 0, 'likes_received': 0,
+        }])
+
+        (cls.query
+         .filter(cls.user_id == user_id, cls.month == month)
+         .update({
+             cls.messages_count: cls.messages_count + messages,
+             cls.likes_received: cls.likes_received + likes,
+         }, synchronize_session=False))
+
+    @classmethod
+    def remove_likes(cls, removed):
+        """Take `{(user_id, month): count}` off the likes received, in one
+        statement. Months without a row are left alone. Doesn't commit."""
+
+        if not removed:
+            return
+
+        matches = [db.and_(cls.user_id == user_id, cls.month == month)
+                   for user_id, month in removed]
+        amount = db.case(list(zip(matches, removed.values())), else_=0)
+
+        (cls.query
+         .filter(db.or_(*matches))
+         .update({cls.likes_received: cls.likes_received - amount},
+                 synchronize_session=False))
+
+    def __repr__(self):
+        return (f"<MonthlyActivity user #{self.user_id} {self.month:%Y-%m}: "
+                f"{self.messages_count} messages>")
+
+
+class Notification(db.Model):
+    """The likes or follows a user got in one time bucket, rolled up.
+
+    One row per recipient, kind, subject and bucket however many people
+    acted: `count` of them, the latest being `actor_id`. `subject_id` is
+    the liked message's id, or 0 for follows.
+    """
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'kind', 'subject_id', 'bucket'),
+        db.Index('ix_notifications_user_id_unread', 'user_id', 'unread'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    subject_id = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    bucket = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='SET NULL'),
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    unread = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=True,
+    )
+
+    def __repr__(self):
+        return (f"<Notification #{self.id} for user #{self.user_id}: "
+                f"{self.count} {self.kind}>")
+
+
+def insert_ignore(table, rows):
+    """INSERT `rows` into `table`, skipping any that already exist.
+
+    One statement for the whole batch; duplicate keys are skipped by the
+    database rather than raising IntegrityError.
+    """
+
+    if not rows:
+        return
+
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        db.session.execute(
+            pg_insert(table).values(rows).on_conflict_do_nothing())
+    elif dialect == 'sqlite':
+        db.session.execute(table.insert().prefix_with('OR IGNORE'), rows)
+    else:
+        db.session.execute(table.insert(), rows)
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
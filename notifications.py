@@ -0,0 +1,366 @@
+"""Like and follow notifications, rolled up per time bucket.
+
+A user isn't sent one notification per like: everything of one kind
+about one subject within a NOTIFICATIONS_BUCKET is a single row of the
+`notifications` table ("alice and 42 others liked your warble"). A
+viral message therefore costs its author a row an hour, not a row a
+like.
+
+The like and follow job handlers only record the event in a
+per-process buffer. A flusher thread folds the buffer into the table
+every NOTIFICATIONS_INTERVAL seconds, or sooner once
+NOTIFICATIONS_MAX_PENDING rows are waiting. A flush issues one SELECT
+and one INSERT for the whole batch, plus one UPDATE per changed row.
+Events still in the buffer are lost if the process dies; notifications
+aren't worth a journal.
+
+The unread count in the nav bar is read from memory. `unread.get()`
+counts a user's unread rows once and then keeps the number current as
+this process flushes and as the user reads their notifications. Counts
+are re-read after NOTIFICATIONS_COUNT_TTL seconds, so events flushed by
+another process show up within that time.
+
+Config:
+
+- NOTIFICATIONS_BUCKET: seconds of events rolled into one row
+  (default 3600).
+- NOTIFICATIONS_INTERVAL: seconds between flushes (default 2.0).
+- NOTIFICATIONS_MAX_PENDING: rows waiting before an early flush
+  (default 1000).
+- NOTIFICATIONS_AUTOFLUSH: run the flusher thread (default: on unless
+  the app is TESTING; tests call `buffer.flush()`).
+- NOTIFICATIONS_COUNT_TTL: seconds an unread count is trusted
+  (default 60).
+"""
+
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+
+from flask import g
+from sqlalchemy import and_
+
+import jobs
+import queries
+from models import db, insert_ignore, Notification
+
+LIKE, FOLLOW = 'like', 'follow'
+
+# Unread counts kept per process.
+COUNTS_LIMIT = 10000
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def bucket_of(timestamp, seconds):
+    """Start of the `seconds`-long bucket `timestamp` falls in."""
+
+    elapsed = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=elapsed - elapsed % seconds)
+
+
+##############################################################################
+# Unread counts
+
+
+class UnreadCounts:
+    """Per-process cache of users' unread notification counts."""
+
+    def __init__(self):
+        self.ttl = 60
+        self._counts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            cached = self._counts.get(user_id)
+            if cached is not None and time.monotonic() < cached[1]:
+                return cached[0]
+
+        count = queries.unread_notifications_count(user_id)
+        self._set(user_id, count)
+        return count
+
+    def add(self, user_id, n):
+        """Count `n` more unread notifications, if `user_id` is cached."""
+
+        with self._lock:
+            cached = self._counts.get(user_id)
+            if cached is not None:
+                self._counts[user_id] = (cached[0] + n, cached[1])
+
+    def reset(self, user_id):
+        self._set(user_id, 0)
+
+    def _set(self, user_id, count):
+        with self._lock:
+            self._counts[user_id] = (count, time.monotonic() + self.ttl)
+            self._counts.move_to_end(user_id)
+            while len(self._counts) > COUNTS_LIMIT:
+                self._counts.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+unread = UnreadCounts()
+
+
+##############################################################################
+# Buffer
+
+
+class NotificationBuffer:
+    """Per-process buffer of notification events, keyed by their row."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.stats = Counter()
+        # {(user_id, kind, subject_id, bucket): [count, actor_id, at]}
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._flushing = threading.Lock()
+        self._pid = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('NOTIFICATIONS_BUCKET', 3600)
+        app.config.setdefault('NOTIFICATIONS_INTERVAL', 2.0)
+        app.config.setdefault('NOTIFICATIONS_MAX_PENDING', 1000)
+        app.config.setdefault('NOTIFICATIONS_COUNT_TTL', 60)
+
+        self.app = app
+        unread.ttl = app.config['NOTIFICATIONS_COUNT_TTL']
+
+    @property
+    def autoflush(self):
+        return self.app.config.get('NOTIFICATIONS_AUTOFLUSH',
+                                   not self.app.testing)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, user_id, kind, actor_id, subject_id=0, change=1):
+        """Buffer `actor_id` doing (or, with `change=-1`, undoing)
+        `kind` to `user_id`'s `subject_id`."""
+
+        if actor_id == user_id:
+            return
+
+        now = datetime.utcnow()
+        key = (user_id, kind, subject_id,
+               bucket_of(now, self.app.config['NOTIFICATIONS_BUCKET']))
+
+        with self._cond:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [change, actor_id, now]
+            else:
+                self.stats['coalesced'] += 1
+                entry[0] += change
+                if change > 0:
+                    entry[1:] = [actor_id, now]
+            self.stats['events'] += 1
+
+            if len(self._pending) >= \
+                    self.app.config['NOTIFICATIONS_MAX_PENDING']:
+                self._cond.notify()
+
+        if self.autoflush:
+            self.start()
+
+    ##########################################################################
+    # Flushing
+
+    def start(self):
+        """Start the flusher thread in this process if not running."""
+
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True,
+                             name='warbler-notifications').start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.app.config['NOTIFICATIONS_INTERVAL'])
+                if self._pid != os.getpid():
+                    return
+
+            if self._pending:
+                with self.app.app_context():
+                    try:
+                        self.flush()
+                    except Exception:
+                        self.app.logger.exception(
+                            "Notification flush failed")
+
+    def stop(self):
+        """Stop the flusher thread and drop buffered events."""
+
+        with self._cond:
+            self._pid = None
+            self._pending.clear()
+            self._cond.notify_all()
+
+    def flush(self):
+        """Fold buffered events into `notifications`; returns how many
+        rows were written."""
+
+        with self._flushing:
+            with self._cond:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            try:
+                newly_unread = _apply(batch)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                with self._cond:
+                    self.stats['errors'] += 1
+                    for key, entry in batch.items():
+                        newer = self._pending.get(key)
+                        if newer is not None:
+                            newer[0] += entry[0]
+                        else:
+                            self._pending[key] = entry
+                raise
+
+            for user_id, n in newly_unread.items():
+                unread.add(user_id, n)
+
+            with self._cond:
+                self.stats['flushes'] += 1
+                self.stats['rows'] += len(batch)
+
+            return len(batch)
+
+    def metrics(self):
+        with self._cond:
+            return dict(self.stats, pending=len(self._pending))
+
+
+def _apply(batch):
+    """Write `batch` to `notifications`; return {user_id: rows that
+    became unread}."""
+
+    table = Notification.__table__
+    user_ids = {key[0] for key in batch}
+    buckets = {key[3] for key in batch}
+
+    existing = {
+        (row.user_id, row.kind, row.subject_id, row.bucket): row.unread
+        for row in db.session.query(
+            Notification.user_id, Notification.kind,
+            Notification.subject_id, Notification.bucket,
+            Notification.unread)
+        .filter(Notification.user_id.in_(user_ids),
+                Notification.bucket.in_(buckets))
+    }
+
+    insert_ignore(table, [
+        {'user_id': key[0], 'kind': key[1], 'subject_id': key[2],
+         'bucket': key[3], 'actor_id': actor_id, 'count': 0,
+         'updated_at': at, 'unread': False}
+        for key, (change, actor_id, at) in batch.items()
+        if key not in existing and change > 0
+    ])
+
+    newly_unread = Counter()
+    for key, (change, actor_id, at) in batch.items():
+        if change == 0 or (change < 0 and key not in existing):
+            continue
+
+        values = {table.c.count: table.c.count + change}
+        if change > 0:
+            values.update({table.c.actor_id: actor_id,
+                           table.c.updated_at: at,
+                           table.c.unread: True})
+            if not existing.get(key):
+                newly_unread[key[0]] += 1
+
+        db.session.execute(table.update().where(and_(
+            table.c.user_id == key[0], table.c.kind == key[1],
+            table.c.subject_id == key[2], table.c.bucket == key[3],
+        )).values(values))
+
+    return newly_unread
+
+
+buffer = NotificationBuffer()
+
+
+def init_app(app):
+    buffer.init_app(app)
+
+    @app.context_processor
+    def unread_notifications():
+        if not getattr(g, 'user', None):
+            return {}
+        return {'unread_notifications': unread.get(g.user.id)}
+
+
+##############################################################################
+# Reading
+
+
+def mark_read(user_id):
+    """Mark all of `user_id`'s notifications read."""
+
+    (Notification.query
+     .filter(Notification.user_id == user_id,
+             Notification.unread.is_(True))
+     .update({Notification.unread: False}, synchronize_session=False))
+    db.session.commit()
+    unread.reset(user_id)
+
+
+##############################################################################
+# Job handlers
+
+
+@jobs.on('like_added')
+def notify_like(user_id, message_id, author_id):
+    buffer.record(author_id, LIKE, user_id, message_id)
+
+
+@jobs.on('like_removed')
+def unnotify_like(user_id, message_id, author_id):
+    buffer.record(author_id, LIKE, user_id, message_id, change=-1)
+
+
+@jobs.on('likes_removed')
+def unnotify_likes(user_id, likes):
+    for message_id, author_id in likes:
+        buffer.record(author_id, LIKE, user_id, message_id, change=-1)
+
+
+@jobs.on('follows_added')
+def notify_follows(user_id, followed_ids):
+    for followed_id in followed_ids:
+        buffer.record(followed_id, FOLLOW, user_id)
+
+
+@jobs.on('follows_removed')
+def unnotify_follows(user_id, followed_ids):
+    for followed_id in followed_ids:
+        buffer.record(followed_id, FOLLOW, user_id, change=-1)
+
+
+@jobs.on('message_deleted')
+def drop_message_notifications(message_id, user_id, month=None, likes=0):
+    (Notification.query
+     .filter(Notification.user_id == user_id, Notification.kind == LIKE,
+             Notification.subject_id == message_id)
+     .delete(synchronize_session=False))
+    db.session.commit()
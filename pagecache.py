@@ -0,0 +1,374 @@
+"""Rendered-page cache for anonymous visitors.
+
+Logged-out visitors to the home page, profiles and messages all get the
+same HTML, so views decorated with `page_cache.cached` store their
+response the first time and serve it to every later anonymous request
+for the same path and query string. Requests with a logged-in user or
+anything in the session (e.g. a flash message) always render.
+
+Entries are tagged with what they show (`user:<id>`, `message:<id>`).
+Writes bump the version of the tags they affect, and an entry saved
+under an older version of any of its tags counts as a miss. Invalidation
+is therefore one counter increment whatever the number of pages, and it
+works the same in every process sharing the backend. Entries also
+expire after PAGE_CACHE_TTL seconds.
+
+Invalidation runs in the job handlers at the bottom of this module, in
+whichever process runs the job, and only reaches the pages cached in
+that process's backend. A process with the in-memory backend never
+hears of writes whose jobs ran elsewhere and serves its stale pages
+until they expire. So when jobs run out of process (JOBS_PERSISTENT,
+e.g. with a `jobs-worker`), PAGE_CACHE_URL is required, and
+`init_app` refuses to start without it. Likewise, give several web
+processes one PAGE_CACHE_URL, or accept pages up to PAGE_CACHE_TTL
+old.
+
+When a popular page is missing, concurrent requests for it share a
+single render (see `singleflight`). With a shared backend, the renderer
+also takes a short lock on the key, so other processes wait for it too.
+Hot entries are re-rendered a little before they expire by one lucky
+request, so they don't expire under all their readers at once.
+
+Config:
+
+- PAGE_CACHE_ENABLED: default True, except when testing.
+- PAGE_CACHE_TTL: seconds an entry lives (default 60).
+- PAGE_CACHE_SIZE: entries kept by the in-memory backend (default 1000).
+- PAGE_CACHE_URL: `redis://` URL of a cache shared by all processes
+  (requires the `redis` package). Default: in-memory, per process;
+  required with JOBS_PERSISTENT unless the cache is disabled.
+- PAGE_CACHE_BETA: eagerness of early re-renders; 0 turns them off
+  (default 1.0).
+"""
+
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, g, request, session
+
+import jobs
+from singleflight import Group, should_refresh
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - optional shared backend
+    redis = None
+
+# How long a renderer may hold a page's lock, and how often the requests
+# waiting on it look for the result.
+LOCK_TIMEOUT = 10
+LOCK_POLL_INTERVAL = 0.05
+
+# Response headers stored with a page; everything else is per-request.
+STORED_HEADERS = ('Content-Type',)
+
+
+##############################################################################
+# Backends
+
+
+class MemoryBackend:
+    """Bounded LRU of entries with per-entry expiry, in this process."""
+
+    shared = False
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+
+            value, expires = item
+            if expires < time.time():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def versions(self, tags):
+        return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump(self, tag):
+        with self._lock:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisBackend:
+    """Entries shared by every process through Redis."""
+
+    shared = True
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("PAGE_CACHE_URL needs the redis package.")
+
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self.client.get(key)
+        return pickle.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(key, pickle.dumps(value), ex=max(int(ttl), 1))
+
+    def add(self, key, value, ttl):
+        """Set `key` unless it's already set; True if it was set."""
+
+        return bool(self.client.set(key, pickle.dumps(value),
+                                    ex=max(int(ttl), 1), nx=True))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def versions(self, tags):
+        if not tags:
+            return []
+
+        raw = self.client.mget([f"tag:{tag}" for tag in tags])
+        return [int(value or 0) for value in raw]
+
+    def bump(self, tag):
+        self.client.incr(f"tag:{tag}")
+
+
+##############################################################################
+# Cache
+
+
+class PageCache:
+    """Caches whole responses of decorated views for anonymous users."""
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.renders = Group('page_cache')
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PAGE_CACHE_TTL', 60)
+        app.config.setdefault('PAGE_CACHE_SIZE', 1000)
+        app.config.setdefault('PAGE_CACHE_URL', None)
+        app.config.setdefault('PAGE_CACHE_BETA', 1.0)
+
+        url = app.config['PAGE_CACHE_URL']
+        enabled = app.config.get('PAGE_CACHE_ENABLED', not app.testing)
+        if enabled and not url and app.config.get('JOBS_PERSISTENT'):
+            raise RuntimeError(
+                "With JOBS_PERSISTENT, jobs may run in another process "
+                "and the page cache needs a shared PAGE_CACHE_URL.")
+
+        self.backend = (RedisBackend(url) if url
+                        else MemoryBackend(app.config['PAGE_CACHE_SIZE']))
+
+        app.extensions['page_cache'] = self
+
+    def tag(self, *tags):
+        """Mark the page being rendered as showing `tags`.
+
+        Call before loading what the tags cover: their versions are read
+        here, so a write landing mid-render leaves the entry stale
+        rather than wrong.
+        """
+
+        if 'page_cache_tags' in g:
+            tags = [tag for tag in tags if tag not in g.page_cache_tags]
+            g.page_cache_tags.update(zip(tags, self.backend.versions(tags)))
+
+    def invalidate(self, *tags):
+        """Expire every cached page tagged with any of `tags`."""
+
+        for tag in tags:
+            self.backend.bump(tag)
+
+    @property
+    def enabled(self):
+        return current_app.config.get('PAGE_CACHE_ENABLED',
+                                      not current_app.testing)
+
+    def _cacheable(self):
+        return (self.enabled
+                and request.method in ('GET', 'HEAD')
+                and not g.get('user')
+                and not session)
+
+    def _lookup(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+
+        tags = list(entry['versions'])
+        if self.backend.versions(tags) != [entry['versions'][tag]
+                                           for tag in tags]:
+            return None
+
+        # Now and then re-render a hot page shortly before it expires,
+        # so it never expires under all its readers at once.
+        if should_refresh(entry['expires'], entry['delta'],
+                          current_app.config['PAGE_CACHE_BETA']):
+            return None
+
+        return entry
+
+    def _respond(self, entry, outcome):
+        response = current_app.response_class(
+            entry['body'], status=entry['status'], headers=entry['headers'])
+        response.headers['X-Page-Cache'] = outcome
+        response.vary.add('Cookie')
+
+        return response
+
+    def _entry(self, response, versions, delta):
+        """What to store for `response`, or None if it mustn't be shared."""
+
+        if (response.status_code != 200
+                or response.direct_passthrough
+                or 'Set-Cookie' in response.headers
+                or session.modified):
+            return None
+
+        return {
+            'status': response.status_code,
+            'headers': [(name, response.headers[name])
+                        for name in STORED_HEADERS
+                        if name in response.headers],
+            'body': response.get_data(),
+            'versions': versions,
+            'expires': time.time() + current_app.config['PAGE_CACHE_TTL'],
+            'delta': delta,
+        }
+
+    def _wait_for(self, key):
+        """Wait for another process rendering `key`; its entry or None."""
+
+        deadline = time.time() + LOCK_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry
+            if self.backend.get(f"lock:{key}") is None:
+                return None
+
+        return None
+
+    def _render(self, key, view, args, kwargs):
+        """Render and store `key`; returns `(response, entry)`.
+
+        With a shared backend, a render already running in another
+        process is waited for instead, and `response` is None.
+        """
+
+        lock = f"lock:{key}"
+        if self.backend.shared and not self.backend.add(
+                lock, True, LOCK_TIMEOUT):
+            entry = self._wait_for(key)
+            if entry is not None:
+                return None, entry
+
+        try:
+            g.page_cache_tags = {}
+            started = time.time()
+            response = current_app.make_response(view(*args, **kwargs))
+
+            entry = self._entry(response, g.page_cache_tags,
+                                time.time() - started)
+            if entry is not None:
+                self.backend.set(key, entry,
+                                 current_app.config['PAGE_CACHE_TTL'])
+        finally:
+            if self.backend.shared:
+                self.backend.delete(lock)
+
+        return response, entry
+
+    def cached(self, view):
+        """Decorator: cache `view`'s response for anonymous requests."""
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self._cacheable():
+                return view(*args, **kwargs)
+
+            key = f"page:{request.full_path}"
+
+            entry = self._lookup(key)
+            if entry is not None:
+                return self._respond(entry, 'HIT')
+
+            (response, entry), shared = self.renders.do(
+                key, lambda: self._render(key, view, args, kwargs))
+
+            if response is None or shared:
+                if entry is None:
+                    # The shared render can't be reused (e.g. an error
+                    # page); render our own.
+                    return view(*args, **kwargs)
+                return self._respond(entry, 'COALESCED')
+
+            response.headers['X-Page-Cache'] = 'MISS'
+            response.vary.add('Cookie')
+            return response
+
+        return wrapper
+
+
+page_cache = PageCache()
+
+
+##############################################################################
+# Invalidation
+
+
+@jobs.on('message_posted')
+def expire_author(message_id, user_id):
+    page_cache.invalidate(f"user:{user_id}")
+
+
+@jobs.on('message_deleted')
+def expire_message(message_id, user_id, **details):
+    page_cache.invalidate(f"user:{user_id}", f"message:{message_id}")
+
+
+@jobs.on('like_added')
+@jobs.on('like_removed')
+def expire_liker(user_id, message_id, author_id):
+    page_cache.invalidate(f"user:{user_id}")
+
+
+@jobs.on('follows_added')
+@jobs.on('follows_removed')
+def expire_follow_counts(user_id, followed_ids):
+    page_cache.invalidate(
+        f"user:{user_id}", *(f"user:{other}" for other in followed_ids))
+
+
+@jobs.on('user_updated')
+@jobs.on('user_deleted')
+def expire_user(user_id):
+    page_cache.invalidate(f"user:{user_id}")
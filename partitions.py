@@ -0,0 +1,435 @@
+"""Monthly partitions of the `messages` table, on Postgres.
+
+Nearly every read wants recent messages, but one ever-growing table
+makes every index lookup and vacuum pay for all of history. Range
+partitioned by month on `timestamp`, old months cost nothing day to
+day, and a month nobody reads any more can leave the database for a
+compressed archive file.
+
+Converting the table is a one-off that rewrites it under a lock:
+
+    FLASK_APP=app.py flask partition-messages
+
+Postgres (11 or later) wants the partition key in the primary key, so
+the partitioned table's is `(id, timestamp)`; ids still come from the
+same sequence and stay unique. Nothing can reference `messages.id`
+alone any more, so `likes` loses its foreign key and a trigger deletes
+a message's likes instead.
+
+With MESSAGE_PARTITIONS set, a job queued by the first message posted
+each day creates the partitions for the months ahead. Messages outside
+every partition go to `messages_default`.
+
+Old months move to MESSAGE_ARCHIVE_DIR as gzipped CSV, and back:
+
+    flask archive-messages 2019-06        (or --before 2020-01)
+    flask restore-messages 2019-06
+
+Archived messages are missing from every page until they're restored,
+though monthly activity still counts them. Restoring skips messages of
+users deleted in the meantime.
+
+Reads leave old partitions alone: keyset cursors bound `timestamp`
+directly, and with MESSAGE_HOT_MONTHS set, newest-first lists and
+lookups by id try the last few months before the whole table (see
+`queries.recent_rows()`).
+
+Config:
+
+- MESSAGE_PARTITIONS: create partitions ahead of time (default False).
+- MESSAGE_PARTITIONS_AHEAD: months created past the current one
+  (default 2).
+- MESSAGE_ARCHIVE_DIR: where archived months go (default: `archive` in
+  the instance folder).
+- MESSAGE_HOT_MONTHS: how many recent months reads try first (default:
+  unset, reads go to the whole table).
+"""
+
+import gzip
+import os
+import re
+from datetime import date, datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+import jobs
+from models import db
+
+PARENT = 'messages'
+DEFAULT_PARTITION = 'messages_default'
+AHEAD = 2
+
+_partition_name = re.compile(r'^messages_(\d{4})_(\d{2})$')
+
+
+##############################################################################
+# Months
+
+
+def add_months(month, n):
+    """First day of the month `n` months after `month`'s."""
+
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def parse_month(value):
+    """`date` of the first day of a 'YYYY-MM' month; raises ValueError."""
+
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+def partition_name(month):
+    return f"{PARENT}_{month:%Y_%m}"
+
+
+def hot_since():
+    """Start of the months reads try first, or None when unset."""
+
+    # The database's app, so queries run outside a request still work.
+    months = db.get_app().config.get('MESSAGE_HOT_MONTHS')
+    if not months:
+        return None
+
+    month = add_months(date.today().replace(day=1), 1 - months)
+    return datetime(month.year, month.month, 1)
+
+
+##############################################################################
+# Inspecting
+
+
+def _require_postgres():
+    if db.session.get_bind().dialect.name != 'postgresql':
+        raise RuntimeError("Partitioning messages needs Postgres.")
+
+
+def partitioned():
+    """Whether `messages` is a partitioned table."""
+
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return False
+
+    return db.session.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass(:parent))"
+    ), {'parent': PARENT}).scalar()
+
+
+def months():
+    """Months with a partition attached, oldest first."""
+
+    rows = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass(:parent)"
+    ), {'parent': PARENT})
+
+    return sorted(date(int(match.group(1)), int(match.group(2)), 1)
+                  for match in (_partition_name.match(name) for name, in rows)
+                  if match)
+
+
+def _default_has_rows(start, end):
+    return db.session.execute(text(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} "
+        "WHERE timestamp >= :start AND timestamp < :end)"
+    ), {'start': start, 'end': end}).scalar()
+
+
+##############################################################################
+# Creating partitions
+
+
+# Run once, in one transaction, by `convert()`.
+CONVERT = """
+LOCK TABLE messages IN ACCESS EXCLUSIVE MODE;
+
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+ALTER TABLE messages_unpartitioned
+    RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey;
+ALTER INDEX ix_messages_user_id_timestamp
+    RENAME TO ix_messages_unpartitioned_user_id_timestamp;
+
+CREATE TABLE messages (
+    LIKE messages_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+    PRIMARY KEY (id, timestamp),
+    FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+) PARTITION BY RANGE (timestamp);
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+CREATE INDEX ix_messages_user_id_timestamp ON messages (user_id, timestamp);
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+CREATE OR REPLACE FUNCTION messages_delete_likes() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM likes WHERE message_id = OLD.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER messages_delete_likes AFTER DELETE ON messages
+    FOR EACH ROW EXECUTE PROCEDURE messages_delete_likes();
+"""
+
+
+def _create(month):
+    start, end = month, add_months(month, 1)
+    db.session.execute(
+        f"CREATE TABLE {partition_name(month)} PARTITION OF {PARENT} "
+        f"FOR VALUES FROM ('{start}') TO ('{end}')")
+
+
+def convert():
+    """Rewrite `messages` as a partitioned table, one partition per month
+    with messages plus the months ahead. Returns the months created."""
+
+    _require_postgres()
+    if partitioned():
+        raise RuntimeError("The messages table is already partitioned.")
+
+    oldest = db.session.execute(
+        "SELECT min(timestamp) FROM messages").scalar()
+
+    # Foreign keys to `messages.id` can't survive: the trigger in
+    # CONVERT takes over `likes`' ON DELETE CASCADE.
+    for table, name in db.session.execute(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = 'messages'::regclass"):
+        db.session.execute(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"')
+
+    db.session.execute(CONVERT)
+
+    this_month = date.today().replace(day=1)
+    month = (oldest.date().replace(day=1) if oldest else this_month)
+    last = add_months(this_month, _ahead())
+    created = []
+    while month <= last:
+        _create(month)
+        created.append(month)
+        month = add_months(month, 1)
+
+    db.session.execute(
+        "INSERT INTO messages SELECT * FROM messages_unpartitioned")
+    db.session.execute("DROP TABLE messages_unpartitioned")
+    db.session.commit()
+
+    return created
+
+
+def _ahead():
+    return current_app.config.get('MESSAGE_PARTITIONS_AHEAD', AHEAD)
+
+
+def ensure():
+    """Create missing partitions from this month to MESSAGE_PARTITIONS_AHEAD
+    months ahead. Returns the months created.
+
+    A month whose messages already landed in the default partition is
+    skipped (and logged): attaching it would mean moving them first.
+    """
+
+    _require_postgres()
+    if not partitioned():
+        return []
+
+    existing = set(months())
+    this_month = date.today().replace(day=1)
+    created = []
+
+    for n in range(_ahead() + 1):
+        month = add_months(this_month, n)
+        if month in existing:
+            continue
+
+        if _default_has_rows(month, add_months(month, 1)):
+            current_app.logger.warning(
+                "Not creating %s: %s has messages in that month.",
+                partition_name(month), DEFAULT_PARTITION)
+            continue
+
+        _create(month)
+        created.append(month)
+
+    db.session.commit()
+    return created
+
+
+@jobs.on('message_posted')
+def schedule_partitions(message_id, user_id):
+    """The first message posted each day queues `create_partitions`."""
+
+    if current_app.config.get('MESSAGE_PARTITIONS'):
+        jobs.publish('partitions_due', key=f"partitions:{date.today()}")
+
+
+@jobs.on('partitions_due')
+def create_partitions():
+    for month in ensure():
+        current_app.logger.info("Created %s.", partition_name(month))
+
+
+##############################################################################
+# Archiving
+
+
+def archive_dir():
+    return (current_app.config.get('MESSAGE_ARCHIVE_DIR')
+            or os.path.join(current_app.instance_path, 'archive'))
+
+
+def archive_path(month):
+    return os.path.join(archive_dir(), f"{partition_name(month)}.csv.gz")
+
+
+def _copy(sql, file):
+    cursor = db.session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(sql, file)
+    finally:
+        cursor.close()
+
+
+def archive(month):
+    """Move `month`'s partition to a gzipped CSV file in the archive.
+
+    Detaching, writing and dropping happen in one transaction, and the
+    file is in place before it commits, so a failure at any point
+    leaves the partition attached. Returns the number of messages.
+    """
+
+    _require_postgres()
+    if month not in months():
+        raise RuntimeError(f"No partition for {month:%Y-%m}.")
+
+    name = partition_name(month)
+    path = archive_path(month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    try:
+        db.session.execute(f"ALTER TABLE {PARENT} DETACH PARTITION {name}")
+        count = db.session.execute(f"SELECT count(*) FROM {name}").scalar()
+
+        with open(f"{path}.tmp", 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                _copy(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(f"{path}.tmp", path)
+
+        db.session.execute(f"DROP TABLE {name}")
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return count
+
+
+def restore(month):
+    """Load an archived month back as a partition; returns the number of
+    messages restored. Messages of users deleted since are skipped."""
+
+    _require_postgres()
+    path = archive_path(month)
+    if not os.path.exists(path):
+        raise RuntimeError(f"{month:%Y-%m} isn't archived.")
+
+    name = partition_name(month)
+    start, end = month, add_months(month, 1)
+    if month in months():
+        raise RuntimeError(f"{month:%Y-%m} already has a partition.")
+    if _default_has_rows(start, end):
+        raise RuntimeError(f"{DEFAULT_PARTITION} has messages in "
+                           f"{month:%Y-%m}; move them out first.")
+
+    try:
+        db.session.execute(
+            f"CREATE TABLE {name} "
+            f"(LIKE {PARENT} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+        with gzip.open(path, 'rb') as f:
+            _copy(f"COPY {name} FROM STDIN WITH (FORMAT csv, HEADER)", f)
+
+        db.session.execute(
+            f"DELETE FROM {name} m WHERE NOT EXISTS "
+            "(SELECT 1 FROM users u "
+            "WHERE u.id = m.user_id AND u.deleted_at IS NULL)")
+        count = db.session.execute(f"SELECT count(*) FROM {name}").scalar()
+
+        # With the bounds already checked, attaching doesn't scan the
+        # table again while holding its lock on `messages`.
+        db.session.execute(
+            f"ALTER TABLE {name} ADD CONSTRAINT {name}_bounds CHECK "
+            f"(timestamp >= '{start}' AND timestamp < '{end}')")
+        db.session.execute(
+            f"ALTER TABLE {PARENT} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start}') TO ('{end}')")
+        db.session.execute(
+            f"ALTER TABLE {name} DROP CONSTRAINT {name}_bounds")
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    os.remove(path)
+    return count
+
+
+##############################################################################
+# Commands
+
+
+def _month_argument(ctx, param, value):
+    if value is None:
+        return None
+
+    try:
+        return parse_month(value)
+    except ValueError:
+        raise click.BadParameter(f"{value!r} isn't a YYYY-MM month.")
+
+
+@click.command('partition-messages')
+@with_appcontext
+def partition_messages_command():
+    """Partition messages by month, or add the months ahead."""
+
+    try:
+        created = ensure() if partitioned() else convert()
+    except RuntimeError as error:
+        raise click.ClickException(str(error))
+
+    click.echo(f"Created {len(created)} partitions.")
+
+
+@click.command('archive-messages')
+@click.argument('month', required=False, callback=_month_argument)
+@click.option('--before', callback=_month_argument,
+              help="Archive every month before this one (YYYY-MM).")
+@with_appcontext
+def archive_messages_command(month, before):
+    """Move one month of messages, or all before a month, to the archive."""
+
+    if (month is None) == (before is None):
+        raise click.UsageError("Give either MONTH or --before.")
+
+    try:
+        chosen = [month] if month else [m for m in months() if m < before]
+        for m in chosen:
+            click.echo(f"{m:%Y-%m}: archived {archive(m)} messages.")
+    except RuntimeError as error:
+        raise click.ClickException(str(error))
+
+
+@click.command('restore-messages')
+@click.argument('month', callback=_month_argument)
+@with_appcontext
+def restore_messages_command(month):
+    """Load an archived month of messages back into the database."""
+
+    try:
+        click.echo(f"{month:%Y-%m}: restored {restore(month)} messages.")
+    except RuntimeError as error:
+        raise click.ClickException(str(error))
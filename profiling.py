@@ -0,0 +1,269 @@
+"""Profiling live workers, from the admin pages.
+
+Two tools, both for one process at a time:
+
+Sampling. `sample(seconds)` wakes every `interval` and records the
+stack of each thread, grouped by the Flask endpoint that thread is
+serving (or `thread:<name>` when it isn't serving one). Nothing runs
+in the profiled threads, so overhead is the sampler's own CPU time:
+about one `sys._current_frames()` walk per interval. Results come as
+collapsed stacks, `endpoint;module:function;... count`, ready for
+flamegraph.pl or speedscope, or as per-endpoint JSON summaries. See
+`/admin/profile`.
+
+Deterministic. A request carrying a valid `X-Warbler-Profile` header
+runs under cProfile. The header value is a token an admin gets from
+`/admin/profile/token`, signed with the app's SECRET_KEY and valid
+for PROFILE_TOKEN_MAX_AGE seconds. The response gets an
+`X-Warbler-Profile-Id` header, and the profile's pstats report (the
+top functions by cumulative time) is kept for `/admin/profiles/<id>`.
+Requests without the header pay for one dict lookup.
+
+Config:
+
+- PROFILE_MAX_SECONDS: longest sampling run (default 60).
+- PROFILE_KEEP: request profiles kept per process (default 20).
+- PROFILE_TOKEN_MAX_AGE: seconds a profiling token is valid
+  (default 600).
+"""
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict, defaultdict
+from datetime import datetime
+
+from flask import current_app, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+HEADER = 'X-Warbler-Profile'
+ID_HEADER = 'X-Warbler-Profile-Id'
+
+# Functions listed in a request profile's report.
+REPORT_LINES = 40
+
+# {thread ident: endpoint} of the threads serving a request.
+_endpoints = {}
+
+
+class ProfilerBusy(Exception):
+    """Another sampling run is going on in this process."""
+
+
+##############################################################################
+# Sampling
+
+
+_sampling = threading.Lock()
+
+
+def frame_label(frame):
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+
+def collapse(frame):
+    """`frame`'s stack, outermost first, as `a;b;c`."""
+
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+
+    return ';'.join(reversed(labels))
+
+
+def sample(seconds, interval=0.01):
+    """Sample every thread's stack for `seconds`; return a Counter of
+    `(endpoint, collapsed stack)` samples.
+
+    Raises ProfilerBusy if a run is already going on.
+    """
+
+    if not _sampling.acquire(blocking=False):
+        raise ProfilerBusy()
+
+    me = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    samples = Counter()
+
+    try:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+
+                owner = _endpoints.get(ident)
+                if owner is None:
+                    if ident not in names:
+                        names.update((thread.ident, thread.name)
+                                     for thread in threading.enumerate())
+                    owner = f"thread:{names.get(ident, ident)}"
+
+                samples[owner, collapse(frame)] += 1
+
+            time.sleep(interval)
+    finally:
+        _sampling.release()
+
+    return samples
+
+
+def collapsed(samples):
+    """Samples in the collapsed-stack format flame graph tools read."""
+
+    return ''.join(f"{owner};{stack} {count}\n"
+                   for (owner, stack), count in sorted(samples.items()))
+
+
+def summarize(samples, top=20):
+    """Per endpoint: samples taken and the functions most often on CPU
+    (the innermost frame), hottest first."""
+
+    totals = Counter()
+    leaves = defaultdict(Counter)
+
+    for (owner, stack), count in samples.items():
+        totals[owner] += count
+        leaves[owner][stack.rsplit(';', 1)[-1]] += count
+
+    return OrderedDict(
+        (owner, {'samples': total, 'top': leaves[owner].most_common(top)})
+        for owner, total in totals.most_common())
+
+
+##############################################################################
+# Per-request profiles
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.secret_key, salt='warbler-profile')
+
+
+def token(issued_by):
+    """A token for the `X-Warbler-Profile` header, for the current app."""
+
+    return _serializer(current_app).dumps({'by': issued_by})
+
+
+class ProfileMiddleware:
+    """WSGI middleware running requests with a valid token under
+    cProfile."""
+
+    def __init__(self, app, wsgi_app):
+        self.app = app
+        self.wsgi_app = wsgi_app
+
+    def _valid(self, token):
+        try:
+            _serializer(self.app).loads(
+                token, max_age=self.app.config['PROFILE_TOKEN_MAX_AGE'])
+        except BadSignature:
+            return False
+        return True
+
+    def __call__(self, environ, start_response):
+        token = environ.get('HTTP_X_WARBLER_PROFILE')
+        if not token or not self._valid(token):
+            return self.wsgi_app(environ, start_response)
+
+        profile_id = uuid.uuid4().hex[:12]
+
+        def start(status, headers, exc_info=None):
+            headers.append((ID_HEADER, profile_id))
+            return start_response(status, headers, exc_info)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles one thread at a time; this request
+            # runs unprofiled.
+            return self.wsgi_app(environ, start_response)
+
+        started = time.perf_counter()
+        try:
+            response = self.wsgi_app(environ, start)
+            try:
+                body = list(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+        finally:
+            profile.disable()
+
+        profiles.keep(profile_id, environ, profile,
+                      time.perf_counter() - started,
+                      self.app.config['PROFILE_KEEP'])
+        return body
+
+
+class ProfileStore:
+    """The last few request profiles of this process."""
+
+    def __init__(self):
+        self._profiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def keep(self, profile_id, environ, profile, duration, limit):
+        report = io.StringIO()
+        (pstats.Stats(profile, stream=report)
+         .sort_stats('cumulative')
+         .print_stats(REPORT_LINES))
+
+        entry = {
+            'id': profile_id,
+            'at': datetime.utcnow().isoformat(),
+            'endpoint': environ.get('warbler.endpoint'),
+            'path': environ.get('PATH_INFO'),
+            'duration_ms': round(duration * 1000, 1),
+            'report': report.getvalue(),
+        }
+
+        with self._lock:
+            self._profiles[profile_id] = entry
+            while len(self._profiles) > limit:
+                self._profiles.popitem(last=False)
+
+    def recent(self):
+        """Kept profiles without their reports, newest first."""
+
+        with self._lock:
+            entries = list(self._profiles.values())
+
+        return [{key: value for key, value in entry.items()
+                 if key != 'report'} for entry in reversed(entries)]
+
+    def get(self, profile_id):
+        with self._lock:
+            return self._profiles.get(profile_id)
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+
+
+profiles = ProfileStore()
+
+
+def _track_endpoint():
+    _endpoints[threading.get_ident()] = request.endpoint
+    request.environ['warbler.endpoint'] = request.endpoint
+
+
+def _untrack_endpoint(error=None):
+    _endpoints.pop(threading.get_ident(), None)
+
+
+def init_app(app):
+    app.config.setdefault('PROFILE_MAX_SECONDS', 60)
+    app.config.setdefault('PROFILE_KEEP', 20)
+    app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 600)
+
+    app.wsgi_app = ProfileMiddleware(app, app.wsgi_app)
+    app.before_request(_track_endpoint)
+    app.teardown_request(_untrack_endpoint)
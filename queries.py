@@ -0,0 +1,690 @@
+"""Column-projected read queries for Warbler.
+
+These queries select only the columns a page or API payload needs and
+return `readmodels` rows instead of hydrated ORM objects: `fetch()`
+runs the builders' statements through Core and wraps each row in its
+read model. Lists are paged with keyset cursors rather than OFFSET so
+deep pages cost the same as the first one.
+
+Message lists stay clear of old partitions of a partitioned `messages`
+table (see `partitions`): cursors bound `timestamp` directly, and
+`recent_rows()` reads the last few months before the rest.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import aliased
+
+import partitions
+from models import db, User, Message, Follows, Likes, Notification
+from readmodels import (Counts, DirectoryCard, LikedMessageRow, MessageRow,
+                        NotificationRow, ProfileRow, UserCard)
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+##############################################################################
+# Cursors
+
+
+def encode_cursor(*values):
+    """Encode cursor values into an opaque url-safe token."""
+
+    raw = '|'.join(
+        value.strftime(CURSOR_TIME_FORMAT) if isinstance(value, datetime)
+        else str(value)
+        for value in values
+    )
+    return urlsafe_b64encode(raw.encode('UTF-8')).decode('ascii').rstrip('=')
+
+
+def _decode_parts(token):
+    """Split an opaque cursor token into its raw string parts."""
+
+    padded = token + '=' * (-len(token) % 4)
+    try:
+        return urlsafe_b64decode(padded.encode('ascii')).decode('UTF-8') \
+            .split('|')
+    except (ValueError, UnicodeError):
+        raise ValueError(f"Invalid cursor: {token!r}")
+
+
+def decode_message_cursor(token):
+    """Decode a `(timestamp, id)` message cursor.
+
+    Raises ValueError if the token is malformed.
+    """
+
+    parts = _decode_parts(token)
+    if len(parts) != 2:
+        raise ValueError(f"Invalid cursor: {token!r}")
+
+    return datetime.strptime(parts[0], CURSOR_TIME_FORMAT), int(parts[1])
+
+
+def decode_id_cursor(token):
+    """Decode a single integer id cursor.
+
+    Raises ValueError if the token is malformed.
+    """
+
+    parts = _decode_parts(token)
+    if len(parts) != 1:
+        raise ValueError(f"Invalid cursor: {token!r}")
+
+    return int(parts[0])
+
+
+def page_size(requested):
+    """Clamp a requested page size to the allowed range."""
+
+    try:
+        size = int(requested)
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def split_page(rows, limit, cursor_for):
+    """Trim `limit + 1` fetched rows to a page; return (rows, cursor).
+
+    Pages are fetched one row long so we learn whether there's another
+    page without a separate count query.
+    """
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, cursor_for(rows[-1])
+
+    return rows, None
+
+
+def fetch(query, row_type):
+    """Run column `query` and return its rows as `row_type` read models.
+
+    The statement goes straight to Core: the ORM's per-row processing
+    is skipped, since the read model replaces its result tuples anyway.
+    """
+
+    return [row_type._make(row) for row in db.session.execute(query.statement)]
+
+
+def fetch_one(query, row_type):
+    """`fetch()`'s first row, or None."""
+
+    rows = fetch(query.limit(1), row_type)
+    return rows[0] if rows else None
+
+
+def _paginate(query, limit, cursor_for, row_type):
+    """Run `query` for one page; return (rows, next cursor or None)."""
+
+    return split_page(fetch(query.limit(limit + 1), row_type),
+                      limit, cursor_for)
+
+
+def recent_rows(query, limit):
+    """The first `limit` rows of a newest-first message `query`, as
+    `MessageRow`s.
+
+    With MESSAGE_HOT_MONTHS set, tries just the messages of those months
+    first, which on a partitioned table reads only their partitions, and
+    runs the whole query only when they're too few to fill the page.
+    """
+
+    since = partitions.hot_since()
+    if since is not None:
+        rows = fetch(query.filter(Message.timestamp >= since).limit(limit),
+                     MessageRow)
+        if len(rows) == limit:
+            return rows
+
+    return fetch(query.limit(limit), MessageRow)
+
+
+def _paginate_messages(query, limit):
+    """`_paginate` for a newest-first message `query`."""
+
+    return split_page(recent_rows(query, limit + 1), limit, message_cursor)
+
+
+def find_messages(message_ids):
+    """`MessageRow`s for the ids in `message_ids`, in no order.
+
+    Like `recent_rows()`, looks among recent messages first and in the
+    whole table only for ids it didn't find there.
+    """
+
+    found = []
+    missing = set(message_ids)
+
+    since = partitions.hot_since()
+    if since is not None and missing:
+        found = fetch(_message_query().filter(Message.id.in_(missing),
+                                              Message.timestamp >= since),
+                      MessageRow)
+        missing -= {row.id for row in found}
+
+    if missing:
+        found += fetch(_message_query().filter(Message.id.in_(missing)),
+                       MessageRow)
+
+    return found
+
+
+##############################################################################
+# Messages
+
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    User.id.label('user_id'),
+    User.username,
+    User.image_url,
+)
+
+
+def _message_query():
+    """Messages joined to their author, projected to display columns."""
+
+    return (db.session
+            .query(*MESSAGE_COLUMNS)
+            .join(User, Message.user_id == User.id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def _before(query, before):
+    """Restrict `query` to messages older than a `(timestamp, id)` key."""
+
+    if before is None:
+        return query
+
+    timestamp, msg_id = before
+    return query.filter(
+        # Implied by the OR below, but only a plain bound lets Postgres
+        # skip the partitions newer than the cursor.
+        Message.timestamp <= timestamp,
+        or_(Message.timestamp < timestamp,
+            and_(Message.timestamp == timestamp, Message.id < msg_id)),
+    )
+
+
+def _after(query, after):
+    """Restrict `query` to messages newer than a `(timestamp, id)` key."""
+
+    timestamp, msg_id = after
+    return query.filter(
+        Message.timestamp >= timestamp,
+        or_(Message.timestamp > timestamp,
+            and_(Message.timestamp == timestamp, Message.id > msg_id)),
+    )
+
+
+def _newest_first(query):
+    return query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+
+def _oldest_first(query):
+    return query.order_by(Message.timestamp, Message.id)
+
+
+def message_cursor(row):
+    """Cursor pointing just past `row` in a newest-first message list."""
+
+    return encode_cursor(row.timestamp, row.id)
+
+
+def id_cursor(row):
+    """Cursor pointing just past `row` in an id-ordered user list."""
+
+    return encode_cursor(row.id)
+
+
+def like_cursor(row):
+    """Cursor pointing just past `row` in a liked-messages list."""
+
+    return encode_cursor(row.like_id)
+
+
+def following_ids_select(user_id):
+    """Subselect of ids of the users `user_id` follows."""
+
+    return (db.select([Follows.user_being_followed_id])
+            .where(Follows.user_following_id == user_id))
+
+
+def following_ids_query(user_id):
+    """Ids of the users `user_id` follows, as a query."""
+
+    return (db.session.query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id))
+
+
+def _timeline_filter(query, user_id):
+    """Restrict `query` to the messages on `user_id`'s home timeline:
+    their own plus those of the users they follow."""
+
+    return query.filter(or_(
+        Message.user_id.in_(following_ids_select(user_id)),
+        Message.user_id == user_id,
+    ))
+
+
+def following_ids(user_id):
+    """Set of ids of the users `user_id` follows."""
+
+    return {row[0] for row in
+            db.session.execute(following_ids_query(user_id).statement)}
+
+
+def timeline_query(user_id, before=None):
+    """Home timeline for `user_id`: their messages plus followed users'."""
+
+    query = _timeline_filter(_message_query(), user_id)
+
+    return _newest_first(_before(query, before))
+
+
+def timeline_since_query(user_id, after):
+    """Timeline messages newer than the `(timestamp, id)` key `after`,
+    oldest first."""
+
+    query = _timeline_filter(_message_query(), user_id)
+
+    return _oldest_first(_after(query, after))
+
+
+def timeline_since(user_id, after, limit=PAGE_SIZE):
+    """Up to `limit` timeline messages newer than `after`, oldest first;
+    returns (rows, whether there are more)."""
+
+    rows = fetch(timeline_since_query(user_id, after).limit(limit + 1),
+                 MessageRow)
+
+    return rows[:limit], len(rows) > limit
+
+
+def timeline(user_id, before=None, limit=PAGE_SIZE):
+    """Page of `timeline_query`; returns (rows, next cursor or None)."""
+
+    return _paginate_messages(timeline_query(user_id, before), limit)
+
+
+def user_messages_query(user_id, before=None):
+    """Messages written by `user_id`, newest first."""
+
+    query = _message_query().filter(Message.user_id == user_id)
+
+    return _newest_first(_before(query, before))
+
+
+def user_messages(user_id, before=None, limit=PAGE_SIZE):
+    """Page of `user_messages_query`; returns (rows, next cursor or None)."""
+
+    return _paginate_messages(user_messages_query(user_id, before), limit)
+
+
+def month_messages_query(user_id, start, end, before=None):
+    """Messages `user_id` wrote from `start` up to `end`, newest first.
+
+    Seeks straight to the range through the `(user_id, timestamp)`
+    index instead of paging back through newer messages.
+    """
+
+    query = _message_query().filter(Message.user_id == user_id,
+                                    Message.timestamp >= start,
+                                    Message.timestamp < end)
+
+    return _newest_first(_before(query, before))
+
+
+def month_messages(user_id, start, end, before=None, limit=PAGE_SIZE):
+    """Page of `month_messages_query`; returns (rows, next cursor or None)."""
+
+    return _paginate_messages(
+        month_messages_query(user_id, start, end, before), limit)
+
+
+def likes_query(user_id, before=None):
+    """Ids of `user_id`'s likes and of the messages liked, newest first."""
+
+    query = (db.session
+             .query(Likes.id, Likes.message_id)
+             .filter(Likes.user_id == user_id))
+
+    if before is not None:
+        query = query.filter(Likes.id < before)
+
+    return query.order_by(Likes.id.desc())
+
+
+def liked_messages(user_id, before=None, limit=PAGE_SIZE):
+    """Messages `user_id` liked, most recently liked first; returns (rows,
+    next cursor or None).
+
+    Paged by the like's id rather than the message timestamp. The likes
+    come first and their messages are looked up after, so the lookup
+    can try recent messages first. Likes of messages that are gone, or
+    whose author is, are skipped.
+    """
+
+    rows = []
+    while len(rows) <= limit:
+        wanted = limit + 1 - len(rows)
+        likes = likes_query(user_id, before).limit(wanted).all()
+        found = {row.id: row for row in find_messages(
+            [like.message_id for like in likes])}
+
+        rows += [LikedMessageRow(*found[like.message_id], like.id)
+                 for like in likes if like.message_id in found]
+
+        if len(likes) < wanted:
+            break
+        before = likes[-1].id
+
+    return split_page(rows, limit, like_cursor)
+
+
+def message_detail_query(message_id):
+    """Single message with its author."""
+
+    return _message_query().filter(Message.id == message_id)
+
+
+def message_detail(message_id):
+    """Run `message_detail_query`; returns the row or None."""
+
+    return fetch_one(message_detail_query(message_id), MessageRow)
+
+
+def messages_by_ids(message_ids):
+    """Messages with their authors for `message_ids`, in the order given.
+
+    Ids of missing messages, or of deleted users' messages, are skipped.
+    """
+
+    if not message_ids:
+        return []
+
+    return ordered_by_ids(find_messages(message_ids), message_ids)
+
+
+def ordered_by_ids(rows, ids):
+    """`rows` in the order of their ids in `ids`, skipping missing ids."""
+
+    by_id = {row.id: row for row in rows}
+
+    return [by_id[row_id] for row_id in ids if row_id in by_id]
+
+
+def liked_message_ids_query(user_id, message_ids):
+    """The ids among `message_ids` that `user_id` has liked."""
+
+    return (db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == user_id,
+                    Likes.message_id.in_(message_ids)))
+
+
+def liked_message_ids(user_id, message_ids):
+    """Subset of `message_ids` that `user_id` has liked."""
+
+    if not message_ids:
+        return set()
+
+    return {row.message_id
+            for row in liked_message_ids_query(user_id, message_ids)}
+
+
+##############################################################################
+# Users
+
+
+PROFILE_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+    User.location,
+)
+
+CARD_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.bio,
+)
+
+DIRECTORY_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+)
+
+
+def _count(model, *criteria):
+    """Correlated scalar COUNT(*) subquery over `model`'s table."""
+
+    return (db.select([func.count()])
+            .select_from(model.__table__)
+            .where(and_(*criteria))
+            .as_scalar())
+
+
+def profile_query(user_id):
+    """Profile header for `user_id` with its counts.
+
+    The four counts are scalar subqueries so the whole header is one
+    round trip and no related rows are loaded.
+    """
+
+    return (db.session
+            .query(
+                *PROFILE_COLUMNS,
+                _count(Message, Message.user_id == User.id)
+                .label('messages_count'),
+                _count(Follows,
+                       Follows.user_following_id == User.id)
+                .label('following_count'),
+                _count(Follows,
+                       Follows.user_being_followed_id == User.id)
+                .label('followers_count'),
+                _count(Likes, Likes.user_id == User.id)
+                .label('likes_count'),
+            )
+            .filter(User.id == user_id, User.deleted_at.is_(None)))
+
+
+def profile(user_id):
+    """Run `profile_query`; returns the row or None."""
+
+    return fetch_one(profile_query(user_id), ProfileRow)
+
+
+def user_counts_query(user_id):
+    """`profile_query`'s message and follow counts alone.
+
+    Doesn't read the users table, for pages whose user is already known
+    (the home sidebar).
+    """
+
+    return db.session.query(
+        _count(Message, Message.user_id == user_id)
+        .label('messages_count'),
+        _count(Follows, Follows.user_following_id == user_id)
+        .label('following_count'),
+        _count(Follows, Follows.user_being_followed_id == user_id)
+        .label('followers_count'),
+    )
+
+
+def user_counts(user_id):
+    """Run `user_counts_query`; returns its row."""
+
+    return fetch_one(user_counts_query(user_id), Counts)
+
+
+def user_cards_query(user_ids):
+    """User cards for `user_ids`, in no order."""
+
+    return (db.session
+            .query(*CARD_COLUMNS)
+            .filter(User.id.in_(user_ids), User.deleted_at.is_(None)))
+
+
+def user_cards(user_ids):
+    """User cards for `user_ids`, in the order given.
+
+    Ids of missing or deleted users are skipped.
+    """
+
+    if not user_ids:
+        return []
+
+    return ordered_by_ids(fetch(user_cards_query(user_ids), UserCard),
+                          user_ids)
+
+
+def user_cards_by_username(usernames):
+    """User cards for `usernames`, in the order given, skipping unknowns."""
+
+    if not usernames:
+        return []
+
+    rows = fetch(db.session
+                 .query(*CARD_COLUMNS)
+                 .filter(User.username.in_(usernames),
+                         User.deleted_at.is_(None)),
+                 UserCard)
+    by_name = {row.username: row for row in rows}
+
+    return [by_name[name] for name in usernames if name in by_name]
+
+
+def _user_cards_query(edge_column, match_column, user_id, after):
+    """User cards joined through `follows`, ordered by user id."""
+
+    query = (db.session
+             .query(*CARD_COLUMNS)
+             .join(Follows, edge_column == User.id)
+             .filter(match_column == user_id, User.deleted_at.is_(None)))
+
+    if after is not None:
+        query = query.filter(User.id > after)
+
+    return query.order_by(User.id)
+
+
+def followers_query(user_id, after=None):
+    """Users following `user_id`."""
+
+    return _user_cards_query(Follows.user_following_id,
+                             Follows.user_being_followed_id,
+                             user_id, after)
+
+
+def followers(user_id, after=None, limit=PAGE_SIZE):
+    """Page of `followers_query`; returns (rows, next cursor or None)."""
+
+    return _paginate(followers_query(user_id, after), limit, id_cursor,
+                     UserCard)
+
+
+def following_query(user_id, after=None):
+    """Users `user_id` follows."""
+
+    return _user_cards_query(Follows.user_being_followed_id,
+                             Follows.user_following_id,
+                             user_id, after)
+
+
+def following(user_id, after=None, limit=PAGE_SIZE):
+    """Page of `following_query`; returns (rows, next cursor or None)."""
+
+    return _paginate(following_query(user_id, after), limit, id_cursor,
+                     UserCard)
+
+
+def user_directory(search=None):
+    """Every live user for the users page, or those whose username
+    contains `search`."""
+
+    query = (db.session
+             .query(*DIRECTORY_COLUMNS)
+             .filter(User.deleted_at.is_(None)))
+
+    if search:
+        query = query.filter(User.username.like(f"%{search}%"))
+
+    return fetch(query, DirectoryCard)
+
+
+##############################################################################
+# Notifications
+
+
+_Actor = aliased(User)
+
+NOTIFICATION_COLUMNS = (
+    Notification.id,
+    Notification.kind,
+    Notification.count,
+    Notification.updated_at,
+    Notification.unread,
+    Notification.subject_id,
+    Message.text.label('subject_text'),
+    _Actor.id.label('actor_id'),
+    _Actor.username.label('actor_username'),
+    _Actor.image_url.label('actor_image_url'),
+)
+
+
+def notifications_query(user_id, before=None):
+    """`user_id`'s notifications, newest first.
+
+    Likes of messages that are gone are left out; an actor who is gone
+    shows as None.
+    """
+
+    query = (db.session
+             .query(*NOTIFICATION_COLUMNS)
+             .outerjoin(Message, and_(Notification.kind == 'like',
+                                      Message.id == Notification.subject_id))
+             .outerjoin(_Actor, and_(_Actor.id == Notification.actor_id,
+                                     _Actor.deleted_at.is_(None)))
+             .filter(Notification.user_id == user_id,
+                     Notification.count > 0,
+                     or_(Notification.kind != 'like', Message.id.isnot(None))))
+
+    if before is not None:
+        query = query.filter(Notification.id < before)
+
+    return query.order_by(Notification.id.desc())
+
+
+def notifications(user_id, before=None, limit=PAGE_SIZE):
+    """Page of `notifications_query`; returns (rows, next cursor or None)."""
+
+    return _paginate(notifications_query(user_id, before), limit, id_cursor,
+                     NotificationRow)
+
+
+def unread_notifications_count(user_id):
+    """How many of `user_id`'s notifications are unread."""
+
+    return (db.session.query(func.count(Notification.id))
+            .filter(Notification.user_id == user_id,
+                    Notification.unread.is_(True),
+                    Notification.count > 0)
+            .scalar())
@@ -0,0 +1,85 @@
+"""Read models: the immutable rows Warbler's pages and API print.
+
+`queries` runs column-projected statements and wraps each result row in
+one of these types. They're namedtuples with empty `__slots__`: no
+identity map, no change tracking, no instance `__dict__`, and only the
+columns a page shows, so listing a hundred messages costs a hundred
+small tuples rather than two hundred hydrated `Message` and `User`
+instances (see `bench_reads.py`).
+
+Message rows carry their author's display fields flat, as the API
+serializers expect, and also as `.user` so templates written against
+`Message.user` render them unchanged.
+"""
+
+from collections import namedtuple
+
+
+class Author(namedtuple('Author', 'id username image_url')):
+    """A message's author, as much of it as a timeline shows."""
+
+    __slots__ = ()
+
+
+class _Authored:
+    __slots__ = ()
+
+    @property
+    def user(self):
+        return Author(self.user_id, self.username, self.image_url)
+
+
+class MessageRow(_Authored, namedtuple(
+        'MessageRow', 'id text timestamp user_id username image_url')):
+    """A message with its author."""
+
+    __slots__ = ()
+
+
+class LikedMessageRow(_Authored, namedtuple(
+        'LikedMessageRow', MessageRow._fields + ('like_id',))):
+    """A liked message, with the like's id to page by."""
+
+    __slots__ = ()
+
+
+class UserCard(namedtuple('UserCard', 'id username image_url bio')):
+    """A user in a list: followers, following, suggestions."""
+
+    __slots__ = ()
+
+
+class DirectoryCard(namedtuple(
+        'DirectoryCard', 'id username image_url header_image_url bio')):
+    """A user on the users page, which shows their header image too."""
+
+    __slots__ = ()
+
+
+class Counts(namedtuple(
+        'Counts', 'messages_count following_count followers_count')):
+    """A user's message and follow counts."""
+
+    __slots__ = ()
+
+
+class ProfileRow(namedtuple(
+        'ProfileRow',
+        'id username image_url header_image_url bio location '
+        'messages_count following_count followers_count likes_count')):
+    """A profile header with its counts."""
+
+    __slots__ = ()
+
+
+class NotificationRow(namedtuple(
+        'NotificationRow',
+        'id kind count updated_at unread subject_id subject_text '
+        'actor_id actor_username actor_image_url')):
+    """A rolled-up notification: the latest actor and how many others."""
+
+    __slots__ = ()
+
+    @property
+    def others(self):
+        return self.count - 1
@@ -0,0 +1,185 @@
+"""Who-to-follow recommendations for Warbler.
+
+Suggestions are friends-of-friends: users followed by the people you
+follow, scored by how many of them follow that user and boosted if the
+user has posted recently.
+
+The follow graph comes from `graph.index`, so suggestions see follows
+and unfollows as soon as the index does. Users' last post times and the
+most followed accounts are cached here and reloaded when the index is
+rebuilt or the cache gets old. Both are built in the background, and
+there are no suggestions until they are.
+
+Config:
+
+- RECOMMENDATIONS_MAX_AGE: seconds before user activity is reloaded
+  (default 600).
+- RECOMMENDATIONS_BACKGROUND: load in a background thread rather than
+  in the request that finds the snapshot missing or stale (default: on,
+  except when testing).
+"""
+
+import heapq
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func
+
+import graph
+import jobs
+from models import db, Message
+
+# Followees of a user whose own followees are explored. Keeps a user
+# who follows thousands of accounts from making suggestions slow.
+MAX_FANOUT = 200
+
+# How much posting recently can add to a score, and how fast that fades.
+ACTIVITY_WEIGHT = 1.0
+ACTIVITY_HALF_LIFE_DAYS = 7.0
+
+# Suggestions for users with no friends-of-friends come from the most
+# followed users; this many are kept.
+POPULAR_SIZE = 50
+
+
+class Recommender:
+    """Friends-of-friends suggestions over the in-memory follow graph."""
+
+    def __init__(self):
+        self.last_active = {}
+        self.popular = []
+        self.built_at = 0
+        self.graph_generation = None
+
+        self._building = threading.Lock()
+
+    ##########################################################################
+    # Snapshot
+
+    def rebuild(self):
+        """Reload user activity and the most followed users."""
+
+        with self._building:
+            self._load()
+
+    def _load(self):
+        last_active = {
+            row.user_id: row.last_post for row in
+            db.session.query(Message.user_id,
+                             func.max(Message.timestamp).label('last_post'))
+            .group_by(Message.user_id)
+        }
+        popular = graph.index.most_followed(POPULAR_SIZE)
+
+        self.last_active = last_active
+        self.popular = popular
+        self.built_at = time.time()
+        self.graph_generation = graph.index.generation
+
+    def _stale(self):
+        return (
+            self.graph_generation != graph.index.generation
+            or time.time() - self.built_at
+            > current_app.config.get('RECOMMENDATIONS_MAX_AGE', 600)
+        )
+
+    def ensure_fresh(self):
+        """Rebuild if activity has gone stale or the graph was reloaded.
+
+        Returns whether there is anything to suggest from yet. Neither
+        the follow graph nor the activity snapshot is built on the
+        request path: until both exist this starts them in the
+        background and returns False.
+
+        One thread rebuilds at a time, and looks again once it has the
+        lock, so requests queued behind a rebuild don't repeat it.
+        """
+
+        graph.index.refresh(wait=False)
+        if not graph.index.ready:
+            return False
+
+        if not self._stale():
+            return True
+
+        app = current_app._get_current_object()
+        if app.config.get('RECOMMENDATIONS_BACKGROUND', not app.testing):
+            if self._building.acquire(blocking=False):
+                threading.Thread(target=self._rebuild_in_background,
+                                 args=(app,), daemon=True,
+                                 name='warbler-recommendations').start()
+            return bool(self.built_at)
+
+        with self._building:
+            if self._stale():
+                self._load()
+
+        return True
+
+    def _rebuild_in_background(self, app):
+        try:
+            with app.app_context():
+                if self._stale():
+                    self._load()
+        finally:
+            self._building.release()
+
+    def posted(self, user_id, timestamp):
+        self.last_active[user_id] = timestamp
+
+    ##########################################################################
+    # Queries
+
+    def _activity(self, user_id, now):
+        last_post = self.last_active.get(user_id)
+        if last_post is None:
+            return 0.0
+
+        age_days = max((now - last_post).total_seconds(), 0) / 86400
+        return 0.5 ** (age_days / ACTIVITY_HALF_LIFE_DAYS)
+
+    def suggest(self, user_id, k=5):
+        """Top `k` `(user_id, score)` suggestions for `user_id`."""
+
+        if not self.ensure_fresh():
+            return []
+
+        following = graph.index.following_ids(user_id)
+        mutuals = Counter()
+
+        for followed_id in sorted(following)[:MAX_FANOUT]:
+            for candidate in graph.index.following_ids(followed_id):
+                mutuals[candidate] += 1
+
+        excluded = following | {user_id}
+        now = datetime.utcnow()
+
+        scored = [
+            (count * (1 + ACTIVITY_WEIGHT * self._activity(candidate, now)),
+             candidate)
+            for candidate, count in mutuals.items()
+            if candidate not in excluded
+        ]
+        top = heapq.nlargest(k, scored, key=lambda pair: (pair[0], -pair[1]))
+        suggestions = [(candidate, score) for score, candidate in top]
+
+        # Not enough friends-of-friends: pad with popular accounts.
+        chosen = excluded | {candidate for candidate, score in suggestions}
+        for candidate in self.popular:
+            if len(suggestions) >= k:
+                break
+            if candidate not in chosen:
+                suggestions.append((candidate, 0.0))
+
+        return suggestions
+
+
+engine = Recommender()
+
+
+@jobs.on('message_posted')
+def record_activity(message_id, user_id):
+    engine.posted(user_id, datetime.utcnow())
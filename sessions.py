@@ -0,0 +1,489 @@
+"""Server-side sessions for Warbler.
+
+The session cookie holds only a random session id; the session's data
+lives in a store on the server. That makes sessions revocable: deleting
+an account or changing a password ends every session of the user at
+once, and the store knows which users are signed in.
+
+Sessions expire after SESSION_IDLE_TIMEOUT seconds without a request.
+Each request slides the expiry forward, but the store is only written
+when the session changed or at most every SESSION_TOUCH_INTERVAL
+seconds, so most requests don't write at all.
+
+A logged-out visitor's session usually holds nothing but the CSRF token
+of the login or signup form. That's kept in the cookie itself, signed
+with SECRET_KEY, rather than in the store: anonymous traffic doesn't
+grow the store, however many visitors never come back. The session
+moves into the store as soon as it holds anything else.
+
+The in-memory store drops expired sessions as it saves new ones and
+keeps at most SESSION_STORE_SIZE, forgetting the least recently written
+first.
+
+At login the session also keeps a snapshot of the user's profile
+(`SNAPSHOT_FIELDS`): enough for the nav bar and the home sidebar. On
+each request `g.user` is a `CurrentUser` built from it, and the `User`
+row is only loaded when a view asks for something the snapshot lacks.
+
+Config:
+
+- SESSION_STORE_URL: `redis://` URL of a store shared by all processes
+  (requires the `redis` package). Default: in-memory, per process, so
+  deployments with several processes need a shared store.
+- SESSION_STORE_SIZE: sessions the in-memory store keeps (default
+  100000).
+- SESSION_IDLE_TIMEOUT: seconds a session lives without requests
+  (default 14 days).
+- SESSION_TOUCH_INTERVAL: how often an unchanged session's expiry is
+  pushed back, in seconds (default 60).
+"""
+
+import secrets
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import click
+from flask import current_app, session
+from flask.cli import with_appcontext
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadData, URLSafeTimedSerializer
+from werkzeug.datastructures import CallbackDict
+
+from models import User
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - optional shared store
+    redis = None
+
+# Session key of the user snapshot.
+SNAPSHOT_KEY = 'user_snapshot'
+
+# User columns copied into the session at login.
+SNAPSHOT_FIELDS = ('id', 'username', 'image_url', 'header_image_url',
+                   'bio', 'location')
+
+DEFAULT_IDLE_TIMEOUT = 14 * 24 * 3600
+DEFAULT_STORE_SIZE = 100000
+
+# Session keys that alone don't earn a place in the store: a session
+# holding only these lives in its signed cookie.
+COOKIE_KEYS = frozenset({'csrf_token'})
+
+
+##############################################################################
+# Stores
+
+
+class MemoryStore:
+    """Sessions in a dict in this process, indexed by user.
+
+    The dict is kept in the order sessions were last written. Every
+    session lives for the same idle timeout, so that's also the order
+    they expire in, and a save only looks at the oldest few to sweep
+    the expired ones.
+    """
+
+    def __init__(self, max_entries=DEFAULT_STORE_SIZE):
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+        self._by_user = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def load(self, sid):
+        """`(data, expires)` of session `sid`, or None."""
+
+        with self._lock:
+            item = self._sessions.get(sid)
+            if item is None:
+                return None
+
+            data, user_id, expires = item
+            if expires < time.time():
+                self._drop(sid)
+                return None
+
+            return data, expires
+
+    def save(self, sid, data, user_id, ttl):
+        with self._lock:
+            self._drop(sid)
+            self._sessions[sid] = (data, user_id, time.time() + ttl)
+            if user_id is not None:
+                self._by_user[user_id].add(sid)
+            self._sweep()
+
+    def touch(self, sid, ttl):
+        with self._lock:
+            item = self._sessions.get(sid)
+            if item is not None:
+                data, user_id, expires = item
+                self._sessions[sid] = (data, user_id, time.time() + ttl)
+                self._sessions.move_to_end(sid)
+
+    def delete(self, sid):
+        with self._lock:
+            self._drop(sid)
+
+    def user_sessions(self, user_id):
+        with self._lock:
+            return set(self._by_user.get(user_id, ()))
+
+    def revoke_user(self, user_id, keep=None):
+        """Delete the sessions of `user_id` except `keep`; how many."""
+
+        with self._lock:
+            sids = self._by_user.get(user_id, set()) - {keep}
+            for sid in sids:
+                self._drop(sid)
+
+        return len(sids)
+
+    def active_users(self):
+        """How many users have a live session."""
+
+        now = time.time()
+        with self._lock:
+            return len({user_id for data, user_id, expires
+                        in self._sessions.values()
+                        if user_id is not None and expires >= now})
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def _sweep(self):
+        """Drop expired sessions, then the oldest beyond `max_entries`."""
+
+        now = time.time()
+        while self._sessions:
+            sid, (data, user_id, expires) = next(iter(self._sessions.items()))
+            if expires >= now and len(self._sessions) <= self.max_entries:
+                break
+            self._drop(sid)
+
+    def _drop(self, sid):
+        item = self._sessions.pop(sid, None)
+        if item is not None and item[1] is not None:
+            sids = self._by_user.get(item[1])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._by_user[item[1]]
+
+
+class RedisStore:
+    """Sessions shared by every process through Redis.
+
+    Each session is a key expiring with it; each user has a set of their
+    session ids, pruned lazily as sessions expire.
+    """
+
+    def __init__(self, url):
+        if redis is None:
+            raise RuntimeError("SESSION_STORE_URL needs the redis package.")
+
+        self.client = redis.Redis.from_url(url)
+
+    def load(self, sid):
+        pipe = self.client.pipeline()
+        pipe.get(f"session:{sid}")
+        pipe.ttl(f"session:{sid}")
+        data, ttl = pipe.execute()
+        if data is None:
+            return None
+
+        return data.decode('utf-8'), time.time() + max(ttl, 0)
+
+    def save(self, sid, data, user_id, ttl):
+        pipe = self.client.pipeline()
+        pipe.set(f"session:{sid}", data, ex=max(int(ttl), 1))
+        if user_id is not None:
+            pipe.sadd(f"user_sessions:{user_id}", sid)
+            pipe.expire(f"user_sessions:{user_id}", max(int(ttl), 1))
+        pipe.execute()
+
+    def touch(self, sid, ttl):
+        self.client.expire(f"session:{sid}", max(int(ttl), 1))
+
+    def delete(self, sid):
+        self.client.delete(f"session:{sid}")
+
+    def user_sessions(self, user_id):
+        sids = {sid.decode('utf-8') for sid
+                in self.client.smembers(f"user_sessions:{user_id}")}
+        live = {sid for sid in sids
+                if self.client.exists(f"session:{sid}")}
+        if sids - live:
+            self.client.srem(f"user_sessions:{user_id}", *(sids - live))
+
+        return live
+
+    def revoke_user(self, user_id, keep=None):
+        sids = self.user_sessions(user_id) - {keep}
+        if sids:
+            pipe = self.client.pipeline()
+            pipe.delete(*(f"session:{sid}" for sid in sids))
+            pipe.srem(f"user_sessions:{user_id}", *sids)
+            pipe.execute()
+
+        return len(sids)
+
+    def active_users(self):
+        return sum(1 for key in self.client.scan_iter("user_sessions:*")
+                   if self.client.scard(key))
+
+
+##############################################################################
+# Flask session interface
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data loaded from the store, with its id."""
+
+    def __init__(self, initial=None, sid=None, expires=None, new=False,
+                 in_cookie=False):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.new = new
+        self.in_cookie = in_cookie
+        self.modified = False
+        self.replaced_sid = None
+
+    def regenerate(self):
+        """Move the data to a fresh id, e.g. at login, so an id known
+        before it can't be used to ride the new session."""
+
+        if not self.new:
+            self.replaced_sid = self.sid
+        self.sid = new_sid()
+        self.modified = True
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface keeping session data in `store`.
+
+    `user_key` is the session key holding the logged-in user's id, by
+    which sessions are indexed for `revoke_user()`.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, user_key):
+        self.store = store
+        self.user_key = user_key
+
+    def _signer(self, app):
+        return URLSafeTimedSerializer(app.secret_key, salt='warbler-session',
+                                      serializer=self.serializer)
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+
+        # Session ids never contain a dot; signed data always does.
+        if sid and '.' in sid:
+            try:
+                data = self._signer(app).loads(
+                    sid, max_age=app.config['SESSION_IDLE_TIMEOUT'])
+            except BadData:
+                data = None
+            if isinstance(data, dict):
+                return ServerSession(data, new_sid(), new=True,
+                                     in_cookie=True)
+
+        elif sid:
+            loaded = self.store.load(sid)
+            if loaded is not None:
+                data, expires = loaded
+                return ServerSession(self.serializer.loads(data), sid,
+                                     expires)
+
+        return ServerSession(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.replaced_sid:
+            self.store.delete(session.replaced_sid)
+
+        if not session:
+            if not session.new:
+                self.store.delete(session.sid)
+            if not session.new or session.in_cookie:
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        ttl = app.config['SESSION_IDLE_TIMEOUT']
+        now = time.time()
+        value = session.sid
+
+        if set(session) <= COOKIE_KEYS:
+            if session.in_cookie and not session.modified:
+                return
+            if not session.new:
+                self.store.delete(session.sid)
+            value = self._signer(app).dumps(dict(session))
+        elif session.new or session.modified:
+            self.store.save(session.sid, self.serializer.dumps(dict(session)),
+                            session.get(self.user_key), ttl)
+        elif (session.expires - now
+              < ttl - app.config['SESSION_TOUCH_INTERVAL']):
+            self.store.touch(session.sid, ttl)
+        else:
+            return
+
+        response.set_cookie(
+            app.session_cookie_name, value,
+            expires=now + ttl,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=app.config.get('SESSION_COOKIE_SAMESITE'),
+        )
+
+
+def init_app(app, user_key):
+    """Keep `app`'s sessions server-side."""
+
+    app.config.setdefault('SESSION_STORE_URL', None)
+    app.config.setdefault('SESSION_IDLE_TIMEOUT', DEFAULT_IDLE_TIMEOUT)
+    app.config.setdefault('SESSION_TOUCH_INTERVAL', 60)
+    app.config.setdefault('SESSION_STORE_SIZE', DEFAULT_STORE_SIZE)
+
+    url = app.config['SESSION_STORE_URL']
+    store = (RedisStore(url) if url
+             else MemoryStore(app.config['SESSION_STORE_SIZE']))
+    app.session_interface = ServerSessionInterface(store, user_key)
+
+
+def _interface():
+    interface = current_app.session_interface
+    return interface if isinstance(interface, ServerSessionInterface) else None
+
+
+##############################################################################
+# Logged-in user
+
+
+def snapshot(user):
+    """The session's copy of `user`'s profile."""
+
+    return {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+
+
+class CurrentUser:
+    """The logged-in user, as `g.user`.
+
+    Snapshot fields are plain attributes. Anything else, such as
+    `likes` or `is_following()`, loads the `User` row on first use;
+    `record` is that row, for code that needs the model instance itself.
+    """
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+        self._record = None
+
+    @property
+    def record(self):
+        if self._record is None:
+            self._record = User.query.get(self.id)
+        return self._record
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.record, name)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+
+def current_user(user_key):
+    """`CurrentUser` for the session's user, or None if there's none.
+
+    Sessions without a snapshot of their user (e.g. from before the
+    snapshot existed) load the user once and keep one from then on.
+    """
+
+    user_id = session.get(user_key)
+    if user_id is None:
+        return None
+
+    data = session.get(SNAPSHOT_KEY)
+    if data is None or data['id'] != user_id:
+        user = User.query.get(user_id)
+        if user is None or user.deleted_at:
+            return None
+
+        session[SNAPSHOT_KEY] = data = snapshot(user)
+        current = CurrentUser(data)
+        current._record = user
+        return current
+
+    return CurrentUser(data)
+
+
+def refresh_user(user):
+    """Update the snapshot of `user` in all their sessions."""
+
+    data = snapshot(user)
+    if SNAPSHOT_KEY in session:
+        session[SNAPSHOT_KEY] = data
+
+    interface = _interface()
+    if interface is None:
+        return
+
+    sid = getattr(session, 'sid', None)
+    for other in interface.store.user_sessions(user.id) - {sid}:
+        loaded = interface.store.load(other)
+        if loaded is None:
+            continue
+
+        values, expires = loaded
+        values = interface.serializer.loads(values)
+        values[SNAPSHOT_KEY] = data
+        interface.store.save(other, interface.serializer.dumps(values),
+                             user.id, max(expires - time.time(), 1))
+
+
+def revoke_user(user_id, keep_current=False):
+    """End the sessions of `user_id`, e.g. after a password change or
+    account deletion; `keep_current` spares this request's session.
+    Returns how many were ended."""
+
+    interface = _interface()
+    if interface is None:
+        return 0
+
+    keep = getattr(session, 'sid', None) if keep_current else None
+    return interface.store.revoke_user(user_id, keep)
+
+
+def active_users():
+    """How many users have a live session, or None if unknown."""
+
+    interface = _interface()
+    return interface.store.active_users() if interface else None
+
+
+@click.command('revoke-sessions')
+@click.argument('user_id', type=int)
+@with_appcontext
+def revoke_sessions_command(user_id):
+    """Sign USER_ID out everywhere."""
+
+    click.echo(f"Ended {revoke_user(user_id)} session(s).")
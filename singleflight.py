@@ -0,0 +1,171 @@
+"""Request coalescing ("single-flight") and short-lived read caches.
+
+When many requests need the same thing at once, say the profile of an
+account that just went viral, only the first one runs the query; the
+others wait for it and share the result. `Group.do()` does this for any
+function, keyed by a string.
+
+`Cache` adds a short TTL on top, for reads that may be a few seconds
+stale. To avoid every request missing together when a hot entry
+expires, each read may refresh the entry a little early, with a
+probability that rises as expiry nears and with how slow the value is
+to compute (the "XFetch" rule). One request refreshes; the rest keep
+getting the cached value.
+
+Every group counts calls, executions and coalesced waits; `metrics()`
+returns the counts for all of them.
+"""
+
+import math
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# Every Group, by name, for metrics().
+_groups = {}
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class Group:
+    """Runs at most one call per key at a time; concurrent callers share
+    its result."""
+
+    def __init__(self, name):
+        self.name = name
+        self.stats = Counter()
+        self._calls = {}
+        self._lock = threading.Lock()
+        _groups[name] = self
+
+    def count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def do(self, key, func):
+        """Call `func()` for `key`, or wait for the call already running.
+
+        Returns `(value, shared)`: `shared` is True when the value came
+        from another caller's call. Exceptions are shared too.
+        """
+
+        with self._lock:
+            self.stats['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value = func()
+        except Exception as error:
+            call.error = error
+            self.count('errors')
+            raise
+        finally:
+            with self._lock:
+                self.stats['executions'] += 1
+                del self._calls[key]
+            call.done.set()
+
+        return call.value, False
+
+
+def should_refresh(expires, delta, beta=1.0, now=None):
+    """XFetch: refresh early, more likely near `expires` and the longer
+    the value took to compute (`delta` seconds)."""
+
+    now = time.time() if now is None else now
+    return now - delta * beta * math.log(1.0 - random.random()) >= expires
+
+
+class Cache:
+    """Bounded TTL cache whose misses and refreshes go through a Group."""
+
+    def __init__(self, name, ttl, max_entries=1000, beta=1.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.beta = beta
+        self.group = Group(name)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every delete; a load that started before one isn't
+        # stored, so an invalidation never loses to a slow load.
+        self._epoch = 0
+
+    def get(self, key, loader, ttl=None):
+        """Cached value for `key`, calling `loader()` to fill or refresh
+        it. `ttl` overrides the cache's own; 0 only coalesces."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if entry is not None:
+            value, expires, delta = entry
+            if not should_refresh(expires, delta, self.beta):
+                self.group.count('hits')
+                return value
+            if time.time() < expires:
+                self.group.count('early_refreshes')
+
+        ttl = self.ttl if ttl is None else ttl
+        value, shared = self.group.do(
+            key, lambda: self._load(key, loader, ttl))
+        return value
+
+    def _load(self, key, loader, ttl):
+        epoch = self._epoch
+        started = time.time()
+        value = loader()
+        finished = time.time()
+
+        with self._lock:
+            if epoch != self._epoch:
+                return value
+
+            if not ttl:
+                return value
+
+            self._entries[key] = (value, finished + ttl,
+                                  finished - started)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def delete(self, *keys):
+        with self._lock:
+            self._epoch += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def metrics():
+    """`{group name: {'calls', 'executions', 'coalesced', ...}}`."""
+
+    return {name: dict(group.stats) for name, group in _groups.items()}
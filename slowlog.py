@@ -0,0 +1,262 @@
+"""Slow-query log with captured query plans.
+
+Every statement the app's engines run is timed. One slower than
+SLOW_QUERY_MS is recorded with:
+
+- its normalized SQL (placeholders and literals as `?`, IN lists
+  collapsed to `?...`), so repeats of one query group together;
+- the shape of its bind parameters, e.g. `{"user_id": "int[40]"}`;
+- the Flask endpoint and path of the request that ran it, or the name
+  of the thread (a job worker, say) when there's no request;
+- its plan from `EXPLAIN` (Postgres) or `EXPLAIN QUERY PLAN` (SQLite).
+  The statement isn't run again: the plan is the planner's estimate.
+  One plan per normalized statement is captured every
+  SLOW_QUERY_EXPLAIN_INTERVAL seconds; entries in between reuse it.
+
+Entries go to a per-process ring buffer of the last SLOW_QUERY_LOG_SIZE,
+shown at `/admin/slow-queries` (see `admin`), and are also appended to
+SLOW_QUERY_LOG_PATH as JSON lines when that's set.
+
+Config:
+
+- SLOW_QUERY_MS: threshold in milliseconds; None turns the log off
+  (default 250).
+- SLOW_QUERY_LOG_SIZE: entries kept in memory (default 200).
+- SLOW_QUERY_LOG_PATH: JSONL file to append entries to (default None).
+- SLOW_QUERY_EXPLAIN: capture plans (default True).
+- SLOW_QUERY_EXPLAIN_INTERVAL: seconds a captured plan is reused
+  (default 300).
+"""
+
+import json
+import re
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_whitespace = re.compile(r'\s+')
+_placeholder = re.compile(
+    r"%\(\w+\)s|%s|(?<!:):\w+|\$\d+|\?|'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_in_list = re.compile(r'\?(?:\s*,\s*\?)+')
+_numbered = re.compile(r'_\d+$')
+
+EXPLAINABLE = ('select', 'with', 'insert', 'update', 'delete')
+
+# Distinct statements whose plans are remembered.
+PLANS_LIMIT = 1000
+
+
+def normalize(statement):
+    """`statement` with literals and placeholders as `?` and IN lists
+    collapsed, on one line."""
+
+    sql = _placeholder.sub('?', _whitespace.sub(' ', statement).strip())
+    return _in_list.sub('?...', sql)
+
+
+def _type_name(value):
+    return 'null' if value is None else type(value).__name__
+
+
+def bind_shape(parameters):
+    """Names and types of `parameters`, not their values.
+
+    Numbered names of an expanded IN list (`user_id_1`, `user_id_2`...)
+    fold into one entry, e.g. `"user_id": "int[40]"`.
+    """
+
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return {'rows': len(parameters),
+                    'each': bind_shape(parameters[0])}
+        return [_type_name(value) for value in parameters]
+
+    shape = {}
+    for name, value in sorted((parameters or {}).items()):
+        base = _numbered.sub('', name)
+        kind, count = _type_name(value), 1
+        if base in shape:
+            kind, _, seen = shape[base].partition('[')
+            count = int(seen.rstrip(']') or 1) + 1
+        shape[base] = kind if count == 1 else f"{kind}[{count}]"
+
+    return shape
+
+
+class SlowQueryLog:
+    """Ring buffer of this process's slow statements."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self._entries = deque(maxlen=200)
+        self._plans = {}
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_MS', 250)
+        app.config.setdefault('SLOW_QUERY_LOG_SIZE', 200)
+        app.config.setdefault('SLOW_QUERY_LOG_PATH', None)
+        app.config.setdefault('SLOW_QUERY_EXPLAIN', True)
+        app.config.setdefault('SLOW_QUERY_EXPLAIN_INTERVAL', 300)
+
+        self.app = app
+        self._entries = deque(maxlen=app.config['SLOW_QUERY_LOG_SIZE'])
+        app.extensions['slow_queries'] = self
+
+    def entries(self):
+        """Recorded entries, newest first."""
+
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def summary(self):
+        """Entries grouped by statement, the most total time first."""
+
+        groups = {}
+        for entry in self.entries():
+            group = groups.setdefault(entry['sql'], {
+                'sql': entry['sql'], 'count': 0, 'total_ms': 0.0,
+                'max_ms': 0.0, 'endpoints': set(), 'plan': entry['plan']})
+            group['count'] += 1
+            group['total_ms'] += entry['duration_ms']
+            group['max_ms'] = max(group['max_ms'], entry['duration_ms'])
+            group['endpoints'].add(entry['endpoint'] or entry['thread'])
+
+        return sorted(
+            (dict(group, total_ms=round(group['total_ms'], 1),
+                  endpoints=sorted(map(str, group['endpoints'])))
+             for group in groups.values()),
+            key=lambda group: group['total_ms'], reverse=True)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._plans.clear()
+
+    def record(self, conn, cursor, statement, parameters, duration,
+               executemany):
+        config = self.app.config
+        sql = normalize(statement)
+
+        plan = None
+        if config['SLOW_QUERY_EXPLAIN'] and not executemany:
+            plan = self._plan(conn.dialect.name, cursor, sql, statement,
+                              parameters)
+
+        entry = {
+            'at': datetime.utcnow().isoformat(),
+            'duration_ms': round(duration * 1000, 1),
+            'sql': sql,
+            'binds': bind_shape(parameters),
+            'endpoint': request.endpoint if has_request_context() else None,
+            'path': request.path if has_request_context() else None,
+            'thread': threading.current_thread().name,
+            'plan': plan,
+        }
+
+        with self._lock:
+            self._entries.append(entry)
+            path = config['SLOW_QUERY_LOG_PATH']
+            if path:
+                with open(path, 'a') as log:
+                    log.write(json.dumps(entry, default=str) + '\n')
+
+    def _plan(self, dialect, cursor, sql, statement, parameters):
+        """The plan of `statement`, captured at most once an interval
+        per normalized `sql`."""
+
+        if not sql.lower().startswith(EXPLAINABLE):
+            return None
+
+        now = time.monotonic()
+        with self._lock:
+            cached = self._plans.get(sql)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+
+        try:
+            plan = explain(dialect, cursor, statement, parameters)
+        except Exception as error:
+            plan = f"EXPLAIN failed: {error}"
+
+        with self._lock:
+            if len(self._plans) >= PLANS_LIMIT:
+                self._plans.clear()
+            self._plans[sql] = (
+                plan, now + self.app.config['SLOW_QUERY_EXPLAIN_INTERVAL'])
+
+        return plan
+
+
+def explain(dialect, cursor, statement, parameters):
+    """Plan of `statement`, from a fresh cursor on `cursor`'s connection.
+
+    Goes straight to the DB-API connection, so it isn't itself timed
+    or logged. On Postgres the EXPLAIN runs in a savepoint, so a failure
+    doesn't abort the transaction the statement belongs to.
+    """
+
+    plan_cursor = cursor.connection.cursor()
+
+    try:
+        if dialect == 'sqlite':
+            plan_cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            return '\n'.join(row[-1] for row in plan_cursor.fetchall())
+        if dialect != 'postgresql':
+            return None
+
+        plan_cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            plan_cursor.execute(f"EXPLAIN (ANALYZE off) {statement}",
+                                parameters)
+            plan = '\n'.join(row[0] for row in plan_cursor.fetchall())
+        except Exception:
+            plan_cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            raise
+        plan_cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+        return plan
+    finally:
+        plan_cursor.close()
+
+
+log = SlowQueryLog()
+
+
+def init_app(app):
+    log.init_app(app)
+
+
+##############################################################################
+# Engine hooks
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.slow_query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _check_time(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'slow_query_started', None)
+    if started is None or not has_app_context():
+        return
+
+    duration = time.perf_counter() - started
+
+    slow_queries = current_app.extensions.get('slow_queries')
+    threshold = current_app.config.get('SLOW_QUERY_MS')
+    if slow_queries is None or threshold is None \
+            or duration * 1000 < threshold:
+        return
+
+    slow_queries.record(conn, cursor, statement, parameters, duration,
+                        executemany)
@@ -0,0 +1,388 @@
+"""Real-time delivery of new messages as Server-Sent Events.
+
+Clients hold open `GET /api/v1/stream` on the ASGI app (see `asgi.py`)
+and get an event for each message posted by someone they follow, or by
+themselves, without reloading the home page:
+
+    id: 1234
+    event: message
+    data: {"id": 1234, "text": ..., "timestamp": ..., "user": {...}}
+
+Event ids are message ids, which only grow, so a client that reconnects
+with `Last-Event-ID` is sent what it missed from a replay buffer that
+keeps each author's last STREAM_REPLAY messages. When the buffer can't
+tell (the process started after the client's last event, or the author
+posted more than the buffer holds), the client gets a `reset` event
+instead and should reload its timeline, e.g. through
+`/api/v1/timeline/since/<cursor>`.
+
+The hub lives in memory. Posting publishes a job (`push_message`), and
+the job hands the message to the hub of the process it runs in, which
+passes it to that process's subscribers. When several processes serve
+streams, or jobs run in a separate `jobs-worker`, set
+STREAM_BROKER_URL: every process then publishes through Redis and
+delivers what it receives.
+
+Each connection has a queue of at most STREAM_QUEUE_SIZE events. A
+client that falls that far behind is disconnected rather than buffered
+without bound; it reconnects with its `Last-Event-ID` and catches up
+from the replay buffer.
+
+Clients that can't hold a connection open poll
+`/api/v1/timeline/since/<cursor>` instead. The hub also answers most of
+those polls: after a poll has read everything up to its cursor, the hub
+remembers the cursor, when it was read and whose messages the reader
+follows. A later poll with that cursor gets `204 No Content` without a
+database query unless one of those authors has posted since, the reader
+has followed someone, or STREAM_POLL_TTL has passed.
+
+Config:
+
+- STREAM_BROKER_URL: `redis://` URL of a pub/sub broker shared by all
+  processes (requires the `redis` package). Default: none, in-process.
+- STREAM_REPLAY: messages kept per author for reconnects (default 100).
+- STREAM_QUEUE_SIZE: events a connection may fall behind (default 100).
+- STREAM_HEARTBEAT: seconds between keep-alive comments (default 15).
+- STREAM_POLL_TTL: seconds a poll's "nothing new" answer is trusted
+  without querying (default 60). Bounds how late a poll may miss a
+  message whose event this process never saw.
+- STREAM_POLL_READERS: pollers remembered per process (default 10000).
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque, namedtuple
+
+import api
+import jobs
+import queries
+
+try:
+    import redis
+except ImportError:  # pragma: no cover - optional shared broker
+    redis = None
+
+REPLAY = 100
+QUEUE_SIZE = 100
+HEARTBEAT = 15
+POLL_TTL = 60
+POLL_READERS = 10000
+
+# What a lagging subscriber's queue is left holding: the end of its stream.
+OVERFLOW = object()
+
+Event = namedtuple('Event', 'id author_id data')
+
+# What a poller last read: up to `cursor`, at `read_at`, following
+# `authors`.
+Checkpoint = namedtuple('Checkpoint', 'cursor read_at authors')
+
+
+def encode(event):
+    """`event` in the SSE wire format."""
+
+    return f"id: {event.id}\nevent: message\ndata: {event.data}\n\n".encode()
+
+
+RESET = b"event: reset\ndata: {}\n\n"
+KEEPALIVE = b": keep-alive\n\n"
+
+
+##############################################################################
+# Subscribers
+
+
+class Subscriber:
+    """One open stream: the authors it follows and its event queue.
+
+    The hub offers events from any thread; they're queued on the
+    subscriber's event loop.
+    """
+
+    def __init__(self, user_id, authors, loop, maxsize=QUEUE_SIZE):
+        self.user_id = user_id
+        self.authors = set(authors)
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def offer(self, event):
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self.overflowed:
+            return
+
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(OVERFLOW)
+
+
+##############################################################################
+# Hub
+
+
+class RedisBroker:
+    """Pub/sub through Redis, so every process sees every event."""
+
+    CHANNEL = 'warbler:stream'
+
+    def __init__(self, url, deliver):
+        if redis is None:
+            raise RuntimeError("STREAM_BROKER_URL needs the redis package.")
+
+        self.client = redis.Redis.from_url(url)
+        self.deliver = deliver
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def publish(self, message):
+        self.client.publish(self.CHANNEL, json.dumps(message))
+
+    def listen(self):
+        """Start this process's listener thread if not running."""
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True,
+                             name='warbler-stream-broker').start()
+
+    def _run(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.CHANNEL)
+
+        for item in pubsub.listen():
+            self.deliver(json.loads(item['data']))
+
+
+class Hub:
+    """Routes new messages to the subscribers following their authors."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.broker = None
+        self.replay = REPLAY
+        self.poll_ttl = POLL_TTL
+        self.poll_readers = POLL_READERS
+        self._lock = threading.Lock()
+        self._reset_state()
+
+        if app is not None:
+            self.init_app(app)
+
+    def _reset_state(self):
+        self._subscribers = defaultdict(set)
+        self._by_user = defaultdict(set)
+        self._recent = {}
+        # Per author, the id of the newest event dropped from `_recent`.
+        self._evicted = {}
+        # Id of the first event seen: the hub knows nothing older.
+        self._horizon = None
+        # Per author, when their latest event arrived (monotonic clock).
+        self._posted_at = {}
+        self._checkpoints = OrderedDict()
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('STREAM_BROKER_URL', None)
+        app.config.setdefault('STREAM_REPLAY', REPLAY)
+        app.config.setdefault('STREAM_QUEUE_SIZE', QUEUE_SIZE)
+        app.config.setdefault('STREAM_HEARTBEAT', HEARTBEAT)
+        app.config.setdefault('STREAM_POLL_TTL', POLL_TTL)
+        app.config.setdefault('STREAM_POLL_READERS', POLL_READERS)
+
+        self.replay = app.config['STREAM_REPLAY']
+        self.poll_ttl = app.config['STREAM_POLL_TTL']
+        self.poll_readers = app.config['STREAM_POLL_READERS']
+        url = app.config['STREAM_BROKER_URL']
+        self.broker = RedisBroker(url, self._receive) if url else None
+
+    def clear(self):
+        """Forget subscribers and buffered events."""
+
+        with self._lock:
+            self._reset_state()
+
+    ##########################################################################
+    # Publishing
+
+    def publish(self, event):
+        """Deliver `event` to subscribers in every process."""
+
+        self._send(['message', list(event)])
+
+    def refollow(self, user_id, added=(), removed=()):
+        """Change which authors `user_id`'s open streams follow."""
+
+        self._send(['follow', user_id, list(added), list(removed)])
+
+    def _send(self, message):
+        if self.broker is not None:
+            self.broker.publish(message)
+        else:
+            self._receive(message)
+
+    def _receive(self, message):
+        if message[0] == 'message':
+            self._deliver(Event(*message[1]))
+        else:
+            self._refollow(*message[1:])
+
+    def _deliver(self, event):
+        with self._lock:
+            if self._horizon is None:
+                self._horizon = event.id
+            self._posted_at[event.author_id] = time.monotonic()
+
+            recent = self._recent.setdefault(event.author_id, deque())
+            recent.append(event)
+            if len(recent) > self.replay:
+                self._evicted[event.author_id] = recent.popleft().id
+
+            subscribers = list(self._subscribers.get(event.author_id, ()))
+
+        for subscriber in subscribers:
+            try:
+                subscriber.offer(event)
+            except RuntimeError:
+                # Its event loop is closed: the connection is gone
+                # without having unsubscribed.
+                self.unsubscribe(subscriber)
+
+    def _refollow(self, user_id, added, removed):
+        with self._lock:
+            if added:
+                self._checkpoints.pop(user_id, None)
+
+            for subscriber in self._by_user.get(user_id, ()):
+                for author_id in added:
+                    subscriber.authors.add(author_id)
+                    self._subscribers[author_id].add(subscriber)
+                for author_id in removed:
+                    if author_id != user_id:
+                        subscriber.authors.discard(author_id)
+                        self._subscribers[author_id].discard(subscriber)
+
+    ##########################################################################
+    # Subscribing
+
+    def subscribe(self, subscriber, last_event_id=None):
+        """Register `subscriber`; return (events to replay, complete).
+
+        The replay holds the buffered events of its authors newer than
+        `last_event_id`. `complete` is False when events the client
+        missed may no longer be buffered.
+        """
+
+        if self.broker is not None:
+            self.broker.listen()
+
+        with self._lock:
+            for author_id in subscriber.authors:
+                self._subscribers[author_id].add(subscriber)
+            self._by_user[subscriber.user_id].add(subscriber)
+
+            if last_event_id is None:
+                return [], True
+
+            complete = (self._horizon is not None
+                        and last_event_id >= self._horizon - 1)
+            replay = []
+            for author_id in subscriber.authors:
+                if self._evicted.get(author_id, 0) > last_event_id:
+                    complete = False
+                replay.extend(event for event in
+                              self._recent.get(author_id, ())
+                              if event.id > last_event_id)
+
+        return sorted(replay), complete
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            for author_id in subscriber.authors:
+                subscribers = self._subscribers.get(author_id)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+                    if not subscribers:
+                        del self._subscribers[author_id]
+
+            connections = self._by_user.get(subscriber.user_id)
+            if connections is not None:
+                connections.discard(subscriber)
+                if not connections:
+                    del self._by_user[subscriber.user_id]
+
+    ##########################################################################
+    # Polling
+
+    def checkpoint(self, user_id, cursor, read_at, authors):
+        """Remember that `user_id`, following `authors`, had read their
+        timeline up to `cursor` as of `read_at` (a `time.monotonic()`
+        taken before the read)."""
+
+        with self._lock:
+            self._checkpoints[user_id] = Checkpoint(
+                cursor, read_at, frozenset(authors))
+            self._checkpoints.move_to_end(user_id)
+            while len(self._checkpoints) > self.poll_readers:
+                self._checkpoints.popitem(last=False)
+
+    def nothing_since(self, user_id, cursor):
+        """Whether `user_id`'s timeline surely has nothing newer than
+        `cursor`, going by their checkpoint."""
+
+        with self._lock:
+            checkpoint = self._checkpoints.get(user_id)
+            if checkpoint is None or checkpoint.cursor != cursor:
+                return False
+
+            if time.monotonic() - checkpoint.read_at > self.poll_ttl:
+                return False
+
+            return not any(
+                self._posted_at.get(author_id, 0) >= checkpoint.read_at
+                for author_id in checkpoint.authors)
+
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(connections)
+                       for connections in self._by_user.values())
+
+
+hub = Hub()
+
+
+def init_app(app):
+    hub.init_app(app)
+
+
+##############################################################################
+# Job handlers
+
+
+@jobs.on('message_posted')
+def push_message(message_id, user_id):
+    rows = queries.messages_by_ids([message_id])
+    if rows:
+        hub.publish(Event(message_id, user_id,
+                          api.dumps(api.serialize_message(rows[0])).decode()))
+
+
+@jobs.on('follows_added')
+def follow_in_streams(user_id, followed_ids):
+    hub.refollow(user_id, added=followed_ids)
+
+
+@jobs.on('follows_removed')
+def unfollow_in_streams(user_id, followed_ids):
+    hub.refollow(user_id, removed=followed_ids)
@@ -0,0 +1,142 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_accounts.py
+
+
+from models import db, User, Message, Follows, Likes, MonthlyActivity
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import accounts
+    import activity
+    import graph
+    import jobs
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class AccountsTestCase(testsupport.DatabaseTestCase):
+    """Test tombstoning and purging deleted users."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        """Make the two users follow each other, with messages."""
+
+        super().setUp()
+        self.tu1_id = self.testuser.id
+        self.tu2_id = self.testuser2.id
+
+        Follows.follow_many(self.tu1_id, [self.tu2_id])
+        Follows.follow_many(self.tu2_id, [self.tu1_id])
+        db.session.add_all(
+            [Message(text=f"msg {i}", user_id=self.tu1_id) for i in range(5)])
+        db.session.add(Message(text="other", user_id=self.tu2_id))
+        db.session.commit()
+
+        other_msg = Message.query.filter_by(user_id=self.tu2_id).one()
+        db.session.add(Likes(user_id=self.tu1_id, message_id=other_msg.id))
+        db.session.commit()
+
+    def test_purge_in_chunks(self):
+        """Purge deletes everything a few rows at a time."""
+
+        self.assertEqual(accounts.remaining(self.tu1_id), {
+            'likes': 1, 'following': 1, 'followers': 1, 'messages': 5})
+
+        with app.app_context():
+            progress = list(accounts.purge(self.tu1_id, chunk_size=2))
+
+        self.assertEqual(progress[-1], {'step': 'done', 'deleted': {
+            'likes': 1, 'following': 1, 'followers': 1, 'messages': 5}})
+        # messages in chunks of 2: 2, 4, 5
+        self.assertEqual(
+            [p['deleted']['messages'] for p in progress
+             if p['step'] == 'messages'], [2, 4, 5])
+
+        self.assertIsNone(User.query.get(self.tu1_id))
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(Message.query.count(), 1)
+
+    def test_purge_undoes_likes_and_follows(self):
+        """Other users' rollups and follow counts lose the purged
+        user's likes and follows."""
+
+        built = graph.index
+        try:
+            with app.app_context():
+                activity.rebuild(self.tu2_id)
+                graph.index = graph.GraphIndex()
+                graph.index.rebuild()
+                self.assertEqual(graph.index.followers_count(self.tu2_id), 1)
+
+                list(accounts.purge(self.tu1_id))
+
+                self.assertEqual(graph.index.followers_count(self.tu2_id), 0)
+                self.assertEqual(graph.index.following_count(self.tu2_id), 0)
+        finally:
+            graph.index = built
+
+        rollup = MonthlyActivity.query.filter_by(user_id=self.tu2_id).one()
+        self.assertEqual(rollup.likes_received, 0)
+        self.assertEqual(rollup.messages_count, 1)
+
+    def test_tombstoned_user_hidden(self):
+        """A tombstoned user can't log in or be seen before the purge."""
+
+        app.config['JOBS_EAGER'] = False
+        app.config['JOBS_WORKERS'] = 0
+
+        try:
+            with app.app_context():
+                accounts.tombstone(User.query.get(self.tu1_id))
+
+            self.assertFalse(User.authenticate('testuser', 'testuser'))
+
+            with app.test_client() as c:
+                resp = c.get(f'/users/{self.tu1_id}')
+                self.assertEqual(resp.status_code, 404)
+
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.tu1_id
+
+                c.get('/')
+
+                with c.session_transaction() as sess:
+                    self.assertNotIn(CURR_USER_KEY, sess)
+
+        finally:
+            app.config.pop('JOBS_EAGER')
+            jobs.queue.stop()
+
+    def test_delete_user_view_purges(self):
+        """Deleting through the site purges the account."""
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.tu1_id
+
+            resp = c.post('/users/delete')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertIsNone(User.query.get(self.tu1_id))
+        self.assertEqual(Message.query.filter_by(user_id=self.tu1_id).count(),
+                         0)
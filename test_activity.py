@@ -0,0 +1,136 @@
+"""Monthly activity and archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_activity.py
+
+
+from datetime import date, datetime
+
+from models import db, Message, MonthlyActivity
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import activity
+    import jobs
+    import queries
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class ActivityTestCase(testsupport.DatabaseTestCase):
+    """Test the monthly rollups and archive pages."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        super().setUp()
+        self.tu1_id = self.testuser.id
+        self.tu2_id = self.testuser2.id
+
+        self.old_ids = []
+        with app.app_context():
+            for day in (3, 17):
+                msg = Message(text=f"March {day}", user_id=self.tu1_id,
+                              timestamp=datetime(2019, 3, day))
+                db.session.add(msg)
+                db.session.commit()
+                self.old_ids.append(msg.id)
+                jobs.publish('message_posted', message_id=msg.id,
+                             user_id=self.tu1_id)
+
+    def counts(self):
+        return {(row.month, row.messages_count, row.likes_received)
+                for row in MonthlyActivity.query.filter_by(
+                    user_id=self.tu1_id)}
+
+    def test_incremental(self):
+        """Posting, liking, unliking and deleting keep the rollup exact."""
+
+        this_month = activity.month_of(datetime.utcnow())
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.tu1_id
+            c.post('/messages/new', data={'text': "Now"})
+            new_id = Message.query.filter_by(text="Now").one().id
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.tu2_id
+            c.post(f'/users/add_like/{self.old_ids[0]}')
+            c.post(f'/users/add_like/{new_id}')
+            c.post(f'/users/add_like/{new_id}')
+
+        self.assertEqual(self.counts(), {
+            (date(2019, 3, 1), 2, 1),
+            (this_month, 1, 0),
+        })
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.tu1_id
+            c.post(f'/messages/{self.old_ids[0]}/delete')
+
+        self.assertEqual(self.counts(), {
+            (date(2019, 3, 1), 1, 0),
+            (this_month, 1, 0),
+        })
+
+        with app.app_context():
+            expected = self.counts()
+            activity.rebuild(self.tu1_id)
+            self.assertEqual(self.counts(), expected)
+
+    def test_archive_month(self):
+        with app.test_client() as c:
+            html = c.get(f'/users/{self.tu1_id}/archive/2019/3') \
+                .get_data(as_text=True)
+            empty = c.get(f'/users/{self.tu1_id}/archive/2019/4') \
+                .get_data(as_text=True)
+            invalid = c.get(f'/users/{self.tu1_id}/archive/2019/13')
+
+            index = c.get(f'/users/{self.tu1_id}/archive') \
+                .get_data(as_text=True)
+
+        self.assertIn('March 2019', html)
+        self.assertLess(html.index('March 17'), html.index('March 3'))
+        self.assertIn('No messages this month.', empty)
+        self.assertEqual(invalid.status_code, 404)
+        self.assertIn(f'/users/{self.tu1_id}/archive/2019/3', index)
+
+    def test_archive_pages(self):
+        with app.app_context():
+            start, end = activity.month_bounds(2019, 3)
+            first, cursor = queries.month_messages(
+                self.tu1_id, start, end, limit=1)
+            second, last = queries.month_messages(
+                self.tu1_id, start, end,
+                before=queries.decode_message_cursor(cursor),
+                limit=1)
+
+        self.assertEqual([row.text for row in first + second],
+                         ["March 17", "March 3"])
+        self.assertIsNone(last)
+
+    def test_month_bounds(self):
+        self.assertEqual(activity.month_bounds(2019, 12),
+                         (datetime(2019, 12, 1), datetime(2020, 1, 1)))
+        with self.assertRaises(ValueError):
+            activity.month_bounds(2019, 0)
@@ -0,0 +1,232 @@
+"""
+JSON API tests.
+
+# run these tests like:
+#
+#    python -m unittest test_api_views.py
+"""
+
+from models import db, Message, Follows, Likes
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+testsupport.use_test_database()
+
+# formatter was moving this so...
+if True:
+    import jobs
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class ApiViewsTestCase(testsupport.DatabaseTestCase):
+    """Test JSON API views."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        super().setUp()
+        self.client = app.test_client()
+
+        self.tu1_id = self.testuser.id
+        self.tu2_id = self.testuser2.id
+
+        db.session.add(Follows(user_being_followed_id=self.tu2_id,
+                               user_following_id=self.tu1_id))
+        for i in range(5):
+            db.session.add(Message(text=f"Message {i}", user_id=self.tu2_id))
+        db.session.commit()
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.tu1_id
+
+    def test_timeline_restricted(self):
+        """Timeline needs a logged in user."""
+
+        resp = self.client.get('/api/v1/timeline')
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.get_json()['error'], 'Access unauthorized.')
+
+    def test_timeline_keyset_pages(self):
+        """Timeline pages follow the `next` cursor without repeats."""
+
+        with self.client as c:
+            self.login(c)
+
+            first = c.get('/api/v1/timeline?limit=3').get_json()
+            second = c.get(
+                f"/api/v1/timeline?limit=3&before={first['next']}").get_json()
+
+        self.assertEqual(len(first['data']), 3)
+        self.assertEqual(len(second['data']), 2)
+        self.assertIsNone(second['next'])
+
+        ids = [m['id'] for m in first['data'] + second['data']]
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(first['data'][0]['user']['username'], 'testuser2')
+
+    def test_timeline_since(self):
+        """Polls return what's new once, then 204 until someone posts."""
+
+        with self.client as c:
+            self.login(c)
+
+            timeline = c.get('/api/v1/timeline').get_json()['data']
+            seen = c.get('/api/v1/timeline?limit=3').get_json()['next']
+
+            resp = c.get(f"/api/v1/timeline/since/{seen}")
+            new = resp.get_json()
+            self.assertEqual([m['id'] for m in new['data']],
+                             [m['id'] for m in timeline[1::-1]])
+            self.assertFalse(new['more'])
+
+            self.assertEqual(
+                c.get(f"/api/v1/timeline/since/{new['next']}").status_code,
+                204)
+
+            # Answered from the checkpoint: a message the hub hasn't
+            # heard of yet isn't looked for...
+            msg = Message(text="Late", user_id=self.tu2_id)
+            db.session.add(msg)
+            db.session.commit()
+            msg_id = msg.id
+            self.assertEqual(
+                c.get(f"/api/v1/timeline/since/{new['next']}").status_code,
+                204)
+
+            # ...until it's announced.
+            with app.app_context():
+                jobs.publish('message_posted', message_id=msg_id,
+                             user_id=self.tu2_id)
+            latest = c.get(f"/api/v1/timeline/since/{new['next']}")
+
+        self.assertEqual([m['id'] for m in latest.get_json()['data']],
+                         [msg_id])
+
+    def test_timeline_since_more(self):
+        """Long gaps come back in pages, oldest first."""
+
+        with self.client as c:
+            self.login(c)
+
+            timeline = c.get('/api/v1/timeline').get_json()['data']
+            seen = c.get('/api/v1/timeline?limit=4').get_json()['next']
+            first = c.get(f"/api/v1/timeline/since/{seen}?limit=2").get_json()
+            rest = c.get(
+                f"/api/v1/timeline/since/{first['next']}?limit=2").get_json()
+            bad = c.get('/api/v1/timeline/since/nonsense')
+
+        self.assertTrue(first['more'])
+        self.assertFalse(rest['more'])
+        self.assertEqual([m['id'] for m in first['data'] + rest['data']],
+                         [m['id'] for m in timeline[2::-1]])
+        self.assertEqual(bad.status_code, 400)
+
+    def test_bad_cursor(self):
+        """Malformed cursors are a 400, not a server error."""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.get('/api/v1/timeline?before=nonsense')
+
+        self.assertEqual(resp.status_code, 400)
+
+    def test_user_profile(self):
+        """Profile carries counts without needing a login."""
+
+        resp = self.client.get(f'/api/v1/users/{self.tu2_id}')
+        data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['username'], 'testuser2')
+        self.assertEqual(data['counts']['messages'], 5)
+        self.assertEqual(data['counts']['followers'], 1)
+        self.assertEqual(data['counts']['following'], 0)
+        self.assertNotIn('password', data)
+        self.assertNotIn('email', data)
+        self.assertEqual(len(data['messages']['data']), 5)
+
+    def test_user_profile_missing(self):
+        resp = self.client.get('/api/v1/users/999999')
+
+        self.assertEqual(resp.status_code, 404)
+
+    def test_followers_and_following(self):
+        with self.client as c:
+            self.login(c)
+
+            followers = c.get(
+                f'/api/v1/users/{self.tu2_id}/followers').get_json()
+            following = c.get(
+                f'/api/v1/users/{self.tu1_id}/following').get_json()
+
+        self.assertEqual([u['id'] for u in followers['data']], [self.tu1_id])
+        self.assertEqual([u['id'] for u in following['data']], [self.tu2_id])
+
+    def test_likes_and_message_detail(self):
+        msg = Message.query.filter_by(user_id=self.tu2_id).first()
+        msg_id, msg_text = msg.id, msg.text
+        db.session.add(Likes(user_id=self.tu1_id, message_id=msg_id))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c)
+            likes = c.get(f'/api/v1/users/{self.tu1_id}/likes').get_json()
+            detail = c.get(f'/api/v1/messages/{msg_id}').get_json()
+
+        self.assertEqual([m['id'] for m in likes['data']], [msg_id])
+        self.assertEqual(detail['text'], msg_text)
+        self.assertEqual(detail['user']['id'], self.tu2_id)
+
+    def test_bulk_follow(self):
+        """Bulk follow reports a result for every id."""
+
+        with self.client as c:
+            self.login(c)
+            resp = c.post('/api/v1/following', json={
+                'user_ids': [self.tu2_id, self.tu1_id, 999999]})
+
+        results = {r['id']: r['result'] for r in resp.get_json()['data']}
+        self.assertEqual(results, {
+            self.tu2_id: 'already_following',
+            self.tu1_id: 'self',
+            999999: 'not_found',
+        })
+
+    def test_bulk_unfollow_then_follow(self):
+        with self.client as c:
+            self.login(c)
+
+            resp = c.delete('/api/v1/following', json={
+                'user_ids': [self.tu2_id, self.tu2_id]})
+            self.assertEqual(resp.get_json()['data'], [
+                {'id': self.tu2_id, 'result': 'unfollowed'}])
+            self.assertEqual(Follows.query.count(), 0)
+
+            resp = c.post('/api/v1/following', json={
+                'user_ids': [self.tu2_id]})
+            self.assertEqual(resp.get_json()['data'], [
+                {'id': self.tu2_id, 'result': 'followed'}])
+            self.assertEqual(Follows.query.count(), 1)
+
+    def test_bulk_follow_bad_body(self):
+        with self.client as c:
+            self.login(c)
+            resp = c.post('/api/v1/following', json={'user_ids': ['x']})
+
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,307 @@
+"""
+ASGI entry point tests.
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+These drive the ASGI app directly with a stand-in connection pool, so
+they need neither asyncpg nor an ASGI server.
+"""
+
+import asyncio
+import json
+import threading
+from concurrent.futures import Executor, Future
+from datetime import datetime
+from unittest import TestCase
+
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+testsupport.use_test_database()
+
+# formatter was moving this so...
+if True:
+    import queries
+    import sessions
+    import writes
+    from app import app, CURR_USER_KEY
+    from asgi import AsyncWarbler, compile_query
+    from models import Follows
+
+app.config['TESTING'] = True
+
+
+class FakePool:
+    """Records statements and answers them with canned rows in order."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.statements = []
+
+    async def fetch(self, sql, *args):
+        self.statements.append((sql, args))
+        return self.results.pop(0) if self.results else []
+
+
+def message_row(msg_id, timestamp=datetime(2020, 1, 1), user_id=1):
+    return {'id': msg_id, 'text': f'msg {msg_id}', 'timestamp': timestamp,
+            'user_id': user_id, 'username': 'testuser',
+            'image_url': '/x.png'}
+
+
+class RecordingStore(sessions.MemoryStore):
+    """Memory store noting the threads sessions are loaded in."""
+
+    def __init__(self):
+        super().__init__()
+        self.threads = []
+
+    def load(self, sid):
+        self.threads.append(threading.current_thread())
+        return super().load(sid)
+
+
+class InlineExecutor(Executor):
+    """Runs "blocking" calls right away in the calling thread, so they
+    share the test's database connection."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+def send_request(asgi, path, query_string=b'', session=None):
+    """Run one GET through the ASGI app; return the messages sent."""
+
+    headers = []
+    if session is not None:
+        interface = app.session_interface
+        sid = sessions.new_sid()
+        interface.store.save(sid, interface.serializer.dumps(session),
+                             session[CURR_USER_KEY], ttl=60)
+        headers.append((b'cookie', f'session={sid}'.encode()))
+
+    scope = {'type': 'http', 'method': 'GET', 'path': path,
+             'query_string': query_string, 'headers': headers}
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request'}
+
+    async def send(message):
+        sent.append(message)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(asgi(scope, receive, send))
+    finally:
+        loop.close()
+
+    return sent
+
+
+class AsgiTestCase(TestCase):
+    """Test the async read routes."""
+
+    def setUp(self):
+        self.asgi = AsyncWarbler(app)
+
+    def call(self, path, query_string=b'', user_id=None):
+        """Run one GET through the ASGI app; return (status, json body)."""
+
+        sent = send_request(
+            self.asgi, path, query_string,
+            {CURR_USER_KEY: user_id} if user_id is not None else None)
+
+        return sent[0]['status'], json.loads(sent[1]['body'])
+
+    def test_compile_query(self):
+        """Shared builders compile to asyncpg's `$n` placeholders."""
+
+        with app.app_context():
+            sql, args = compile_query(
+                queries.timeline_query(7, (datetime(2020, 1, 1), 3)))
+
+        self.assertIn('$1', sql)
+        self.assertNotIn(':1', sql)
+        self.assertEqual(args[:2], [7, 7])
+
+    def test_timeline_restricted(self):
+        self.asgi.pool = FakePool()
+
+        status, body = self.call('/api/v1/timeline')
+
+        self.assertEqual(status, 401)
+        self.assertEqual(self.asgi.pool.statements, [])
+
+    def test_timeline_pages(self):
+        self.asgi.pool = FakePool([message_row(3), message_row(2),
+                                   message_row(1)])
+
+        status, body = self.call(
+            '/api/v1/timeline', b'limit=2', user_id=1)
+
+        self.assertEqual(status, 200)
+        self.assertEqual([m['id'] for m in body['data']], [3, 2])
+        self.assertEqual(queries.decode_message_cursor(body['next']),
+                         (datetime(2020, 1, 1), 2))
+
+        sql, args = self.asgi.pool.statements[0]
+        self.assertEqual(args[-1], 3)
+
+    def test_bad_cursor(self):
+        self.asgi.pool = FakePool()
+
+        status, body = self.call(
+            '/api/v1/timeline', b'before=nonsense', user_id=1)
+
+        self.assertEqual(status, 400)
+
+    def test_profile_runs_both_queries(self):
+        profile = {'id': 1, 'username': 'testuser', 'image_url': '/x.png',
+                   'header_image_url': '/y.jpg', 'bio': None,
+                   'location': None, 'messages_count': 1,
+                   'following_count': 0, 'followers_count': 0,
+                   'likes_count': 0}
+        self.asgi.pool = FakePool([profile], [message_row(1)])
+
+        status, body = self.call('/api/v1/users/1')
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body['counts']['messages'], 1)
+        self.assertEqual(len(body['messages']['data']), 1)
+        self.assertEqual(len(self.asgi.pool.statements), 2)
+
+    def test_message_missing(self):
+        self.asgi.pool = FakePool([])
+
+        status, body = self.call('/api/v1/messages/5')
+
+        self.assertEqual(status, 404)
+
+    def test_session_read_in_worker_thread(self):
+        """Reading the session store doesn't block the event loop."""
+
+        interface = app.session_interface
+        original, interface.store = interface.store, RecordingStore()
+        self.asgi.pool = FakePool([])
+        try:
+            status, body = self.call('/api/v1/timeline', user_id=1)
+        finally:
+            threads, interface.store = interface.store.threads, original
+
+        self.assertEqual(status, 200)
+        self.assertTrue(threads)
+        self.assertNotIn(threading.main_thread(), threads)
+
+
+class AsgiPageTestCase(testsupport.DatabaseTestCase):
+    """Test the async HTML pages."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        super().setUp()
+        self.asgi = AsyncWarbler(app, executor=InlineExecutor())
+        self.tu1_id = self.testuser.id
+        self.tu2_id = self.testuser2.id
+
+    def page(self, path, query_string=b'', logged_in=True):
+        """Run one page GET; return (status, body text)."""
+
+        session = None
+        if logged_in:
+            session = {CURR_USER_KEY: self.tu1_id,
+                       sessions.SNAPSHOT_KEY: sessions.snapshot(self.testuser)}
+
+        sent = send_request(self.asgi, path, query_string, session)
+
+        return sent[0]['status'], sent[1]['body'].decode()
+
+    def test_home_page(self):
+        """The page renders the pool's rows with the buffered likes."""
+
+        self.asgi.pool = FakePool(
+            [message_row(2, user_id=self.tu2_id),
+             message_row(1, user_id=self.tu2_id)],
+            [{'messages_count': 7, 'following_count': 1,
+              'followers_count': 0}],
+            [{'message_id': 1}])
+        writes.buffer.record(self.tu1_id, writes.LIKE, 2, True)
+
+        status, html = self.page('/')
+
+        self.assertEqual(status, 200)
+        self.assertIn('msg 2', html)
+        self.assertIn('>7</a', html)
+        self.assertEqual(html.count('btn-primary'), 2)
+        self.assertEqual(len(self.asgi.pool.statements), 3)
+
+    def test_profile_page(self):
+        profile = {'id': self.tu2_id, 'username': 'testuser2',
+                   'image_url': '/x.png', 'header_image_url': '/y.jpg',
+                   'bio': None, 'location': None, 'messages_count': 1,
+                   'following_count': 0, 'followers_count': 0,
+                   'likes_count': 0}
+        self.asgi.pool = FakePool(
+            [profile], [message_row(1, user_id=self.tu2_id)], [])
+        writes.buffer.record(self.tu1_id, writes.FOLLOW, self.tu2_id, True)
+
+        status, html = self.page(f'/users/{self.tu2_id}')
+
+        self.assertEqual(status, 200)
+        self.assertIn('msg 1', html)
+        self.assertIn(f'/users/stop-following/{self.tu2_id}', html)
+
+    def test_message_page(self):
+        self.asgi.pool = FakePool(
+            [message_row(5, user_id=self.tu2_id)],
+            [{'user_being_followed_id': self.tu2_id}])
+
+        status, html = self.page('/messages/5')
+
+        self.assertEqual(status, 200)
+        self.assertIn('msg 5', html)
+        self.assertIn(f'/users/stop-following/{self.tu2_id}', html)
+
+    def test_followers_settle_buffered_follow(self):
+        """The viewer's buffered follow is written before the list."""
+
+        profile = {'id': self.tu2_id, 'username': 'testuser2',
+                   'image_url': '/x.png', 'header_image_url': '/y.jpg',
+                   'bio': None, 'location': None, 'messages_count': 0,
+                   'following_count': 0, 'followers_count': 1,
+                   'likes_count': 0}
+        self.asgi.pool = FakePool(
+            [profile],
+            [{'id': self.tu1_id, 'username': 'testuser',
+              'image_url': '/x.png', 'bio': None}],
+            [])
+        writes.buffer.record(self.tu1_id, writes.FOLLOW, self.tu2_id, True)
+
+        status, html = self.page(f'/users/{self.tu2_id}/followers')
+
+        self.assertEqual(status, 200)
+        self.assertFalse(writes.buffer.has_writes(self.tu1_id))
+        self.assertEqual(Follows.followed_among(self.tu1_id, [self.tu2_id]),
+                         {self.tu2_id})
+
+    def test_anonymous_and_missing_pages_fall_back(self):
+        """The Flask app answers these; the fallback here is a 404."""
+
+        self.asgi.pool = FakePool([])
+
+        self.assertEqual(self.page('/', logged_in=False)[0], 404)
+        self.assertEqual(self.asgi.pool.statements, [])
+
+        self.assertEqual(self.page('/messages/5')[0], 404)
+        self.assertEqual(len(self.asgi.pool.statements), 1)
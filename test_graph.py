@@ -0,0 +1,226 @@
+"""Follow graph index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_graph.py
+
+
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from models import db, User, Follows
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import graph
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class CSRTestCase(TestCase):
+    """Test the packed adjacency arrays."""
+
+    def test_neighbors(self):
+        csr = graph.CSR.from_edges([(1, 2), (1, 3), (4, 1)])
+
+        self.assertEqual(list(csr.neighbors(1)), [2, 3])
+        self.assertEqual(list(csr.neighbors(4)), [1])
+        self.assertEqual(list(csr.neighbors(2)), [])
+        self.assertEqual(list(csr.neighbors(99)), [])
+        self.assertEqual(dict(csr.degrees()), {1: 2, 4: 1})
+        self.assertEqual(len(csr), 3)
+
+
+class GraphIndexTestCase(testsupport.DatabaseTestCase):
+    """Test follow queries answered from the index."""
+
+    def setUp(self):
+        """a follows b, c and d; b follows a and d; c follows a."""
+
+        super().setUp()
+        users = [User(username=name, email=f"{name}@test.com", password="x")
+                 for name in 'abcde']
+        db.session.add_all(users)
+        db.session.commit()
+        self.ids = {user.username: user.id for user in users}
+
+        for follower, followed in ('ab', 'ac', 'ad', 'ba', 'bd', 'ca'):
+            Follows.follow_many(self.ids[follower], [self.ids[followed]])
+        db.session.commit()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.ctx = app.app_context()
+        self.ctx.push()
+        app.config['GRAPH_CHECK_INTERVAL'] = 0
+
+    def tearDown(self):
+        self.ctx.pop()
+        app.config.pop('GRAPH_CHECK_INTERVAL')
+        app.config['GRAPH_SNAPSHOT_PATH'] = None
+        graph.index = graph.GraphIndex()
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def id_list(self, names):
+        return sorted(self.ids[name] for name in names)
+
+    def test_queries(self):
+        index = graph.GraphIndex()
+        index.rebuild()
+        a, b, d = self.ids['a'], self.ids['b'], self.ids['d']
+
+        self.assertTrue(index.is_following(a, b))
+        self.assertFalse(index.is_following(d, a))
+        self.assertEqual(index.following_count(a), 3)
+        self.assertEqual(index.followers_count(d), 2)
+        self.assertEqual(index.following_ids(b), set(self.id_list('ad')))
+        self.assertEqual(index.follower_ids(a), set(self.id_list('bc')))
+        self.assertEqual(index.mutuals(a), self.id_list('bc'))
+        self.assertEqual(index.common_following(a, b), self.id_list('d'))
+        self.assertEqual(index.following_among(a, [b, d, a]), {b, d})
+
+        first = index.following_page(a, limit=2)
+        self.assertEqual(first, self.id_list('bcd')[:2])
+        self.assertEqual(index.following_page(a, after=first[-1], limit=2),
+                         self.id_list('bcd')[2:])
+
+    def test_deltas(self):
+        """Follows and unfollows show up without a rebuild."""
+
+        index = graph.GraphIndex()
+        index.rebuild()
+        a, c, e = self.ids['a'], self.ids['c'], self.ids['e']
+
+        index.record(graph.FOLLOW, a, [e])
+        index.record(graph.UNFOLLOW, a, [c])
+
+        self.assertTrue(index.is_following(a, e))
+        self.assertFalse(index.is_following(a, c))
+        self.assertEqual(index.following_count(a), 3)
+        self.assertEqual(index.followers_count(e), 1)
+        self.assertEqual(index.following_page(a), self.id_list('bde'))
+        self.assertEqual(index.mutuals(a), self.id_list('b'))
+
+    def test_rebuild_in_background(self):
+        """An old index is rebuilt without holding up its readers."""
+
+        index = graph.GraphIndex()
+        index.rebuild()
+        a, b = self.ids['a'], self.ids['b']
+
+        started, finish = threading.Event(), threading.Event()
+        rebuilds = []
+
+        def slow_rebuild():
+            rebuilds.append(1)
+            started.set()
+            finish.wait(5)
+
+        index.rebuild = slow_rebuild
+        app.config['GRAPH_BACKGROUND'] = True
+        app.config['GRAPH_MAX_AGE'] = 0
+        try:
+            index.refresh()
+            self.assertTrue(started.wait(5))
+
+            # Answered from the old arrays while the rebuild runs, and
+            # without starting another.
+            self.assertTrue(index.is_following(a, b))
+            self.assertEqual(rebuilds, [1])
+        finally:
+            finish.set()
+            with index._rebuilding:
+                pass
+            app.config.pop('GRAPH_BACKGROUND')
+            app.config.pop('GRAPH_MAX_AGE')
+
+    def test_shared_snapshot(self):
+        """Processes share the snapshot file and each other's deltas."""
+
+        app.config['GRAPH_SNAPSHOT_PATH'] = os.path.join(self.tmp.name, 'g')
+        a, c, e = self.ids['a'], self.ids['c'], self.ids['e']
+
+        writer = graph.GraphIndex()
+        reader = graph.GraphIndex()
+
+        writer.refresh()
+        self.assertTrue(os.path.exists(app.config['GRAPH_SNAPSHOT_PATH']))
+        reader.refresh()
+        self.assertIsInstance(reader.following.targets, memoryview)
+        self.assertEqual(reader.following_count(a), 3)
+
+        writer.record(graph.FOLLOW, a, [e])
+        writer.record(graph.UNFOLLOW, a, [c])
+
+        self.assertEqual(reader.following_page(a), self.id_list('bde'))
+        self.assertEqual(writer.following_page(a), self.id_list('bde'))
+
+        # A rebuild elsewhere starts a new log; the reader follows it.
+        Follows.follow_many(e, [a])
+        db.session.commit()
+        writer.rebuild()
+        writer.record(graph.UNFOLLOW, a, [e])
+
+        self.assertTrue(reader.is_following(e, a))
+        self.assertFalse(reader.is_following(a, e))
+
+    def test_follow_view_updates_index(self):
+        app.config['GRAPH_INDEX'] = True
+        graph.index.rebuild()
+
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.ids['d']
+
+                client.post(f"/users/follow/{self.ids['e']}")
+                resp = client.get(f"/api/v1/users/{self.ids['a']}"
+                                  "/relationship")
+        finally:
+            app.config['GRAPH_INDEX'] = False
+
+        self.assertTrue(graph.index.is_following(self.ids['d'],
+                                                 self.ids['e']))
+        self.assertEqual(resp.get_json(), {
+            'following': False,
+            'followed_by': True,
+            'followers_count': 2,
+            'following_count': 3,
+            'common_following_count': 0,
+            'common_following': [],
+        })
+
+    def test_relationship_without_index(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids['b']
+
+            resp = client.get(f"/api/v1/users/{self.ids['a']}"
+                              "/relationship")
+
+        self.assertEqual(resp.get_json(), {
+            'following': True,
+            'followed_by': True,
+            'followers_count': 2,
+            'following_count': 3,
+            'common_following_count': 1,
+            'common_following': self.id_list('d'),
+        })
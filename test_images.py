@@ -0,0 +1,199 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import base64
+import io
+import os
+import shutil
+import tempfile
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import skipIf
+
+from models import db
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import images
+    from app import app
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = True
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+# A 1x1 transparent PNG.
+PIXEL = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk"
+    "YPhfDwAChwGA60e6kgAAAABJRU5ErkJggg==")
+
+
+class Origin(BaseHTTPRequestHandler):
+    """Stand-in image host: `/pixel.png`, `/page.html`, 404 otherwise."""
+
+    hits = []
+
+    def do_GET(self):
+        Origin.hits.append(self.path)
+
+        if self.path == '/pixel.png':
+            body, content_type = PIXEL, 'image/png'
+        elif self.path == '/page.html':
+            body, content_type = b'<html></html>', 'text/html'
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(testsupport.DatabaseTestCase):
+    """Test fetching, resizing and caching thumbnails."""
+
+    seed_users = ('testuser',)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), Origin)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.origin = f"http://127.0.0.1:{cls.server.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        Origin.hits.clear()
+        self.cache_dir = tempfile.mkdtemp()
+        app.extensions['images'] = images.ThumbnailCache(
+            self.cache_dir, max_bytes=1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        super().tearDown()
+
+    def proxy_url(self, path, size='avatar'):
+        with app.test_request_context():
+            return images.thumbnail_url(self.origin + path, size)
+
+    @skipIf(images.Image is None, "needs Pillow")
+    def test_fetches_once(self):
+        url = self.proxy_url('/pixel.png')
+
+        with app.test_client() as c:
+            first = c.get(url)
+            second = c.get(url)
+            revalidated = c.get(url, headers={
+                'If-None-Match': first.headers['ETag']})
+
+        self.assertEqual(Origin.hits, ['/pixel.png'])
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertIn('max-age=31536000', first.headers['Cache-Control'])
+        self.assertEqual(revalidated.status_code, 304)
+
+    @skipIf(images.Image is None, "needs Pillow")
+    def test_resizes(self):
+        with app.test_client() as c:
+            resp = c.get(self.proxy_url('/pixel.png', 'header'))
+
+        thumb = images.Image.open(io.BytesIO(resp.get_data()))
+        self.assertEqual(resp.mimetype, 'image/jpeg')
+        self.assertEqual(thumb.size, images.SIZES['header'])
+
+    def test_bad_originals_fall_back(self):
+        with app.test_client() as c:
+            missing = c.get(self.proxy_url('/gone.png'))
+            html = c.get(self.proxy_url('/page.html', 'header'))
+            forged = c.get('/img/avatar/not-a-token')
+
+        self.assertEqual(missing.status_code, 302)
+        self.assertTrue(missing.location.endswith(images.FALLBACKS['avatar']))
+        self.assertTrue(html.location.endswith(images.FALLBACKS['header']))
+        self.assertEqual(forged.status_code, 404)
+
+    def test_private_origins_refused(self):
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+        try:
+            with app.test_client() as c:
+                resp = c.get(self.proxy_url('/pixel.png'))
+        finally:
+            app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = True
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(Origin.hits, [])
+
+    def test_redirects_and_connections_checked(self):
+        app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = False
+        req = urllib.request.Request('http://example.com/a.png')
+        try:
+            with app.app_context():
+                with self.assertRaises(images.ImageError):
+                    images._CheckedRedirectHandler().redirect_request(
+                        req, None, 302, 'Found', {},
+                        'http://169.254.169.254/latest/meta-data')
+
+                # Whatever was checked before, the connection itself
+                # refuses a private address.
+                with self.assertRaises(images.ImageError):
+                    images._PublicHTTPConnection(
+                        '127.0.0.1', self.server.server_port).connect()
+        finally:
+            app.config['IMAGE_PROXY_ALLOW_PRIVATE'] = True
+
+        self.assertEqual(Origin.hits, [])
+
+    def test_lru_eviction(self):
+        cache = images.ThumbnailCache(self.cache_dir, max_bytes=10)
+
+        old = cache.put('http://a/1', 'avatar', b'123456', '.png')
+        os.utime(old, (0, 0))
+        cache.put('http://a/2', 'avatar', b'abcdef', '.png')
+
+        self.assertIsNone(cache.get('http://a/1', 'avatar'))
+        self.assertIsNotNone(cache.get('http://a/2', 'avatar'))
+
+        # Identical content is stored once.
+        shared = cache.put('http://a/3', 'avatar', b'abcdef', '.png')
+        self.assertEqual(shared, cache.get('http://a/2', 'avatar'))
+
+    def test_templates_use_thumbnails(self):
+        self.testuser.image_url = self.origin + '/pixel.png'
+        db.session.commit()
+        user_id = self.testuser.id
+
+        with app.test_client() as c:
+            html = c.get(f'/users/{user_id}').get_data(as_text=True)
+
+        self.assertIn('/img/avatar/', html)
+        self.assertNotIn(self.origin, html)
+        self.assertIn('/static/images/warbler-hero.jpg', html)
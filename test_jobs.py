@@ -0,0 +1,196 @@
+"""
+Background job tests.
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+"""
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Message, Job
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+testsupport.use_test_database()
+
+# formatter was moving this so...
+if True:
+    import jobs
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+calls = []
+
+
+@jobs.on('test_event')
+def record_call(value):
+    calls.append(value)
+
+
+@jobs.on('test_flaky')
+def flaky(fail_times):
+    calls.append('try')
+    if len(calls) <= fail_times:
+        raise RuntimeError("flaky")
+
+
+@jobs.on('message_posted')
+def record_message(message_id, user_id):
+    calls.append(('posted', message_id, user_id))
+
+
+class JobsTestCase(testsupport.DatabaseTestCase):
+    """Test publishing and running background jobs."""
+
+    seed_users = ('testuser',)
+
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+        app.config['JOBS_WORKERS'] = 0
+        app.config['JOBS_BACKOFF'] = 0
+        app.config['JOBS_MAX_ATTEMPTS'] = 3
+
+    def tearDown(self):
+        jobs.queue.stop()
+        app.config.pop('JOBS_EAGER', None)
+        super().tearDown()
+
+    def test_eager_in_testing(self):
+        """Tests run jobs inline, once per idempotency key."""
+
+        jobs.publish('test_event', key='once', value=1)
+        jobs.publish('test_event', key='once', value=2)
+        jobs.publish('test_event', value=3)
+
+        self.assertEqual(calls, [1, 3])
+
+    def test_memory_queue_retries(self):
+        """Failing jobs are retried until they pass."""
+
+        app.config['JOBS_EAGER'] = False
+
+        with app.app_context():
+            jobs.publish('test_flaky', fail_times=2)
+            ran = jobs.queue.run_pending()
+
+        self.assertEqual(calls, ['try', 'try', 'try'])
+        self.assertEqual(ran, 3)
+
+    def test_memory_queue_gives_up(self):
+        app.config['JOBS_EAGER'] = False
+
+        with app.app_context():
+            jobs.publish('test_flaky', fail_times=10)
+            jobs.queue.run_pending()
+
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(len(jobs.queue.backend), 0)
+
+    def test_message_posted_event(self):
+        """Posting a message publishes `message_posted`."""
+
+        user_id = self.testuser.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post("/messages/new", data={"text": "Hello"})
+
+        msg = Message.query.one()
+        self.assertEqual(calls, [('posted', msg.id, user_id)])
+
+
+class PersistentJobsTestCase(TestCase):
+    """Test the jobs table backend.
+
+    Jobs are inserted on a connection of their own (see
+    `jobs.DatabaseBackend.push`), outside any test transaction, so these
+    tests commit for real and delete the jobs afterwards.
+    """
+
+    def setUp(self):
+        calls.clear()
+        testsupport.reset_state(app)
+        app.config['JOBS_WORKERS'] = 0
+        app.config['JOBS_BACKOFF'] = 0
+        app.config['JOBS_MAX_ATTEMPTS'] = 3
+        app.config['JOBS_EAGER'] = False
+        app.config['JOBS_PERSISTENT'] = True
+
+    def tearDown(self):
+        db.session.rollback()
+        Job.query.delete()
+        db.session.commit()
+
+        jobs.queue.stop()
+        app.config.pop('JOBS_EAGER')
+        app.config['JOBS_PERSISTENT'] = False
+
+    def test_persistent_queue(self):
+        """Persistent jobs are stored once per key and marked done."""
+
+        with app.app_context():
+            jobs.publish('test_event', key='k', value=1)
+            jobs.publish('test_event', key='k', value=1)
+
+            self.assertEqual(Job.query.count(), 1)
+
+            jobs.queue.run_pending()
+            job = Job.query.one()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(job.attempts, 1)
+
+    def test_persistent_retry_records_error(self):
+        app.config['JOBS_BACKOFF'] = 3600
+
+        with app.app_context():
+            jobs.publish('test_flaky', fail_times=5)
+            jobs.queue.run_pending()
+            job = Job.query.one()
+
+        self.assertEqual(job.status, 'pending')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('flaky', job.last_error)
+
+    def test_abandoned_job_reclaimed(self):
+        """A job left running by a dead worker runs again once its lease
+        is over, and the lost run counts as an attempt."""
+
+        expired = datetime.utcnow() - timedelta(seconds=1)
+        db.session.add_all([
+            Job(name=jobs.task_name(record_call), payload='{"value": 1}',
+                status='running', attempts=0, run_at=expired),
+            Job(name=jobs.task_name(record_call), payload='{"value": 2}',
+                status='running', attempts=2, run_at=expired),
+            Job(name=jobs.task_name(record_call), payload='{"value": 3}',
+                status='running', attempts=0,
+                run_at=expired + timedelta(hours=1)),
+        ])
+        db.session.commit()
+
+        with app.app_context():
+            jobs.queue.run_pending()
+            statuses = [(job.status, job.attempts)
+                        for job in Job.query.order_by(Job.id)]
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(statuses, [('done', 2), ('failed', 3),
+                                    ('running', 0)])
@@ -5,18 +5,17 @@
 #    python -m unittest test_message_model.py
 
 
-import os
-from unittest import TestCase
 from datetime import datetime
 
-from models import db, User, Message
+from models import db, Message
+import testsupport
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+testsupport.use_test_database()
 
 # Now we can import app
 if True:
@@ -27,24 +26,20 @@ app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 # Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-db.drop_all()
-db.create_all()
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
 
 
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(testsupport.DatabaseTestCase):
     """Test views for messages."""
 
+    seed_users = ('testuser',)
+
     def setUp(self):
         """Create test client, add sample data."""
 
-        self.testuser = User.signup(username="testuser",
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None)
-        db.session.commit()
-
+        super().setUp()
         self.message = Message(user_id=self.testuser.id,
                                text="Distant horizon.")
         db.session.add(self.message)
@@ -52,11 +47,6 @@ class MessageModelTestCase(TestCase):
 
         self.client = app.test_client()
 
-    def tearDown(self):
-        db.session.rollback()
-        User.query.delete()
-        Message.query.delete()
-
     def test_user_model(self):
         """Does basic model work?"""
 
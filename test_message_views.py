@@ -6,16 +6,15 @@ Message View tests.
 #    python -m unittest test_message_views.py
 """
 
-import os
-from unittest import TestCase
 
 from models import db, Message, User
+import testsupport
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+testsupport.use_test_database()
 
 # formatter was moving this so...
 if True:
@@ -26,29 +25,25 @@ app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 # Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-db.drop_all()
-db.create_all()
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
 
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(testsupport.DatabaseTestCase):
     """Test views for messages."""
 
+    seed_users = ('testuser',)
+
     def setUp(self):
         """Create test client, add sample data."""
 
+        super().setUp()
         self.client = app.test_client()
 
-        self.testuser = User.signup(username="testuser",
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None)
-        db.session.commit()
-
         self.new_message = Message(
             text="Hello I am a message.", user_id=self.testuser.id)
 
@@ -57,13 +52,6 @@ class MessageViewTestCase(TestCase):
 
         self.new_message_id = self.new_message.id
 
-    def tearDown(self):
-        """Clean up any fouled transaction."""
-
-        db.session.rollback()
-        User.query.delete()
-        Message.query.delete()
-
     def test_add_message(self):
         """Can user add a message?"""
 
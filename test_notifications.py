@@ -0,0 +1,149 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+from datetime import datetime
+
+from models import db, User, Message, Notification
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import jobs
+    import notifications
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class NotificationTestCase(testsupport.DatabaseTestCase):
+    """Test rolling up, counting and showing notifications."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        super().setUp()
+        testsupport.reset_state(app)
+
+        self.fans = [User(username=f"fan{n}", email=f"fan{n}@test.com",
+                          password="x") for n in range(3)]
+        self.message = Message(text="Going viral", user_id=self.testuser.id)
+        db.session.add_all(self.fans + [self.message])
+        db.session.commit()
+
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        super().tearDown()
+
+    def like(self, user, event='like_added'):
+        jobs.publish(event, user_id=user.id, message_id=self.message.id,
+                     author_id=self.testuser.id)
+
+    def test_bucket_of(self):
+        self.assertEqual(
+            notifications.bucket_of(datetime(2020, 5, 4, 13, 37, 12), 3600),
+            datetime(2020, 5, 4, 13))
+
+    def test_likes_roll_up(self):
+        for user in self.fans + [self.testuser]:
+            self.like(user)
+        self.like(self.fans[1], 'like_removed')
+
+        self.assertEqual(len(notifications.buffer), 1)
+        self.assertEqual(notifications.buffer.flush(), 1)
+
+        row = Notification.query.one()
+        self.assertEqual((row.user_id, row.kind, row.subject_id, row.count),
+                         (self.testuser.id, 'like', self.message.id, 2))
+        self.assertEqual(row.actor_id, self.fans[2].id)
+
+        # Later likes in the bucket add to the same row.
+        self.like(self.fans[1])
+        notifications.buffer.flush()
+        self.assertEqual(Notification.query.one().count, 3)
+
+    def test_unread_count(self):
+        unread = notifications.unread
+        self.assertEqual(unread.get(self.testuser.id), 0)
+
+        self.like(self.fans[0])
+        jobs.publish('follows_added', user_id=self.fans[0].id,
+                     followed_ids=[self.testuser.id, self.testuser2.id])
+        notifications.buffer.flush()
+
+        # Kept current by the flush, without recounting.
+        self.assertEqual(unread._counts[self.testuser.id][0], 2)
+        self.assertEqual(unread.get(self.testuser.id), 2)
+        self.assertEqual(unread.get(self.testuser2.id), 1)
+
+        # A row that's already unread isn't counted twice.
+        self.like(self.fans[1])
+        notifications.buffer.flush()
+        self.assertEqual(unread.get(self.testuser.id), 2)
+
+        notifications.mark_read(self.testuser.id)
+        self.assertEqual(unread.get(self.testuser.id), 0)
+        unread.clear()
+        self.assertEqual(unread.get(self.testuser.id), 0)
+
+    def test_deleted_message(self):
+        self.like(self.fans[0])
+        notifications.buffer.flush()
+
+        jobs.publish('message_deleted', message_id=self.message.id,
+                     user_id=self.testuser.id)
+
+        self.assertEqual(Notification.query.count(), 0)
+
+    def test_pages(self):
+        for user in self.fans[:2]:
+            self.like(user)
+        jobs.publish('follows_added', user_id=self.fans[2].id,
+                     followed_ids=[self.testuser.id])
+        notifications.buffer.flush()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            api = c.get('/api/v1/notifications?limit=1').get_json()
+            home = c.get('/').get_data(as_text=True)
+            page = c.get('/notifications').get_data(as_text=True)
+            after = c.get('/api/v1/notifications').get_json()
+
+        self.assertEqual(api['unread'], 2)
+        self.assertEqual(api['data'][0]['kind'], 'follow')
+        self.assertEqual(api['data'][0]['actor']['username'], 'fan2')
+        self.assertIsNotNone(api['next'])
+
+        self.assertIn('<span class="badge badge-primary">2</span>', home)
+        self.assertIn('@fan1', page)
+        self.assertIn('and 1 other', page)
+        self.assertIn('liked your warble', page)
+        self.assertIn('Going viral', page)
+        self.assertIn('followed you', page)
+
+        self.assertEqual(after['unread'], 0)
+        self.assertEqual([note['unread'] for note in after['data']],
+                         [False, False])
+        self.assertEqual(after['data'][1]['subject']['text'], 'Going viral')
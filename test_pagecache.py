@@ -0,0 +1,179 @@
+"""Anonymous page cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pagecache.py
+
+
+import threading
+import time
+from unittest import TestCase
+
+from flask import Flask
+
+from models import Message
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    from app import app, CURR_USER_KEY
+    from pagecache import MemoryBackend, PageCache, page_cache
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class MemoryBackendTestCase(TestCase):
+    """Test the in-process LRU."""
+
+    def test_lru_and_ttl(self):
+        backend = MemoryBackend(max_entries=2)
+
+        backend.set('a', 1, ttl=60)
+        backend.set('b', 2, ttl=60)
+        backend.get('a')
+        backend.set('c', 3, ttl=60)
+
+        self.assertEqual(backend.get('a'), 1)
+        self.assertIsNone(backend.get('b'))
+
+        backend.set('d', 4, ttl=-1)
+        self.assertIsNone(backend.get('d'))
+
+
+class InitAppTestCase(TestCase):
+    """Test the checks made when the cache is set up."""
+
+    def test_persistent_jobs_need_shared_cache(self):
+        flask_app = Flask(__name__)
+        flask_app.config['JOBS_PERSISTENT'] = True
+
+        with self.assertRaises(RuntimeError):
+            PageCache(flask_app)
+
+        flask_app.config['PAGE_CACHE_ENABLED'] = False
+        PageCache(flask_app)
+
+
+class StampedeTestCase(TestCase):
+    """Concurrent misses for one page render it once."""
+
+    def test_single_render(self):
+        small = Flask(__name__)
+        cache = PageCache(small)
+        renders = []
+
+        @small.route('/slow')
+        @cache.cached
+        def slow():
+            renders.append(1)
+            time.sleep(0.3)
+            return "rendered"
+
+        results = []
+
+        def fetch():
+            with small.test_client() as c:
+                resp = c.get('/slow')
+                results.append((resp.get_data(as_text=True),
+                                resp.headers['X-Page-Cache']))
+
+        threads = [threading.Thread(target=fetch) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(renders), 1)
+        self.assertEqual(sorted(results),
+                         [('rendered', 'COALESCED')] * 4
+                         + [('rendered', 'MISS')])
+        self.assertEqual(cache.renders.stats['coalesced'], 4)
+
+
+class PageCacheViewTestCase(testsupport.DatabaseTestCase):
+    """Test caching and invalidating the site's anonymous pages."""
+
+    seed_users = ('testuser',)
+
+    def setUp(self):
+        super().setUp()
+        app.config['PAGE_CACHE_ENABLED'] = True
+        # No early re-renders: hits must be deterministic here.
+        app.config['PAGE_CACHE_BETA'] = 0
+        page_cache.backend = MemoryBackend(100)
+        self.tu1_id = self.testuser.id
+
+    def tearDown(self):
+        app.config.pop('PAGE_CACHE_ENABLED')
+        app.config['PAGE_CACHE_BETA'] = 1.0
+        super().tearDown()
+
+    def test_anonymous_hits(self):
+        with app.test_client() as c:
+            first = c.get(f'/users/{self.tu1_id}')
+            second = c.get(f'/users/{self.tu1_id}')
+            other = c.get(f'/users/{self.tu1_id}?page=2')
+            home = [c.get('/').headers['X-Page-Cache'] for _ in range(2)]
+
+        self.assertEqual(first.headers['X-Page-Cache'], 'MISS')
+        self.assertEqual(second.headers['X-Page-Cache'], 'HIT')
+        self.assertEqual(second.get_data(), first.get_data())
+        self.assertIn('Cookie', second.headers['Vary'])
+        self.assertEqual(other.headers['X-Page-Cache'], 'MISS')
+        self.assertEqual(home, ['MISS', 'HIT'])
+
+    def test_logged_in_bypasses(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.tu1_id
+
+            resp = c.get(f'/users/{self.tu1_id}')
+
+        self.assertNotIn('X-Page-Cache', resp.headers)
+
+    def test_missing_not_cached(self):
+        with app.test_client() as c:
+            resp = c.get('/messages/999999')
+            again = c.get('/messages/999999')
+
+        self.assertEqual(resp.status_code, 404)
+        self.assertNotIn('X-Page-Cache', again.headers)
+
+    def test_writes_invalidate(self):
+        """Posting and editing the profile expire the cached profile."""
+
+        with app.test_client() as anon, app.test_client() as author:
+            with author.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.tu1_id
+
+            anon.get(f'/users/{self.tu1_id}')
+
+            author.post('/messages/new', data={'text': "Fresh warble"})
+            after_post = anon.get(f'/users/{self.tu1_id}')
+
+            msg_id = Message.query.filter_by(text="Fresh warble").one().id
+            anon.get(f'/messages/{msg_id}')
+            author.post('/users/profile', data={
+                'username': 'renamed', 'email': 'test@test.com',
+                'password': 'testuser'})
+            message_page = anon.get(f'/messages/{msg_id}')
+
+        self.assertEqual(after_post.headers['X-Page-Cache'], 'MISS')
+        self.assertIn('Fresh warble', after_post.get_data(as_text=True))
+        self.assertEqual(message_page.headers['X-Page-Cache'], 'MISS')
+        self.assertIn('@renamed', message_page.get_data(as_text=True))
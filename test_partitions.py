@@ -0,0 +1,185 @@
+"""Message partitioning and recent-first read tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import shutil
+import tempfile
+from datetime import date, datetime, timedelta
+from unittest import skipIf
+
+from models import db, User, Message, Likes
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import partitions
+    import queries
+    from app import app
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+POSTGRES = db.engine.dialect.name == 'postgresql'
+
+
+class RecentReadsTestCase(testsupport.DatabaseTestCase):
+    """Test reading recent months first and falling back to the rest."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        super().setUp()
+        app.config['MESSAGE_HOT_MONTHS'] = 1
+
+        now = datetime.utcnow()
+        old = now - timedelta(days=400)
+        self.messages = [
+            Message(text=text, timestamp=timestamp, user_id=self.testuser.id)
+            for text, timestamp in [('old 1', old),
+                                    ('old 2', old + timedelta(seconds=1)),
+                                    ('new 1', now - timedelta(seconds=2)),
+                                    ('new 2', now - timedelta(seconds=1)),
+                                    ('new 3', now)]]
+        db.session.add_all(self.messages)
+        db.session.commit()
+        self.ids = [msg.id for msg in self.messages]
+
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        app.config.pop('MESSAGE_HOT_MONTHS')
+        super().tearDown()
+
+    def test_months(self):
+        self.assertEqual(partitions.add_months(date(2019, 11, 1), 3),
+                         date(2020, 2, 1))
+        self.assertEqual(partitions.add_months(date(2020, 1, 1), -1),
+                         date(2019, 12, 1))
+        self.assertEqual(partitions.parse_month('2019-06'), date(2019, 6, 1))
+        self.assertEqual(partitions.partition_name(date(2019, 6, 1)),
+                         'messages_2019_06')
+
+        this_month = date.today().replace(day=1)
+        self.assertEqual(partitions.hot_since(),
+                         datetime(this_month.year, this_month.month, 1))
+
+        app.config['MESSAGE_HOT_MONTHS'] = None
+        self.assertIsNone(partitions.hot_since())
+
+    def test_pages_cross_into_old_months(self):
+        rows, cursor = queries.user_messages(self.testuser.id, limit=2)
+        self.assertEqual([row.text for row in rows], ['new 3', 'new 2'])
+
+        rows, cursor = queries.user_messages(
+            self.testuser.id, before=queries.decode_message_cursor(cursor),
+            limit=2)
+        self.assertEqual([row.text for row in rows], ['new 1', 'old 2'])
+
+        rows, cursor = queries.user_messages(
+            self.testuser.id, before=queries.decode_message_cursor(cursor),
+            limit=2)
+        self.assertEqual([row.text for row in rows], ['old 1'])
+        self.assertIsNone(cursor)
+
+    def test_find_messages(self):
+        found = queries.find_messages([self.ids[0], self.ids[4], 999999])
+
+        self.assertEqual(sorted(msg.id for msg in found),
+                         [self.ids[0], self.ids[4]])
+        self.assertEqual(queries.messages_by_ids(self.ids[::-1]),
+                         queries.messages_by_ids(self.ids)[::-1])
+
+    def test_liked_messages_skip_gone(self):
+        stranger = User(username="stranger", email="s@test.com",
+                        password="x", deleted_at=datetime.utcnow())
+        db.session.add(stranger)
+        db.session.commit()
+        gone = Message(text="gone", user_id=stranger.id)
+        db.session.add(gone)
+        db.session.commit()
+
+        for msg_id in [self.ids[0], gone.id, self.ids[3]]:
+            db.session.add(Likes(user_id=self.testuser2.id, message_id=msg_id))
+        db.session.commit()
+
+        pages = []
+        cursor = None
+        while True:
+            rows, cursor = queries.liked_messages(
+                self.testuser2.id, before=cursor, limit=1)
+            pages.append([row.text for row in rows])
+            if cursor is None:
+                break
+            cursor = queries.decode_id_cursor(cursor)
+
+        self.assertEqual(pages, [['new 2'], ['old 1']])
+
+
+@skipIf(not POSTGRES, "partitioning needs Postgres")
+class PartitionTestCase(testsupport.DatabaseTestCase):
+    """Test converting, archiving and restoring partitions."""
+
+    seed_users = ('testuser',)
+
+    def setUp(self):
+        super().setUp()
+        self.archive_dir = tempfile.mkdtemp()
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.archive_dir
+
+        self.context = app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+        app.config.pop('MESSAGE_ARCHIVE_DIR')
+        shutil.rmtree(self.archive_dir)
+        super().tearDown()
+
+    def test_archive_round_trip(self):
+        old = Message(text="Old news", timestamp=datetime(2019, 6, 15),
+                      user_id=self.testuser.id)
+        new = Message(text="News", user_id=self.testuser.id)
+        db.session.add_all([old, new])
+        db.session.commit()
+        old_id = old.id
+        db.session.add(Likes(user_id=self.testuser.id, message_id=old_id))
+        db.session.commit()
+
+        created = partitions.convert()
+        self.assertTrue(partitions.partitioned())
+        self.assertEqual(created[0], date(2019, 6, 1))
+        self.assertEqual(partitions.months(), created)
+        self.assertEqual(partitions.ensure(), [])
+        self.assertEqual(Message.query.count(), 2)
+
+        self.assertEqual(partitions.archive(date(2019, 6, 1)), 1)
+        self.assertTrue(os.path.exists(
+            partitions.archive_path(date(2019, 6, 1))))
+        self.assertIsNone(Message.query.get(old_id))
+
+        self.assertEqual(partitions.restore(date(2019, 6, 1)), 1)
+        self.assertEqual(Message.query.get(old_id).text, "Old news")
+
+        # Deleting a message still takes its likes along.
+        Message.query.filter_by(id=old_id).delete()
+        db.session.commit()
+        self.assertEqual(Likes.query.count(), 0)
@@ -0,0 +1,131 @@
+"""Profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiling.py
+
+
+import threading
+from unittest import TestCase
+
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import profiling
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class SamplingTestCase(TestCase):
+    """Test sampling stacks by endpoint."""
+
+    def test_sample(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=spin, args=(stop,))
+        worker.start()
+        profiling._endpoints[worker.ident] = 'views.homepage'
+        try:
+            samples = profiling.sample(0.2, interval=0.005)
+        finally:
+            stop.set()
+            worker.join()
+            profiling._endpoints.pop(worker.ident, None)
+
+        summary = profiling.summarize(samples)
+        self.assertGreater(summary['views.homepage']['samples'], 5)
+        self.assertIn('test_profiling:spin',
+                      dict(summary['views.homepage']['top']))
+
+        lines = profiling.collapsed(samples).splitlines()
+        line = next(line for line in lines
+                    if line.startswith('views.homepage;'))
+        stack, count = line.rsplit(' ', 1)
+        self.assertIn('threading:run;test_profiling:spin', stack)
+        self.assertTrue(count.isdigit())
+
+    def test_busy(self):
+        with profiling._sampling:
+            with self.assertRaises(profiling.ProfilerBusy):
+                profiling.sample(0.01)
+
+
+class ProfileAdminTestCase(testsupport.DatabaseTestCase):
+    """Test the admin profiling pages and per-request profiles."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        super().setUp()
+        profiling.profiles.clear()
+        app.config['ADMIN_USERNAMES'] = ('testuser',)
+        self.admin_id = self.testuser.id
+        self.user_id = self.testuser2.id
+
+    def tearDown(self):
+        app.config['ADMIN_USERNAMES'] = ()
+        super().tearDown()
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_sampling_page(self):
+        with app.test_client() as c:
+            self.login(c, self.user_id)
+            self.assertEqual(
+                c.get('/admin/profile?seconds=0.05').status_code, 404)
+
+            self.login(c, self.admin_id)
+            text = c.get('/admin/profile?seconds=0.05')
+            summary = c.get('/admin/profile?seconds=0.05&format=json')
+
+        self.assertEqual(text.mimetype, 'text/plain')
+        self.assertEqual(summary.get_json()['seconds'], 0.05)
+        self.assertIn('endpoints', summary.get_json())
+
+    def test_request_profile(self):
+        with app.test_client() as c:
+            self.login(c, self.admin_id)
+            token = c.post('/admin/profile/token').get_json()['token']
+
+            self.login(c, self.user_id)
+            plain = c.get('/')
+            forged = c.get('/', headers={profiling.HEADER: token + 'x'})
+            profiled = c.get('/', headers={profiling.HEADER: token})
+
+            self.login(c, self.admin_id)
+            profile_id = profiled.headers[profiling.ID_HEADER]
+            listed = c.get('/admin/profiles').get_json()['data']
+            report = c.get(f'/admin/profiles/{profile_id}')
+            missing = c.get('/admin/profiles/nope')
+
+        self.assertNotIn(profiling.ID_HEADER, plain.headers)
+        self.assertNotIn(profiling.ID_HEADER, forged.headers)
+        self.assertEqual(profiled.status_code, 200)
+
+        self.assertEqual(listed[0]['id'], profile_id)
+        self.assertEqual(listed[0]['endpoint'], 'views.homepage')
+        self.assertIn('function calls', report.get_data(as_text=True))
+        self.assertIn('homepage', report.get_data(as_text=True))
+        self.assertEqual(missing.status_code, 404)
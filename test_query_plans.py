@@ -0,0 +1,446 @@
+"""Query-plan regression tests.
+
+Seeds a medium dataset, requests every route of the app and captures
+each statement a request runs, with its plan. Then checks:
+
+- Budgets: no route runs more statements than ROUTES allows it.
+- Scans: no plan reads the whole of messages, follows or likes. On
+  Postgres that's a `Seq Scan`; the plans are taken with
+  enable_seqscan off, so one still showing up means no index fits. On
+  SQLite it's a `SCAN` of the table that doesn't use an index.
+- Snapshots: the normalized statements and their plans match
+  query_plans/<dialect>.txt. When they don't, the failure is a unified
+  diff of the snapshot. If the change is meant, rewrite it with
+
+      UPDATE_QUERY_PLANS=1 python -m unittest test_query_plans.py
+
+  and commit the new snapshot with the change that moved the plans.
+  A dialect without a snapshot yet gets its snapshot checks skipped.
+"""
+
+# run these tests like:
+#
+#    python -m unittest test_query_plans.py
+
+
+import difflib
+import os
+import random
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+
+from models import db, User, Message, Follows, Likes, Notification
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import graph
+    import queries
+    import recommendations
+    import slowlog
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+SNAPSHOTS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'query_plans')
+
+USERS = 60
+MESSAGES = 3000
+FOLLOWS_EACH = 12
+LIKES = 1500
+
+# Seeded messages are this old and older, so partitions and months
+# don't depend on the day the tests run.
+EPOCH = datetime(2020, 6, 1)
+
+# Tables no plan may scan whole.
+GUARDED = ('messages', 'follows', 'likes')
+
+# (endpoint, method, path, form or json body, statement budget), in the
+# order they're requested. Paths are formatted with the ids in
+# `QueryPlanTestCase.ids`. Writes come last; deleting the viewer, very
+# last.
+ROUTES = [
+    ('views.homepage', 'GET', '/', None, 6),
+    ('views.signup', 'GET', '/signup', None, 2),
+    ('views.login', 'GET', '/login', None, 2),
+    ('views.list_users', 'GET', '/users?q=user1', None, 4),
+    ('views.users_show', 'GET', '/users/{author}', None, 5),
+    ('views.user_archive', 'GET', '/users/{author}/archive', None, 5),
+    ('views.user_archive_month', 'GET',
+     '/users/{author}/archive/{year}/{month}', None, 6),
+    ('views.show_following', 'GET', '/users/{author}/following', None, 5),
+    ('views.users_followers', 'GET', '/users/{author}/followers', None, 5),
+    ('views.user_likes', 'GET', '/users/{author}/likes', None, 7),
+    ('views.edit_profile', 'GET', '/users/profile', None, 2),
+    ('views.messages_add', 'GET', '/messages/new', None, 2),
+    ('views.messages_show', 'GET', '/messages/{message}', None, 5),
+    ('views.show_trending', 'GET', '/trending', None, 5),
+    ('views.show_notifications', 'GET', '/notifications', None, 3),
+    ('api.timeline', 'GET', '/api/v1/timeline', None, 2),
+    ('api.timeline_since', 'GET', '/api/v1/timeline/since/{cursor}', None,
+     3),
+    ('api.user_profile', 'GET', '/api/v1/users/{author}', None, 3),
+    ('api.user_messages', 'GET', '/api/v1/users/{author}/messages', None, 2),
+    ('api.user_followers', 'GET', '/api/v1/users/{author}/followers', None,
+     2),
+    ('api.user_following', 'GET', '/api/v1/users/{author}/following', None,
+     2),
+    ('api.user_likes', 'GET', '/api/v1/users/{author}/likes', None, 3),
+    ('api.message_detail', 'GET', '/api/v1/messages/{message}', None, 2),
+    ('api.notification_list', 'GET', '/api/v1/notifications', None, 3),
+    ('api.trending_now', 'GET', '/api/v1/trending', None, 4),
+    ('api.relationship', 'GET', '/api/v1/users/{author}/relationship', None,
+     4),
+    ('api.suggestions', 'GET', '/api/v1/suggestions', None, 2),
+    ('admin.metrics', 'GET', '/admin/metrics', None, 1),
+    ('admin.slow_query_log', 'GET', '/admin/slow-queries', None, 1),
+    ('admin.clear_slow_query_log', 'DELETE', '/admin/slow-queries', None, 1),
+    ('admin.profile_token', 'POST', '/admin/profile/token', None, 1),
+    ('admin.request_profiles', 'GET', '/admin/profiles', None, 1),
+    ('admin.request_profile', 'GET', '/admin/profiles/nope', None, 1),
+    ('images.thumbnail', 'GET', '/img/small/nope', None, 1),
+    ('views.login', 'POST', '/login',
+     {'username': 'user1', 'password': 'wrong'}, 2),
+    ('views.signup', 'POST', '/signup',
+     {'username': 'newcomer', 'email': 'newcomer@example.com',
+      'password': 'password'}, 3),
+    ('views.edit_profile', 'POST', '/users/profile',
+     {'username': 'user1', 'email': 'user1@example.com', 'bio': 'Hello',
+      'password': 'wrong'}, 2),
+    ('views.messages_add', 'POST', '/messages/new', {'text': 'Hello'}, 8),
+    ('views.add_like', 'POST', '/users/add_like/{message}', None, 8),
+    ('api.notifications_read', 'POST', '/api/v1/notifications/read', None,
+     2),
+    ('views.add_follow', 'POST', '/users/follow/{stranger}', None, 4),
+    ('views.stop_following', 'POST', '/users/stop-following/{stranger}',
+     None, 3),
+    ('api.follow_many', 'POST', '/api/v1/following',
+     {'user_ids': ['{stranger}']}, 4),
+    ('api.unfollow_many', 'DELETE', '/api/v1/following',
+     {'user_ids': ['{stranger}']}, 3),
+    ('views.messages_destroy', 'POST', '/messages/{own_message}/delete',
+     None, 7),
+    ('views.logout', 'GET', '/logout', None, 1),
+    ('views.delete_user', 'POST', '/users/delete', None, 18),
+]
+
+# Routes not requested, and why.
+UNCHECKED = {
+    'static': "serves files, no queries",
+    'admin.profile': "samples stacks for a while, no queries of its own",
+}
+
+_cost = re.compile(r'\s+\(cost=[^)]*\)')
+
+
+def seed():
+    """Insert the medium dataset; returns the user ids, first the viewer."""
+
+    rng = random.Random(50)
+
+    db.session.execute(User.__table__.insert(), [
+        {'username': f"user{n}", 'email': f"user{n}@example.com",
+         'password': 'x', 'bio': "Warbling away.", 'location': "Somewhere"}
+        for n in range(1, USERS + 1)])
+    user_ids = [user_id for user_id, in db.session.query(User.id)
+                .filter(User.username.like('user%')).order_by(User.id)]
+
+    db.session.execute(Message.__table__.insert(), [
+        {'text': f"Message number {n} #tag{n % 7} @user{n % USERS}",
+         'user_id': rng.choice(user_ids),
+         'timestamp': EPOCH - timedelta(minutes=n * 37)}
+        for n in range(MESSAGES)])
+    message_ids = [message_id for message_id, in
+                   db.session.query(Message.id).order_by(Message.id)]
+
+    db.session.execute(Follows.__table__.insert(), [
+        {'user_following_id': follower, 'user_being_followed_id': followed}
+        for follower in user_ids
+        for followed in rng.sample(user_ids, FOLLOWS_EACH)
+        if followed != follower])
+
+    likes = {(rng.choice(user_ids), rng.choice(message_ids))
+             for _ in range(LIKES)}
+    db.session.execute(Likes.__table__.insert(), [
+        {'user_id': user_id, 'message_id': message_id}
+        for user_id, message_id in sorted(likes)])
+
+    db.session.execute(Notification.__table__.insert(), [
+        {'user_id': user_ids[0], 'kind': 'like', 'subject_id': message_id,
+         'bucket': EPOCH - timedelta(hours=n), 'actor_id': user_ids[n + 1],
+         'count': 1, 'updated_at': EPOCH - timedelta(hours=n),
+         'unread': True}
+        for n, message_id in enumerate(message_ids[:20])])
+
+    db.session.commit()
+    return user_ids
+
+
+def plan_lines(plan):
+    """`plan`'s lines without Postgres's cost estimates, which move with
+    the table statistics."""
+
+    return [_cost.sub('', line).rstrip() for line in plan.splitlines()]
+
+
+def scans(dialect, plan):
+    """Lines of `plan` reading a guarded table whole."""
+
+    found = []
+    for line in plan_lines(plan):
+        text = line.strip()
+        for table in GUARDED:
+            if dialect == 'postgresql':
+                # Monthly partitions of messages count as messages.
+                whole = re.search(
+                    rf'Seq Scan on {table}(_\d{{4}}_\d{{2}}|_default)?\b',
+                    text)
+            else:
+                # SCAN walks the table or a whole index; an AUTOMATIC
+                # index is built from a walk of the table, every query.
+                whole = re.match(rf'(SCAN|SEARCH) (TABLE )?{table}\b', text) \
+                    and (text.startswith('SCAN') or 'AUTOMATIC' in text)
+            if whole:
+                found.append(text)
+    return found
+
+
+def sections(snapshot):
+    """`{route: lines}` of a snapshot, in order."""
+
+    found = {}
+    lines = []
+    for line in snapshot.splitlines():
+        if line.startswith('## '):
+            lines = found.setdefault(line[3:].rsplit(':', 1)[0], [])
+        lines.append(line)
+    return found
+
+
+def snapshot_diff(expected, actual):
+    """A unified diff per route whose statements or plans changed."""
+
+    before, after = sections(expected), sections(actual)
+    routes = list(after) + [route for route in before if route not in after]
+
+    return '\n'.join(
+        line for route in routes
+        for line in difflib.unified_diff(
+            before.get(route, []), after.get(route, []),
+            f"{route} (snapshot)", f"{route} (this run)", lineterm=''))
+
+
+class Capture:
+    """Statements run on a connection, with their plans."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.connection, 'after_cursor_execute', self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.connection, 'after_cursor_execute', self.record)
+
+    def record(self, conn, cursor, statement, parameters, context,
+               executemany):
+        sql = slowlog.normalize(statement)
+        if not sql.lower().startswith(slowlog.EXPLAINABLE):
+            return
+
+        plan = ''
+        if not executemany:
+            plan = slowlog.explain(conn.dialect.name, cursor, statement,
+                                   parameters)
+        self.statements.append((sql, plan or ''))
+
+
+class QueryPlanTestCase(testsupport.DatabaseTestCase):
+    """Test every route's statements against budgets, scan rules and the
+    committed plans."""
+
+    def setUp(self):
+        super().setUp()
+        self.dialect = db.engine.dialect.name
+
+        user_ids = seed()
+        self._connection.execute('ANALYZE')
+
+        # The follow graph and recommendations load whole tables once per
+        # process; load them now, so no route is charged for it.
+        with app.app_context():
+            graph.index.rebuild()
+            recommendations.engine.rebuild()
+        if self.dialect == 'postgresql':
+            # Undone with the test's transaction.
+            self._connection.execute('SET enable_seqscan = off')
+
+        viewer, author = user_ids[0], self.popular()
+        message = (Message.query.filter_by(user_id=author)
+                   .order_by(Message.timestamp.desc()).first())
+        own_message = Message.query.filter_by(user_id=viewer).first()
+        stranger = next(
+            user_id for user_id in reversed(user_ids)
+            if user_id != viewer
+            and not Follows.followed_among(viewer, {user_id}))
+        since = queries.timeline(viewer, limit=5)[0][-1]
+
+        self.ids = {
+            'viewer': viewer, 'author': author, 'stranger': stranger,
+            'message': message.id, 'own_message': own_message.id,
+            'year': message.timestamp.year,
+            'month': message.timestamp.month,
+            'cursor': queries.message_cursor(since),
+        }
+        app.config['ADMIN_USERNAMES'] = (
+            db.session.query(User.username).filter(User.id == viewer)
+            .scalar(),)
+
+    def tearDown(self):
+        app.config['ADMIN_USERNAMES'] = ()
+        super().tearDown()
+
+    def popular(self):
+        """The user with the most followers."""
+
+        return (db.session.query(Follows.user_being_followed_id)
+                .group_by(Follows.user_being_followed_id)
+                .order_by(db.func.count().desc(),
+                          Follows.user_being_followed_id)
+                .limit(1).scalar())
+
+    def fill(self, value):
+        """`value` with the ids filled in; a string that's all id becomes
+        an int."""
+
+        if isinstance(value, str):
+            filled = value.format(**self.ids)
+            return int(filled) if filled.isdigit() and value != filled \
+                else filled
+        if isinstance(value, list):
+            return [self.fill(item) for item in value]
+        if isinstance(value, dict):
+            return {key: self.fill(item) for key, item in value.items()}
+        return value
+
+    def request(self, client, method, path, body):
+        path = self.fill(path)
+        body = self.fill(body)
+
+        if path.startswith('/api/') and body is not None:
+            return client.open(path, method=method, json=body)
+        return client.open(path, method=method, data=body)
+
+    def run_routes(self):
+        """Request every route; returns `[(route, statements)]`."""
+
+        results = []
+        with app.test_client() as client:
+            for route in ROUTES:
+                endpoint, method, path, body, budget = route
+                testsupport.reset_state(app)
+                # Signing up logs the new user in, and logging out
+                # logs everyone out.
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.ids['viewer']
+
+                with Capture(self._connection) as capture:
+                    response = self.request(client, method, path, body)
+
+                self.assertLess(response.status_code, 500, route)
+                results.append((route, capture.statements))
+
+        return results
+
+    def render(self, results):
+        """The snapshot text of `results`.
+
+        A route's statements are sorted: the jobs a request publishes run
+        their handlers in the order the handlers' modules were imported,
+        which depends on what else the test run imported first.
+        """
+
+        lines = []
+        for (endpoint, method, path, body, budget), statements in results:
+            lines.append(f"## {method} {path} ({endpoint}): "
+                         f"{len(statements)} statements")
+            for sql, plan in sorted(statements):
+                lines.append(sql)
+                lines.extend(f"    {line}" for line in plan_lines(plan))
+            lines.append('')
+
+        return '\n'.join(lines)
+
+    def test_every_route_listed(self):
+        listed = {(endpoint, method) for endpoint, method, *_ in ROUTES}
+        missing = [
+            f"{method} {rule.rule} ({rule.endpoint})"
+            for rule in app.url_map.iter_rules()
+            if rule.endpoint not in UNCHECKED
+            for method in sorted(rule.methods - {'HEAD', 'OPTIONS'})
+            if (rule.endpoint, method) not in listed]
+
+        self.assertEqual(missing, [],
+                         "Routes without a query budget in ROUTES")
+
+    def test_plans(self):
+        results = self.run_routes()
+
+        over = [f"{method} {path}: {len(statements)} > {budget}"
+                for (endpoint, method, path, body, budget), statements
+                in results if len(statements) > budget]
+        if over:
+            self.fail("Routes over their query budget:\n" + '\n'.join(over))
+
+        scanned = [f"{method} {path}: {sql}\n    {line}"
+                   for (endpoint, method, path, body, budget), statements
+                   in results
+                   for sql, plan in statements
+                   for line in scans(self.dialect, plan)]
+        if scanned:
+            self.fail(f"Full scans of {', '.join(GUARDED)}:\n"
+                      + '\n'.join(scanned))
+
+        self.check_snapshot(self.render(results))
+
+    def check_snapshot(self, actual):
+        path = os.path.join(SNAPSHOTS, f"{self.dialect}.txt")
+
+        if os.environ.get('UPDATE_QUERY_PLANS'):
+            os.makedirs(SNAPSHOTS, exist_ok=True)
+            with open(path, 'w') as snapshot:
+                snapshot.write(actual)
+            return
+
+        if not os.path.exists(path):
+            self.skipTest(f"No plan snapshot for {self.dialect}; write one "
+                          f"with UPDATE_QUERY_PLANS=1")
+
+        with open(path) as snapshot:
+            expected = snapshot.read()
+
+        if actual != expected:
+            self.fail("Statements or plans changed (rerun with "
+                      "UPDATE_QUERY_PLANS=1 if that's meant):\n"
+                      + snapshot_diff(expected, actual))
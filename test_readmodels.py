@@ -0,0 +1,81 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_readmodels.py
+
+
+from models import db, Message, Follows
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import queries
+    from app import app, CURR_USER_KEY
+    from readmodels import MessageRow, ProfileRow, UserCard
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class ReadModelTestCase(testsupport.DatabaseTestCase):
+    """Test that hot pages read immutable rows rather than ORM objects."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        super().setUp()
+
+        db.session.add(Follows(user_following_id=self.testuser.id,
+                               user_being_followed_id=self.testuser2.id))
+        db.session.add(Message(text="Hello there", user_id=self.testuser2.id))
+        db.session.commit()
+
+        self.tu1_id = self.testuser.id
+        self.tu2_id = self.testuser2.id
+
+    def test_rows(self):
+        rows, cursor = queries.timeline(self.tu1_id)
+        row = rows[0]
+
+        self.assertIsInstance(row, MessageRow)
+        self.assertEqual(row.text, "Hello there")
+        self.assertEqual((row.user.id, row.user.username),
+                         (self.tu2_id, "testuser2"))
+        self.assertFalse(hasattr(row, '__dict__'))
+        with self.assertRaises(AttributeError):
+            row.text = "Changed"
+
+        profile = queries.profile(self.tu2_id)
+        self.assertIsInstance(profile, ProfileRow)
+        self.assertEqual((profile.messages_count, profile.followers_count),
+                         (1, 1))
+
+        cards, cursor = queries.following(self.tu1_id)
+        self.assertEqual([type(card) for card in cards], [UserCard])
+        self.assertEqual(cards[0].username, "testuser2")
+
+    def test_pages_render_rows(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.tu1_id
+
+            home = c.get('/').get_data(as_text=True)
+            users = c.get('/users').get_data(as_text=True)
+
+        self.assertIn('@testuser2', home)
+        self.assertIn('Hello there', home)
+        self.assertIn(f'action="/users/stop-following/{self.tu2_id}"', users)
@@ -0,0 +1,181 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import threading
+import time
+
+from models import db, User, Message, Follows
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    from app import app, CURR_USER_KEY
+    import graph
+    from recommendations import engine
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class WatchedLock:
+    """A lock that says when someone starts waiting for it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiting = threading.Event()
+
+    def acquire(self, blocking=True):
+        return self.lock.acquire(blocking)
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        if self.lock.locked():
+            self.waiting.set()
+        self.lock.acquire()
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class RecommenderTestCase(testsupport.DatabaseTestCase):
+    """Test friends-of-friends suggestions."""
+
+    def setUp(self):
+        """a follows b and c; b follows d; c follows d and e."""
+
+        super().setUp()
+        self.users = {
+            name: User(username=name, email=f"{name}@test.com", password="x")
+            for name in 'abcdef'
+        }
+        db.session.add_all(self.users.values())
+        db.session.commit()
+        self.ids = {name: user.id for name, user in self.users.items()}
+
+        for follower, followed in ('ab', 'ac', 'bd', 'cd', 'ce'):
+            Follows.follow_many(self.ids[follower], [self.ids[followed]])
+        db.session.add(Message(text="hi", user_id=self.ids['e']))
+        db.session.commit()
+
+        with app.app_context():
+            graph.index.rebuild()
+            engine.rebuild()
+
+    def test_suggest_by_mutuals(self):
+        """d has two mutual connections, e only one."""
+
+        with app.app_context():
+            suggested = engine.suggest(self.ids['a'], k=2)
+
+        self.assertEqual([user_id for user_id, score in suggested],
+                         [self.ids['d'], self.ids['e']])
+
+    def test_suggest_pads_with_popular(self):
+        """Users with no friends-of-friends get popular accounts."""
+
+        with app.app_context():
+            suggested = engine.suggest(self.ids['f'], k=1)
+
+        self.assertEqual(suggested, [(self.ids['d'], 0.0)])
+
+    def test_deltas(self):
+        """Follows and unfollows apply without a rebuild."""
+
+        with app.app_context():
+            graph.index.record(graph.FOLLOW, self.ids['a'], [self.ids['d']])
+            graph.index.record(graph.UNFOLLOW, self.ids['a'], [self.ids['c']])
+
+            self.assertEqual(graph.index.following_ids(self.ids['a']),
+                             {self.ids['b'], self.ids['d']})
+
+            suggested = engine.suggest(self.ids['a'], k=5)
+
+        self.assertNotIn(self.ids['d'], [user_id for user_id, s in suggested])
+        self.assertIn(self.ids['c'], [user_id for user_id, s in suggested])
+
+    def test_stale_snapshot_reloaded_once(self):
+        loads = []
+        engine._load = lambda: loads.append(1)
+        engine._building = building = WatchedLock()
+        engine.built_at = 1
+
+        try:
+            # A request that waited on someone else's rebuild finds the
+            # snapshot fresh and doesn't rebuild again.
+            with building:
+                waiter = threading.Thread(target=self.ensure_fresh)
+                waiter.start()
+                building.waiting.wait(5)
+                engine.built_at = time.time()
+            waiter.join()
+
+            # With background rebuilds, requests don't wait at all.
+            app.config['RECOMMENDATIONS_BACKGROUND'] = True
+            engine.built_at = 1
+            with building:
+                self.ensure_fresh()
+        finally:
+            app.config.pop('RECOMMENDATIONS_BACKGROUND', None)
+            engine._building = threading.Lock()
+            del engine._load
+
+        self.assertEqual(loads, [])
+
+    def ensure_fresh(self):
+        with app.app_context():
+            engine.ensure_fresh()
+
+    def test_suggestions_endpoint(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids['a']
+
+            data = c.get('/api/v1/suggestions?limit=1').get_json()['data']
+
+        self.assertEqual([u['username'] for u in data], ['d'])
+
+    def test_home_sidebar(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids['a']
+
+            html = c.get('/').get_data(as_text=True)
+
+        self.assertIn('Who to follow', html)
+        self.assertIn('@e', html)
+
+    def test_home_sidebar_leaves_graph_unbuilt(self):
+        """Without GRAPH_INDEX, the home page doesn't build the graph."""
+
+        built, graph.index = graph.index, graph.GraphIndex()
+        try:
+            with app.test_client() as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.ids['a']
+
+                html = c.get('/').get_data(as_text=True)
+
+            self.assertFalse(graph.index.ready)
+        finally:
+            graph.index = built
+
+        self.assertNotIn('@e', html)
@@ -0,0 +1,214 @@
+"""Server-side session tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sessions.py
+
+
+import re
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from models import db
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import sessions
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class MemoryStoreTestCase(TestCase):
+    """Test the in-process store."""
+
+    def test_expiry_and_revoke(self):
+        store = sessions.MemoryStore()
+        store.save('a', '{}', 1, ttl=60)
+        store.save('b', '{}', 1, ttl=60)
+        store.save('c', '{}', 2, ttl=-1)
+
+        self.assertEqual(store.load('a')[0], '{}')
+        self.assertIsNone(store.load('c'))
+        self.assertEqual(store.active_users(), 1)
+
+        self.assertEqual(store.revoke_user(1, keep='b'), 1)
+        self.assertIsNone(store.load('a'))
+        self.assertEqual(store.user_sessions(1), {'b'})
+
+    def test_touch_slides_expiry(self):
+        store = sessions.MemoryStore()
+        store.save('a', '{}', 1, ttl=10)
+        expires = store.load('a')[1]
+
+        store.touch('a', ttl=100)
+        self.assertGreater(store.load('a')[1], expires + 50)
+
+    def test_sweep_and_cap(self):
+        store = sessions.MemoryStore(max_entries=2)
+        store.save('gone', '{}', None, ttl=-1)
+        store.save('a', '{}', 1, ttl=60)
+        self.assertEqual(len(store), 1)
+
+        store.save('b', '{}', 2, ttl=60)
+        store.touch('a', ttl=60)
+        store.save('c', '{}', 3, ttl=60)
+
+        # b was written least recently.
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(store.load('b'))
+        self.assertEqual(store.user_sessions(2), set())
+        self.assertIsNotNone(store.load('a'))
+
+
+class SessionViewsTestCase(testsupport.DatabaseTestCase):
+    """Test logging in, the user snapshot and revoking sessions."""
+
+    seed_users = ('testuser',)
+
+    def setUp(self):
+        # Also starts a fresh session store: SQLite reuses user ids, so
+        # earlier tests' sessions mustn't carry over.
+        super().setUp()
+        self.tu1_id = self.testuser.id
+
+    def login(self, client):
+        return client.post('/login', data={'username': 'testuser',
+                                           'password': 'testuser'})
+
+    def statements(self, client, path):
+        """SQL run while `client` GETs `path`, and the response."""
+
+        seen = []
+
+        def record(conn, cursor, statement, *args):
+            seen.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            resp = client.get(path)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        return seen, resp
+
+    def test_nav_without_user_query(self):
+        with app.test_client() as c:
+            self.login(c)
+            seen, resp = self.statements(c, '/trending')
+
+        self.assertIn('testuser', resp.get_data(as_text=True))
+        self.assertFalse([sql for sql in seen if 'FROM users' in sql])
+
+    def test_login_replaces_session_id(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess['seen'] = True
+                before = sess.sid
+
+            self.login(c)
+
+            with c.session_transaction() as sess:
+                self.assertNotEqual(sess.sid, before)
+                self.assertEqual(sess[CURR_USER_KEY], self.tu1_id)
+
+        self.assertIsNone(app.session_interface.store.load(before))
+
+    def test_profile_edit_updates_other_sessions(self):
+        with app.test_client() as phone, app.test_client() as laptop:
+            self.login(phone)
+            self.login(laptop)
+
+            laptop.post('/users/profile', data={
+                'username': 'renamed', 'email': 'test@test.com',
+                'password': 'testuser'})
+            html = phone.get('/trending').get_data(as_text=True)
+
+        self.assertIn('alt="renamed"', html)
+
+    def test_delete_ends_all_sessions(self):
+        with app.test_client() as phone, app.test_client() as laptop:
+            self.login(phone)
+            self.login(laptop)
+            self.assertEqual(
+                len(app.session_interface.store.user_sessions(self.tu1_id)),
+                2)
+
+            laptop.post('/users/delete')
+            resp = phone.get('/users/profile')
+
+            with phone.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(
+            app.session_interface.store.user_sessions(self.tu1_id), set())
+
+    def test_revoke_keeps_current(self):
+        with app.test_client() as phone, app.test_client() as laptop:
+            self.login(phone)
+            self.login(laptop)
+
+            with laptop.session_transaction() as sess:
+                keep = sess.sid
+            ended = app.session_interface.store.revoke_user(
+                self.tu1_id, keep)
+
+            self.assertEqual(ended, 1)
+            self.assertIn(b'testuser',
+                          laptop.get('/trending').get_data())
+            self.assertNotIn(b'testuser',
+                             phone.get('/trending').get_data())
+
+    def test_unchanged_session_touched_sparingly(self):
+        app.config['SESSION_TOUCH_INTERVAL'] = 3600
+        try:
+            with app.test_client() as c:
+                self.login(c)
+                c.get('/trending')  # shows and clears the login flash
+                resp = c.get('/trending')
+        finally:
+            app.config['SESSION_TOUCH_INTERVAL'] = 60
+
+        self.assertNotIn('Set-Cookie', resp.headers)
+
+    def test_anonymous_csrf_token_kept_in_cookie(self):
+        store = app.session_interface.store
+        app.config['WTF_CSRF_ENABLED'] = True
+        try:
+            with app.test_client() as c:
+                html = c.get('/login').get_data(as_text=True)
+                token = re.search(r'name="csrf_token" type="hidden" '
+                                  r'value="([^"]+)"', html).group(1)
+                self.assertEqual(len(store), 0)
+
+                c.get('/signup')
+                self.assertEqual(len(store), 0)
+
+                c.post('/login', data={'username': 'testuser',
+                                       'password': 'testuser',
+                                       'csrf_token': token})
+
+                with c.session_transaction() as sess:
+                    self.assertEqual(sess[CURR_USER_KEY], self.tu1_id)
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = False
+
+        self.assertEqual(len(store), 1)
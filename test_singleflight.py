@@ -0,0 +1,107 @@
+"""Request coalescing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_singleflight.py
+
+
+import threading
+import time
+from unittest import TestCase
+
+import singleflight
+
+
+class GroupTestCase(TestCase):
+    """Test sharing one in-flight call."""
+
+    def run_concurrently(self, func, n=5):
+        results = []
+
+        def call():
+            try:
+                results.append(func())
+            except Exception as error:
+                results.append(error)
+
+        threads = [threading.Thread(target=call) for _ in range(n)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_coalesces(self):
+        group = singleflight.Group('test_coalesces')
+        runs = []
+
+        def slow():
+            runs.append(1)
+            time.sleep(0.2)
+            return 'value'
+
+        results = self.run_concurrently(lambda: group.do('key', slow))
+
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(sorted(results),
+                         [('value', False)] + [('value', True)] * 4)
+        self.assertEqual(singleflight.metrics()['test_coalesces'],
+                         {'calls': 5, 'coalesced': 4, 'executions': 1})
+
+    def test_shares_errors(self):
+        group = singleflight.Group('test_errors')
+
+        def fail():
+            time.sleep(0.2)
+            raise KeyError('boom')
+
+        results = self.run_concurrently(lambda: group.do('key', fail), n=3)
+
+        self.assertTrue(all(isinstance(r, KeyError) for r in results))
+        self.assertEqual(group.stats['executions'], 1)
+
+        # The failure isn't remembered.
+        self.assertEqual(group.do('key', lambda: 1), (1, False))
+
+
+class CacheTestCase(TestCase):
+    """Test the TTL cache and early refresh."""
+
+    def test_hits_until_expiry(self):
+        cache = singleflight.Cache('test_hits', ttl=60, beta=0)
+        loads = []
+
+        def load():
+            loads.append(1)
+            return len(loads)
+
+        self.assertEqual(cache.get('k', load), 1)
+        self.assertEqual(cache.get('k', load), 1)
+        cache.delete('k')
+        self.assertEqual(cache.get('k', load), 2)
+        self.assertEqual(cache.get('other', load, ttl=0), 3)
+        self.assertEqual(cache.get('other', load, ttl=0), 4)
+        self.assertEqual(cache.group.stats['hits'], 1)
+
+    def test_delete_during_load(self):
+        """A load that overlaps an invalidation isn't stored."""
+
+        cache = singleflight.Cache('test_race', ttl=60, beta=0)
+
+        def load():
+            cache.delete('k')
+            return 'stale'
+
+        cache.get('k', load)
+        self.assertEqual(len(cache), 0)
+
+    def test_should_refresh(self):
+        # Instant to compute: only refreshed once expired.
+        self.assertFalse(singleflight.should_refresh(100, 0, now=99))
+        self.assertTrue(singleflight.should_refresh(100, 0, now=100))
+
+        # Slow to compute: almost always refreshed just before expiry.
+        refreshes = sum(singleflight.should_refresh(100, 10, now=99)
+                        for _ in range(1000))
+        self.assertGreater(refreshes, 800)
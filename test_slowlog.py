@@ -0,0 +1,132 @@
+"""Slow-query log and admin page tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_slowlog.py
+
+
+import json
+import os
+import tempfile
+
+from models import db, Message
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import slowlog
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class SlowQueryLogTestCase(testsupport.DatabaseTestCase):
+    """Test recording slow statements and showing them to admins."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        super().setUp()
+        slowlog.log.clear()
+        self.log_path = os.path.join(tempfile.mkdtemp(), 'slow.jsonl')
+        app.config.update(SLOW_QUERY_MS=0, SLOW_QUERY_LOG_PATH=self.log_path,
+                          ADMIN_USERNAMES=('testuser',))
+
+    def tearDown(self):
+        app.config.update(SLOW_QUERY_MS=250, SLOW_QUERY_LOG_PATH=None,
+                          ADMIN_USERNAMES=())
+        slowlog.log.clear()
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        os.rmdir(os.path.dirname(self.log_path))
+        super().tearDown()
+
+    def test_normalize(self):
+        self.assertEqual(
+            slowlog.normalize("SELECT *\n  FROM messages WHERE id IN "
+                              "(%(id_1)s, %(id_2)s) AND text = 'it''s' "
+                              "AND user_id = 12"),
+            "SELECT * FROM messages WHERE id IN (?...) AND text = ? "
+            "AND user_id = ?")
+        self.assertEqual(
+            slowlog.normalize("SELECT x FROM messages_2019_06 WHERE a = ?"),
+            "SELECT x FROM messages_2019_06 WHERE a = ?")
+
+    def test_bind_shape(self):
+        self.assertEqual(
+            slowlog.bind_shape({'id_1': 1, 'id_2': 2, 'id_3': 3,
+                                'text': 'x', 'param_1': None}),
+            {'id': 'int[3]', 'text': 'str', 'param': 'null'})
+        self.assertEqual(slowlog.bind_shape((1, 'a')), ['int', 'str'])
+        self.assertEqual(slowlog.bind_shape([{'a': 1}, {'a': 2}]),
+                         {'rows': 2, 'each': {'a': 'int'}})
+
+    def test_records_request_queries(self):
+        user_id = self.testuser2.id
+        db.session.add(Message(text="Hello", user_id=user_id))
+        db.session.commit()
+        slowlog.log.clear()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            c.get(f'/users/{user_id}')
+
+        entries = slowlog.log.entries()
+        select = next(entry for entry in entries
+                      if entry['endpoint'] == 'views.users_show'
+                      and entry['sql'].startswith('SELECT'))
+        self.assertIn('int', json.dumps(select['binds']))
+        self.assertNotIn(str(user_id), json.dumps(select['binds']))
+        self.assertIsNotNone(select['plan'])
+        self.assertEqual(select['path'], f'/users/{user_id}')
+
+        with open(self.log_path) as log:
+            logged = [json.loads(line) for line in log]
+        self.assertEqual(len(logged), len(entries))
+
+    def test_threshold(self):
+        app.config['SLOW_QUERY_MS'] = 10000
+        with app.app_context():
+            Message.query.all()
+
+        self.assertEqual(slowlog.log.entries(), [])
+
+    def test_admin_pages(self):
+        with app.app_context():
+            Message.query.filter(Message.user_id == 1).all()
+            Message.query.filter(Message.user_id == 2).all()
+
+        with app.test_client() as c:
+            self.assertEqual(c.get('/admin/slow-queries').status_code, 404)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+            self.assertEqual(c.get('/admin/metrics').status_code, 404)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+            log = c.get('/admin/slow-queries').get_json()
+            metrics = c.get('/admin/metrics').get_json()
+
+        grouped = [group for group in log['statements']
+                   if 'FROM messages' in group['sql']]
+        self.assertEqual(grouped[0]['count'], 2)
+        self.assertEqual(log['threshold_ms'], 0)
+        self.assertIn('write_buffer', metrics)
+        self.assertIn('singleflight', metrics)
+        self.assertIn('notifications', metrics)
@@ -0,0 +1,287 @@
+"""Message stream tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_stream.py
+
+
+import asyncio
+from unittest import TestCase
+
+from models import Message
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import jobs
+    import sessions
+    import stream
+    from app import app, CURR_USER_KEY
+    from asgi import AsyncWarbler
+    from test_asgi import FakePool
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['WTF_CSRF_ENABLED'] = False
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+def event(msg_id, author_id=1):
+    return stream.Event(msg_id, author_id, f'{{"id": {msg_id}}}')
+
+
+class HubTestCase(TestCase):
+    """Test routing, replay and backpressure in the hub."""
+
+    def setUp(self):
+        self.hub = stream.Hub()
+        self.hub.replay = 2
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def subscriber(self, authors, maxsize=10):
+        return stream.Subscriber(1, authors, self.loop, maxsize)
+
+    def drain(self, subscriber):
+        """Run the queued offers; return what the subscriber received."""
+
+        self.loop.run_until_complete(asyncio.sleep(0))
+        received = []
+        while not subscriber.queue.empty():
+            received.append(subscriber.queue.get_nowait())
+        return received
+
+    def test_routes_by_author(self):
+        follows, other = self.subscriber({1}), self.subscriber({2})
+        self.hub.subscribe(follows)
+        self.hub.subscribe(other)
+
+        self.hub.publish(event(5, author_id=1))
+
+        self.assertEqual([e.id for e in self.drain(follows)], [5])
+        self.assertEqual(self.drain(other), [])
+
+        self.hub.unsubscribe(follows)
+        self.hub.publish(event(6, author_id=1))
+        self.assertEqual(self.drain(follows), [])
+        self.assertEqual(self.hub.subscriber_count(), 1)
+
+    def test_refollow(self):
+        subscriber = self.subscriber({1})
+        self.hub.subscribe(subscriber)
+
+        self.hub.refollow(1, added=[2])
+        self.hub.publish(event(5, author_id=2))
+        self.assertEqual([e.id for e in self.drain(subscriber)], [5])
+
+        self.hub.refollow(1, removed=[1, 2])
+        self.hub.publish(event(6, author_id=2))
+        self.assertEqual(self.drain(subscriber), [])
+        # Nobody unfollows themselves.
+        self.assertEqual(subscriber.authors, {1})
+
+    def test_replay(self):
+        for msg_id in (5, 6, 7):
+            self.hub.publish(event(msg_id))
+        self.hub.publish(event(8, author_id=2))
+
+        # The buffer keeps two per author, so 6 and 7 are still there.
+        replay, complete = self.hub.subscribe(self.subscriber({1, 2}), 5)
+        self.assertTrue(complete)
+        self.assertEqual([e.id for e in replay], [6, 7, 8])
+
+        # 5 was dropped, so a client that last saw 4 missed it.
+        replay, complete = self.hub.subscribe(self.subscriber({1}), 4)
+        self.assertFalse(complete)
+
+        # And one that last saw 3 may have missed something from before
+        # the hub's first event.
+        replay, complete = stream.Hub().subscribe(self.subscriber({1}), 3)
+        self.assertFalse(complete)
+
+        replay, complete = self.hub.subscribe(self.subscriber({1}))
+        self.assertEqual((replay, complete), ([], True))
+
+    def test_overflow(self):
+        subscriber = self.subscriber({1}, maxsize=2)
+        self.hub.subscribe(subscriber)
+
+        for msg_id in (5, 6, 7, 8):
+            self.hub.publish(event(msg_id))
+
+        self.assertEqual(self.drain(subscriber), [stream.OVERFLOW])
+        self.assertTrue(subscriber.overflowed)
+
+    def test_closed_loop(self):
+        closed = asyncio.new_event_loop()
+        closed.close()
+        gone = stream.Subscriber(2, {1}, closed)
+        live = self.subscriber({1})
+        self.hub.subscribe(gone)
+        self.hub.subscribe(live)
+
+        self.hub.publish(event(5))
+
+        self.assertEqual(self.drain(live), [event(5)])
+        self.assertEqual(self.hub.subscriber_count(), 1)
+
+
+class StreamJobsTestCase(testsupport.DatabaseTestCase):
+    """Test that posting and following reach the hub."""
+
+    seed_users = ('testuser',)
+
+    def setUp(self):
+        super().setUp()
+        testsupport.reset_state(app)
+        self.loop = asyncio.new_event_loop()
+        self.subscribers = []
+
+    def tearDown(self):
+        for subscriber in self.subscribers:
+            stream.hub.unsubscribe(subscriber)
+        self.loop.close()
+        super().tearDown()
+
+    def subscribe(self):
+        subscriber = stream.Subscriber(
+            self.testuser.id, {self.testuser.id}, self.loop)
+        stream.hub.subscribe(subscriber)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def test_message_posted(self):
+        subscriber = self.subscribe()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post('/messages/new', data={'text': 'Live'})
+
+        self.loop.run_until_complete(asyncio.sleep(0))
+        sent = subscriber.queue.get_nowait()
+        msg = Message.query.one()
+
+        self.assertEqual((sent.id, sent.author_id),
+                         (msg.id, self.testuser.id))
+        self.assertIn('"text":"Live"', sent.data)
+        self.assertIn('"username":"testuser"', sent.data)
+
+    def test_follows_changed(self):
+        subscriber = self.subscribe()
+
+        with app.app_context():
+            jobs.publish('follows_added', user_id=self.testuser.id,
+                         followed_ids=[42])
+            self.assertEqual(subscriber.authors, {self.testuser.id, 42})
+
+            jobs.publish('follows_removed', user_id=self.testuser.id,
+                         followed_ids=[42])
+        self.assertEqual(subscriber.authors, {self.testuser.id})
+
+
+class AsgiStreamTestCase(TestCase):
+    """Test the SSE route of the ASGI app."""
+
+    def setUp(self):
+        testsupport.reset_state(app)
+        self.asgi = AsyncWarbler(app)
+
+    def headers(self, user_id, last_event_id=None):
+        interface = app.session_interface
+        sid = sessions.new_sid()
+        interface.store.save(
+            sid, interface.serializer.dumps({CURR_USER_KEY: user_id}),
+            user_id, ttl=60)
+
+        headers = [(b'cookie', f'session={sid}'.encode())]
+        if last_event_id is not None:
+            headers.append((b'last-event-id', str(last_event_id).encode()))
+        return headers
+
+    def run_stream(self, headers, publish=(), expect=0):
+        """Open the stream, publish `publish` once it's live, and hang up
+        after `expect` events arrive; return the messages sent."""
+
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/v1/stream',
+                 'query_string': b'', 'headers': headers}
+        sent = []
+
+        async def scenario():
+            gone = asyncio.Event()
+
+            async def receive():
+                await gone.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if len(sent) == 2:
+                    for item in publish:
+                        stream.hub.publish(item)
+                if len(sent) == 2 + expect:
+                    gone.set()
+
+            await self.asgi(scope, receive, send)
+            # Let the stream's cancelled tasks finish.
+            await asyncio.sleep(0)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(asyncio.wait_for(scenario(), 5))
+        finally:
+            loop.close()
+
+        return sent
+
+    def test_requires_login(self):
+        self.asgi.pool = FakePool()
+
+        sent = self.run_stream([])
+
+        self.assertEqual(sent[0]['status'], 401)
+
+    def test_streams_followed_authors(self):
+        self.asgi.pool = FakePool([{'user_being_followed_id': 2}])
+
+        sent = self.run_stream(self.headers(1), publish=[
+            event(5, author_id=2), event(6, author_id=3),
+            event(7, author_id=1)], expect=2)
+
+        self.assertEqual(sent[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'),
+                      sent[0]['headers'])
+        self.assertEqual(sent[1]['body'], b'')
+        self.assertEqual([message['body'] for message in sent[2:]],
+                         [stream.encode(event(5, author_id=2)),
+                          stream.encode(event(7, author_id=1))])
+        self.assertEqual(stream.hub.subscriber_count(), 0)
+
+    def test_reconnect_replays(self):
+        for msg_id in (5, 6):
+            stream.hub.publish(event(msg_id, author_id=2))
+        self.asgi.pool = FakePool([{'user_being_followed_id': 2}])
+
+        sent = self.run_stream(self.headers(1, last_event_id=5))
+
+        self.assertEqual(sent[1]['body'], stream.encode(event(6, 2)))
+
+        self.asgi.pool = FakePool([{'user_being_followed_id': 2}])
+        sent = self.run_stream(self.headers(1, last_event_id=1))
+
+        self.assertTrue(sent[1]['body'].startswith(stream.RESET))
@@ -0,0 +1,184 @@
+"""Trending tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import threading
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Message, TrendingSummary
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import trending
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app.config['WTF_CSRF_ENABLED'] = False
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class CountersTestCase(TestCase):
+    """Test the sketch and the sliding window."""
+
+    def test_sketch(self):
+        sketch = trending.CountMinSketch(width=64, depth=3)
+
+        for i in range(100):
+            sketch.add(f"key{i}")
+        sketch.add('hot', 50)
+
+        self.assertGreaterEqual(sketch.estimate('hot'), 50)
+        self.assertLess(sketch.estimate('hot'), 60)
+
+    def test_window_slides(self):
+        """Counts age out bucket by bucket."""
+
+        window = trending.SlidingTopK(window=60, buckets=6)
+
+        window.add('old', 5, now=0)
+        window.add('new', 3, now=30)
+
+        self.assertEqual(window.top(2, now=30), [('old', 5), ('new', 3)])
+        self.assertEqual(window.top(2, now=65), [('new', 3)])
+        self.assertEqual(window.top(2, now=1000), [])
+
+    def test_candidates_bounded(self):
+        window = trending.SlidingTopK(candidates=10)
+
+        for i in range(1000):
+            window.add(i, 1 + (i == 500) * 100, now=0)
+
+        self.assertLessEqual(len(window.candidates), 20)
+        self.assertEqual(window.top(1, now=0)[0][0], 500)
+
+    def test_parse_tags(self):
+        self.assertEqual(
+            trending.parse_tags("#Flask and #flask with @joel, #py!"),
+            ({'flask', 'py'}, {'joel'}))
+
+
+class TrendingViewTestCase(testsupport.DatabaseTestCase):
+    """Test counting site activity and serving /trending."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        # Also starts fresh counters and forgets the idempotency keys of
+        # messages posted by earlier tests.
+        super().setUp()
+        self.tu1_id = self.testuser.id
+        self.tu2_id = self.testuser2.id
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_trending(self):
+        with app.test_client() as c:
+            self.login(c, self.tu1_id)
+            c.post('/messages/new', data={'text': "#Warbler hi @testuser2"})
+            c.post('/messages/new', data={'text': "more #warbler #news"})
+
+            msg_id = Message.query.order_by(Message.id).first().id
+            self.login(c, self.tu2_id)
+            c.post(f'/users/add_like/{msg_id}')
+
+            html = c.get('/trending').get_data(as_text=True)
+            data = c.get('/api/v1/trending').get_json()
+
+        self.assertIn('#warbler', html)
+        self.assertEqual(data['hashtags'], [
+            {'tag': 'warbler', 'count': 2}, {'tag': 'news', 'count': 1}])
+        self.assertEqual([(u['username'], u['count'])
+                          for u in data['mentions']], [('testuser2', 1)])
+        self.assertEqual([(m['id'], m['count']) for m in data['messages']],
+                         [(msg_id, 1)])
+
+    def test_flush_and_serve_summary(self):
+        """A process with no counts of its own serves the last flush."""
+
+        with app.app_context():
+            trending.counters.record('hashtags', ['a', 'b'])
+            trending.counters.record('hashtags', ['a'])
+            trending.counters.flush()
+
+            fresh = trending.Trending()
+            self.assertEqual(fresh.top('hashtags'), [('a', 2), ('b', 1)])
+
+        self.assertEqual(TrendingSummary.query.count(), 2)
+
+    def test_merge_processes(self):
+        """Each process's latest flush counts; dead processes' don't."""
+
+        with app.app_context():
+            one, two = trending.Trending(), trending.Trending()
+            one.record('hashtags', ['a', 'b'])
+            one.flush()
+            two.record('hashtags', ['a'])
+            two.record('hashtags', ['c'], n=3)
+            two.flush()
+            db.session.add(TrendingSummary(
+                source='gone', kind='hashtags', key='d', count=100,
+                window_end=datetime.utcnow() - timedelta(hours=1)))
+            db.session.commit()
+
+            one.record('hashtags', ['b'])
+            self.assertEqual(one.top('hashtags'),
+                             [('c', 3), ('a', 2), ('b', 2)])
+            self.assertEqual(trending.Trending().top('hashtags'),
+                             [('c', 3), ('a', 2), ('b', 1)])
+
+    def test_concurrent_flush_skipped(self):
+        with app.app_context():
+            counters = trending.counters
+            counters.record('hashtags', ['a'])
+            counters.flushed_at = 0
+
+            with counters._flushing:
+                counters.maybe_flush()
+            self.assertEqual(TrendingSummary.query.count(), 0)
+
+            counters.maybe_flush()
+            self.assertEqual(TrendingSummary.query.count(), 1)
+
+    def test_quiet_process_flushes(self):
+        """The flusher thread flushes without new events."""
+
+        flushed = threading.Event()
+
+        class Recording(trending.Trending):
+            def flush(self, now=None):
+                self.flushed_at = now or 0
+                if threading.current_thread().name == 'warbler-trending':
+                    flushed.set()
+
+        app.config.update(TRENDING_AUTOFLUSH=True,
+                          TRENDING_FLUSH_INTERVAL=0.01)
+        counters = Recording()
+        try:
+            with app.app_context():
+                counters.record('hashtags', ['a'])
+                counters.maybe_flush()
+            self.assertTrue(flushed.wait(5))
+        finally:
+            counters.stop()
+            del app.config['TRENDING_AUTOFLUSH']
+            del app.config['TRENDING_FLUSH_INTERVAL']
@@ -5,17 +5,15 @@
 #    python -m unittest test_user_model.py
 
 
-import os
-from unittest import TestCase
-
-from models import db, User, Message, Follows
+from models import db, User, Follows
+import testsupport
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+testsupport.use_test_database()
 
 # Now we can import app
 if True:
@@ -26,41 +24,25 @@ app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 # Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-db.drop_all()
-db.create_all()
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(testsupport.DatabaseTestCase):
     """Test views for messages."""
 
+    seed_users = ('testuser', 'testuser2')
+
     def setUp(self):
         """Create test client, add sample data."""
 
-        self.testuser = User.signup(username="testuser",
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None)
-
-        self.testuser2 = User.signup(username="testuser2",
-                                     email="test2@test.com",
-                                     password="testuser2",
-                                     image_url=None)
-        db.session.commit()
-
+        super().setUp()
         self.tu1_id = self.testuser.id
         self.tu2_id = self.testuser2.id
 
         self.client = app.test_client()
 
-    #
-    def tearDown(self):
-        db.session.rollback()
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-
     #
     def test_user_model(self):
         """Does basic model work?"""
@@ -168,3 +150,34 @@ class UserModelTestCase(TestCase):
             f'<User #{self.tu1_id}: {self.testuser.username}, {self.testuser.email}>'  # NOQA E501
 
         self.assertEqual(self.testuser.__repr__(), desired_repr)
+
+    #
+    def test_follow_many(self):
+        """Test follow_many follows new users and reports the rest."""
+
+        results = Follows.follow_many(self.tu1_id,
+                                      [self.tu2_id, self.tu1_id, 999999])
+        db.session.commit()
+
+        self.assertEqual(results, {self.tu2_id: 'followed',
+                                   self.tu1_id: 'self',
+                                   999999: 'not_found'})
+        self.assertTrue(User.query.get(self.tu1_id).is_following(
+            User.query.get(self.tu2_id)))
+
+        results = Follows.follow_many(self.tu1_id, [self.tu2_id])
+        self.assertEqual(results, {self.tu2_id: 'already_following'})
+
+    #
+    def test_unfollow_many(self):
+        """Test unfollow_many removes only existing edges."""
+
+        Follows.follow_many(self.tu1_id, [self.tu2_id])
+        db.session.commit()
+
+        results = Follows.unfollow_many(self.tu1_id, [self.tu2_id, 999999])
+        db.session.commit()
+
+        self.assertEqual(results, {self.tu2_id: 'unfollowed',
+                                   999999: 'not_following'})
+        self.assertEqual(Follows.query.count(), 0)
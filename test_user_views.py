@@ -6,19 +6,19 @@ User View tests.
 #    python -m unittest test_user_views.py
 """
 
-import os
-from unittest import TestCase
 
-from models import db, User, Message
+from models import db, User, Message, Follows
+import testsupport
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
 # before we import our app, since that will have already
 # connected to the database
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+testsupport.use_test_database()
 
 # formatter was moving this so...
 if True:
+    import queries
     from app import app, CURR_USER_KEY
 
 app.config['SQLALCHEMY_ECHO'] = False
@@ -26,42 +26,26 @@ app.config['TESTING'] = True
 app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
 
 # Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-db.drop_all()
-db.create_all()
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
 
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class UserViewsTestCase(TestCase):
+class UserViewsTestCase(testsupport.DatabaseTestCase):
     """Test User views including signup, login, logout."""
 
+    seed_users = ('testuser', 'testuser2')
+
     def setUp(self):
         """Create test client, add sample data."""
 
+        super().setUp()
         self.client = app.test_client()
-
-        self.testuser = User.signup(username="testuser",
-                                    email="test@test.com",
-                                    password="testuser",
-                                    image_url=None)
-
-        self.testuser2 = User.signup(username="testuser2",
-                                     email="test2@test.com",
-                                     password="testuser2",
-                                     image_url=None)
-        db.session.commit()
-
         self.tu2_id = self.testuser2.id
 
-    def tearDown(self):
-        """Clean up any fouled transaction."""
-
-        db.session.rollback()
-        User.query.delete()
-
     def test_sign_up(self):
         """Can user sign up?"""
 
@@ -155,6 +139,35 @@ class UserViewsTestCase(TestCase):
             html = resp.get_data(as_text=True)
             self.assertIn('testuser2', html)
 
+    def test_following_view_paginates(self):
+        """Test following view pages through a long list."""
+
+        followed = [User(username=f"followed{i}", email=f"f{i}@test.com",
+                         password="x") for i in range(queries.PAGE_SIZE + 1)]
+        db.session.add_all(followed)
+        db.session.commit()
+        Follows.follow_many(self.testuser.id, [u.id for u in followed])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f'/users/{self.testuser.id}/following')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('followed0<', html)
+            self.assertNotIn(f'followed{queries.PAGE_SIZE}<', html)
+            self.assertIn('?after=', html)
+
+            cursor = html.split('?after=')[1].split('"')[0]
+            resp = c.get(f'/users/{self.testuser.id}/following?after={cursor}')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f'followed{queries.PAGE_SIZE}<', html)
+            self.assertNotIn('followed0<', html)
+            self.assertNotIn('?after=', html)
+
     def test_followers_view_restricted(self):
         """Test followers view. Should show those following user."""
 
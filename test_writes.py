@@ -0,0 +1,159 @@
+"""Write buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_writes.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+import testsupport
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+testsupport.use_test_database()
+
+# Now we can import app
+if True:
+    import writes
+    from app import app, CURR_USER_KEY
+
+app.config['SQLALCHEMY_ECHO'] = False
+app.config['TESTING'] = True
+app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- each test runs in a transaction that's
+# rolled back afterwards, so there's nothing to clean up)
+testsupport.create_schema()
+
+
+class WriteBufferTestCase(testsupport.DatabaseTestCase):
+    """Test buffering, coalescing and flushing likes and follows."""
+
+    seed_users = ('testuser', 'testuser2')
+
+    def setUp(self):
+        super().setUp()
+        app.config['WRITE_BUFFER_ENABLED'] = True
+        writes.buffer.stats.clear()
+        self.tu1_id = self.testuser.id
+        self.tu2_id = self.testuser2.id
+
+        msg = Message(text="Like me", user_id=self.tu2_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def tearDown(self):
+        app.config['WRITE_BUFFER_ENABLED'] = False
+        writes.buffer.stop()
+        super().tearDown()
+
+    def client(self):
+        c = app.test_client()
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.tu1_id
+        return c
+
+    def test_toggles_coalesce(self):
+        with self.client() as c:
+            for _ in range(3):
+                c.post(f'/users/add_like/{self.msg_id}')
+
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(len(writes.buffer), 1)
+
+            with app.app_context():
+                self.assertEqual(writes.buffer.flush(), 1)
+
+            c.post(f'/users/add_like/{self.msg_id}')
+            c.post(f'/users/add_like/{self.msg_id}')
+
+            with app.app_context():
+                self.assertEqual(writes.buffer.flush(), 0)
+
+        self.assertEqual(
+            [(like.user_id, like.message_id) for like in Likes.query],
+            [(self.tu1_id, self.msg_id)])
+
+        metrics = writes.buffer.metrics()
+        self.assertEqual(metrics['writes'], 5)
+        self.assertEqual(metrics['coalesced'], 3)
+        self.assertEqual(metrics['flushes'], 2)
+        self.assertEqual(metrics['pending'], 0)
+        self.assertIn('mean_flush_ms', metrics)
+
+    def test_reads_own_writes(self):
+        with self.client() as c:
+            c.post(f'/users/follow/{self.tu2_id}')
+            profile = c.get(f'/users/{self.tu2_id}').get_data(as_text=True)
+            self.assertIn('Unfollow', profile)
+            self.assertEqual(Follows.query.count(), 0)
+
+            c.post(f'/users/add_like/{self.msg_id}')
+            home = c.get('/').get_data(as_text=True)
+            self.assertIn('btn-primary', home)
+            self.assertEqual(Likes.query.count(), 0)
+
+            following = c.get(f'/users/{self.tu1_id}/following')
+
+        # Listing their own follows wrote them first.
+        self.assertIn('@testuser2', following.get_data(as_text=True))
+        self.assertEqual(Follows.query.count(), 1)
+
+    def test_followers_list_shows_own_follow(self):
+        with self.client() as c:
+            c.post(f'/users/follow/{self.tu2_id}')
+            followers = c.get(f'/users/{self.tu2_id}/followers')
+
+        self.assertIn('<p>@testuser</p>', followers.get_data(as_text=True))
+        self.assertEqual(Follows.query.count(), 1)
+
+    def test_flush_skips_vanished_rows(self):
+        with self.client() as c:
+            c.post(f'/users/add_like/{self.msg_id}')
+            c.post(f'/users/follow/{self.tu2_id}')
+
+        Message.query.filter_by(id=self.msg_id).delete()
+        User.query.get(self.tu2_id).deleted_at = db.func.now()
+        db.session.commit()
+
+        with app.app_context():
+            self.assertEqual(writes.buffer.flush(), 0)
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+
+class JournalTestCase(TestCase):
+    """Test replaying the journal of a dead process."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_orphans_replayed(self):
+        with open(os.path.join(self.directory, '999999.log'), 'w') as f:
+            f.write(json.dumps([1, 'follow', 2, True]) + '\n')
+            f.write(json.dumps([1, 'follow', 2, False]) + '\n')
+            f.write('[1, "like"')
+
+        live = writes.Journal(self.directory, fsync=False)
+        live.append(3, 'like', 4, True)
+
+        recovered = writes.Journal(self.directory, fsync=False).orphans()
+
+        self.assertEqual(recovered, [(1, 'follow', 2, True),
+                                     (1, 'follow', 2, False)])
+        self.assertEqual(os.listdir(self.directory), [f"{os.getpid()}.log"])
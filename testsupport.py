@@ -0,0 +1,231 @@
+"""Test database setup and transactional test cases.
+
+Every test module calls `use_test_database()` before importing the app.
+WARBLER_TEST_DB picks the database:
+
+- unset or "postgres": the local `warbler-test` database (the default)
+- "sqlite": a SQLite file in the temp directory
+- "memory": an in-memory SQLite database
+- anything else: used as the database URL
+
+Under pytest-xdist each worker gets a database of its own (the worker id
+is appended to the database name), so the suite can run in parallel:
+
+    WARBLER_TEST_DB=sqlite python -m pytest -n 4
+
+Missing Postgres databases are created. `create_schema()` builds the
+tables once per process, however many modules ask for them.
+
+`DatabaseTestCase` runs each test inside a transaction that's rolled
+back afterwards. The code under test commits and rolls back as usual,
+against a savepoint, so nothing needs deleting in tearDown and no test
+sees another's rows. Classes list the seed users they want in
+`seed_users`; the rows (with their password hashes, which are what makes
+signing up slow) are built once per process and inserted into each
+test's transaction, and each user is set as an attribute named after it.
+
+Code that opens its own connection (`db.engine`) works outside the test
+transaction and doesn't see its rows. On in-memory SQLite there's only
+one connection, so tests that need that belong on a file database.
+"""
+
+import functools
+import os
+import sqlite3
+import tempfile
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, orm, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+
+from models import bcrypt, db, User
+
+POSTGRES_URL = 'postgresql:///warbler-test'
+
+# username: (email, password)
+SEED_USERS = {
+    'testuser': ("test@test.com", "testuser"),
+    'testuser2': ("test2@test.com", "testuser2"),
+}
+
+
+def database_url():
+    """The database URL for this test process."""
+
+    choice = os.environ.get('WARBLER_TEST_DB', 'postgres')
+    worker = os.environ.get('PYTEST_XDIST_WORKER', '')
+
+    if choice == 'memory':
+        return 'sqlite://'
+    if choice == 'sqlite':
+        name = f"warbler-test{'-' + worker if worker else ''}.db"
+        return f"sqlite:///{os.path.join(tempfile.gettempdir(), name)}"
+
+    url = make_url(POSTGRES_URL if choice == 'postgres' else choice)
+    if worker and url.database:
+        url.database = f"{url.database}-{worker}"
+    return str(url)
+
+
+def _create_database(url):
+    """Create the Postgres database at `url` if it doesn't exist."""
+
+    url = make_url(url)
+    if url.get_backend_name() != 'postgresql':
+        return
+
+    name = url.database
+    url.database = 'postgres'
+    engine = create_engine(url, isolation_level='AUTOCOMMIT')
+    try:
+        with engine.connect() as conn:
+            exists = conn.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                name=name).scalar()
+            if not exists:
+                conn.execute(f'CREATE DATABASE "{name}"')
+    finally:
+        engine.dispose()
+
+
+def use_test_database():
+    """Point the app about to be imported at this process's database."""
+
+    url = database_url()
+    _create_database(url)
+
+    os.environ['DATABASE_URL'] = url
+    os.environ['WARBLER_PROFILE'] = "testing"
+
+
+##############################################################################
+# SQLite savepoints
+#
+# pysqlite begins transactions lazily and commits on its own before DDL,
+# which breaks SAVEPOINT. Take transaction handling away from the driver
+# and emit BEGIN ourselves.
+
+
+@event.listens_for(Engine, 'connect')
+def _sqlite_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.isolation_level = None
+
+
+@event.listens_for(Engine, 'begin')
+def _sqlite_begin(conn):
+    if conn.dialect.name == 'sqlite':
+        conn.execute("BEGIN")
+
+
+##############################################################################
+# Schema and seeds
+
+
+@functools.lru_cache(maxsize=None)
+def create_schema():
+    """Drop and create the tables, once per process."""
+
+    db.drop_all()
+    db.create_all()
+
+
+@functools.lru_cache(maxsize=None)
+def _seed_row(username):
+    email, password = SEED_USERS[username]
+    return dict(username=username,
+                email=email,
+                password=bcrypt.generate_password_hash(password).decode())
+
+
+def reset_state(app):
+    """Forget what earlier tests left in this process's memory."""
+
+    import jobs
+    import notifications
+    import sessions
+    import stream
+    import trending
+    import views
+    import writes
+
+    jobs.queue.stop()
+    writes.buffer.stop()
+    notifications.buffer.stop()
+    notifications.unread.clear()
+    views.profile_reads.clear()
+    stream.hub.clear()
+    trending.counters.stop()
+    trending.counters = trending.Trending()
+    if isinstance(app.session_interface, sessions.ServerSessionInterface):
+        app.session_interface.store = sessions.MemoryStore()
+
+
+##############################################################################
+# Transactional tests
+
+
+class _PinnedSession(orm.scoped_session):
+    """The one session of a test, whoever asks for it.
+
+    The app removes its session after every request; here that forgets
+    its objects and rolls back to the savepoint instead, as closing a
+    real session would.
+    """
+
+    def remove(self):
+        if self.registry.has():
+            session = self.registry()
+            session.expunge_all()
+            session.rollback()
+
+
+def _restart_savepoint(session, transaction):
+    if transaction.nested and not transaction._parent.nested:
+        session.expire_all()
+        session.begin_nested()
+
+
+class DatabaseTestCase(TestCase):
+    """A test run inside a transaction that's rolled back afterwards."""
+
+    seed_users = ()
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        create_schema()
+
+    def setUp(self):
+        from app import app
+
+        reset_state(app)
+
+        self._original_session = db.session
+        self._connection = db.engine.connect()
+        self._transaction = self._connection.begin()
+
+        factory = db.create_session({'bind': self._connection, 'binds': {}})
+        db.session = _PinnedSession(factory, scopefunc=lambda: None)
+        self._session = db.session()
+        self._session.begin_nested()
+        event.listen(self._session, 'after_transaction_end',
+                     _restart_savepoint)
+
+        if self.seed_users:
+            users = [User(**_seed_row(username))
+                     for username in self.seed_users]
+            db.session.add_all(users)
+            db.session.commit()
+            for user in users:
+                setattr(self, user.username, user)
+
+    def tearDown(self):
+        event.remove(self._session, 'after_transaction_end',
+                     _restart_savepoint)
+        self._session.close()
+        db.session = self._original_session
+
+        self._transaction.rollback()
+        self._connection.close()
@@ -0,0 +1,407 @@
+"""Trending hashtags, mentions and messages for Warbler.
+
+Counts are kept in memory over a sliding window (an hour by default) cut
+into time buckets. Each tracked kind has a Count-Min sketch per bucket
+and one for the whole window. A new event adds to the current bucket
+and to the window. When a bucket ages out, its sketch is subtracted
+from the window and reused. Only the `CANDIDATES` keys with the highest
+window estimates are remembered as possible top-k entries. Memory is
+therefore fixed, whether a hundred or a million distinct hashtags turn
+up in an hour.
+
+- hashtags: `#tags` parsed from posted messages, lowercased.
+- mentions: `@usernames` parsed from posted messages.
+- messages: message ids, counted by likes (unlikes subtract).
+
+Events come in through the job queue, so with the default in-process
+queue every web process counts only the events of its own requests.
+Each counting process flushes its current top entries to the `trending`
+summary table every TRENDING_FLUSH_INTERVAL seconds under its own
+`source`. A flusher thread keeps flushing while no new events arrive, so
+a quiet process's entries still age. Reads add this process's own live
+counts to the latest flush of every other process. A process's flushes
+stop counting once they are two intervals old, when it has died or has
+nothing left in its window. A process that hasn't counted anything (a
+web worker when jobs run in a separate worker) serves the other
+processes' flushes alone.
+
+Merging summaries is approximate: each process flushes only its
+`FLUSH_ENTRIES` heaviest keys per kind, so a key spread thinly over many
+processes can be missed, and other processes' counts are up to a flush
+interval old.
+
+Config:
+
+- TRENDING_FLUSH_INTERVAL: seconds between flushes (default 60).
+- TRENDING_RETENTION_DAYS: days of summaries kept (default 7).
+- TRENDING_AUTOFLUSH: run the flusher thread (default: on unless the app
+  is TESTING; tests call `counters.flush()`).
+"""
+
+import operator
+import os
+import re
+import socket
+import threading
+import time
+from array import array
+from collections import Counter
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, func
+
+import jobs
+import queries
+from models import db, Message, TrendingSummary
+
+WINDOW_SECONDS = 3600
+BUCKETS = 12
+
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+
+# Keys per kind kept as possible top-k entries.
+CANDIDATES = 200
+
+TOP_K = 10
+
+# Keys per kind each process writes to the summary table.
+FLUSH_ENTRIES = 50
+
+KINDS = ('hashtags', 'mentions', 'messages')
+
+HASHTAG_RE = re.compile(r'#(\w{1,50})')
+MENTION_RE = re.compile(r'@(\w{1,50})')
+
+
+class CountMinSketch:
+    """Approximate counts for any number of keys in fixed memory.
+
+    Estimates never undercount while all counts stay non-negative, and
+    overcount by at most a small fraction of the total.
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = array('i', bytes(4 * width * depth))
+
+    def _cells(self, key):
+        return [row * self.width + hash((row, key)) % self.width
+                for row in range(self.depth)]
+
+    def add(self, key, n=1):
+        """Add `n` to `key`'s count; returns the new estimate."""
+
+        table = self.table
+        cells = self._cells(key)
+        for cell in cells:
+            table[cell] += n
+
+        return min(table[cell] for cell in cells)
+
+    def estimate(self, key):
+        return min(self.table[cell] for cell in self._cells(key))
+
+    def subtract(self, other):
+        """Remove another sketch's counts from this one."""
+
+        self.table = array('i', map(operator.sub, self.table, other.table))
+
+    def clear(self):
+        self.table = array('i', bytes(4 * self.width * self.depth))
+
+
+class SlidingTopK:
+    """Heaviest keys over the last `window` seconds."""
+
+    def __init__(self, window=WINDOW_SECONDS, buckets=BUCKETS,
+                 candidates=CANDIDATES):
+        self.bucket_seconds = window / buckets
+        self.buckets = [CountMinSketch() for _ in range(buckets)]
+        self.window = CountMinSketch()
+        self.candidates = {}
+        self.max_candidates = candidates
+        self.current = None
+
+    def _advance(self, now):
+        """Expire buckets that have slid out of the window."""
+
+        bucket = int(now // self.bucket_seconds)
+
+        if self.current is None or bucket - self.current >= len(self.buckets):
+            for sketch in self.buckets:
+                sketch.clear()
+            self.window.clear()
+            self.candidates.clear()
+            self.current = bucket
+            return
+
+        while self.current < bucket:
+            self.current += 1
+            expired = self.buckets[self.current % len(self.buckets)]
+            self.window.subtract(expired)
+            expired.clear()
+
+    def add(self, key, n, now):
+        self._advance(now)
+        self.buckets[self.current % len(self.buckets)].add(key, n)
+        self.candidates[key] = self.window.add(key, n)
+
+        if len(self.candidates) > 2 * self.max_candidates:
+            self._prune()
+
+    def _prune(self):
+        estimates = sorted(
+            ((self.window.estimate(key), key) for key in self.candidates),
+            key=operator.itemgetter(0), reverse=True)
+        self.candidates = {key: count for count, key in
+                           estimates[:self.max_candidates] if count > 0}
+
+    def top(self, k, now):
+        """`(key, estimated count)` for the top `k` keys, heaviest first."""
+
+        self._advance(now)
+        estimates = ((key, self.window.estimate(key))
+                     for key in self.candidates)
+        ranked = sorted((pair for pair in estimates if pair[1] > 0),
+                        key=lambda pair: -pair[1])
+
+        return ranked[:k]
+
+
+class Trending:
+    """Sliding-window counters for every trending kind."""
+
+    def __init__(self, window=WINDOW_SECONDS, buckets=BUCKETS):
+        self.trackers = {kind: SlidingTopK(window, buckets) for kind in KINDS}
+        self.recorded = False
+        self.flushed_at = time.time()
+
+        self._lock = threading.Lock()
+        self._flushing = threading.Lock()
+        self._stopped = threading.Event()
+        self._pid = None
+        self._summaries = {}
+
+    @property
+    def source(self):
+        """This process's name in the summary table."""
+
+        return f"{socket.gethostname()}:{os.getpid()}:{id(self):x}"
+
+    def record(self, kind, keys, n=1, now=None):
+        """Count `n` occurrences of each of `keys`."""
+
+        now = time.time() if now is None else now
+
+        with self._lock:
+            for key in keys:
+                self.trackers[kind].add(key, n, now)
+            self.recorded = True
+
+    def top(self, kind, k=TOP_K, now=None):
+        """Top `k` `(key, count)` pairs for `kind`, heaviest first."""
+
+        merged = Counter(dict(self._summary(kind)))
+        for key, count in self._own_top(kind, FLUSH_ENTRIES, now):
+            merged[key] += count
+
+        ranked = sorted((pair for pair in merged.items() if pair[1] > 0),
+                        key=lambda pair: -pair[1])
+
+        return ranked[:k]
+
+    def _own_top(self, kind, k, now=None):
+        """Top `k` of this process's own counts for `kind`."""
+
+        if not self.recorded:
+            return []
+
+        now = time.time() if now is None else now
+        with self._lock:
+            return self.trackers[kind].top(k, now)
+
+    ##########################################################################
+    # Summary table
+
+    def flush(self, now=None):
+        """Write this process's top entries of every kind to `trending`."""
+
+        now = time.time() if now is None else now
+        window_end = datetime.utcnow()
+        retention = timedelta(
+            days=current_app.config.get('TRENDING_RETENTION_DAYS', 7))
+
+        source = self.source
+        rows = [
+            {'source': source, 'kind': kind, 'key': str(key), 'count': count,
+             'window_end': window_end}
+            for kind in KINDS
+            for key, count in self._own_top(kind, FLUSH_ENTRIES, now)
+        ]
+
+        if rows:
+            db.session.execute(TrendingSummary.__table__.insert(), rows)
+        (TrendingSummary.query
+         .filter(TrendingSummary.window_end < window_end - retention)
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+        self.flushed_at = now
+
+    def maybe_flush(self):
+        """Flush if an interval has passed since the last flush, unless
+        another thread is flushing already."""
+
+        if current_app.config.get('TRENDING_AUTOFLUSH',
+                                  not current_app.testing):
+            self.start(current_app._get_current_object())
+
+        interval = current_app.config.get('TRENDING_FLUSH_INTERVAL', 60)
+        if time.time() - self.flushed_at < interval:
+            return
+
+        if not self._flushing.acquire(blocking=False):
+            return
+        try:
+            if time.time() - self.flushed_at >= interval:
+                self.flush()
+        finally:
+            self._flushing.release()
+
+    def start(self, app):
+        """Start the flusher thread in this process if not running."""
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+        threading.Thread(target=self._run, args=(app,), daemon=True,
+                         name='warbler-trending').start()
+
+    def _run(self, app):
+        interval = app.config.get('TRENDING_FLUSH_INTERVAL', 60)
+
+        while not self._stopped.wait(interval):
+            if self._pid != os.getpid():
+                return
+
+            with app.app_context():
+                try:
+                    self.maybe_flush()
+                except Exception:
+                    app.logger.exception("Trending flush failed")
+
+    def stop(self):
+        """Stop the flusher thread."""
+
+        self._pid = None
+        self._stopped.set()
+
+    def _summary(self, kind):
+        """Other processes' latest flushed entries for `kind`, summed and
+        cached for a flush interval."""
+
+        interval = current_app.config.get('TRENDING_FLUSH_INTERVAL', 60)
+        cached = self._summaries.get(kind)
+        if cached and time.time() - cached[0] < interval:
+            return cached[1]
+
+        cutoff = datetime.utcnow() - timedelta(seconds=2 * interval)
+        latest = (db.session
+                  .query(TrendingSummary.source,
+                         func.max(TrendingSummary.window_end)
+                         .label('window_end'))
+                  .filter(TrendingSummary.kind == kind,
+                          TrendingSummary.window_end >= cutoff,
+                          TrendingSummary.source != self.source)
+                  .group_by(TrendingSummary.source)
+                  .subquery())
+        total = func.sum(TrendingSummary.count)
+        rows = (db.session
+                .query(TrendingSummary.key, total.label('count'))
+                .join(latest, and_(
+                    TrendingSummary.source == latest.c.source,
+                    TrendingSummary.window_end == latest.c.window_end))
+                .filter(TrendingSummary.kind == kind,
+                        TrendingSummary.window_end >= cutoff)
+                .group_by(TrendingSummary.key)
+                .order_by(total.desc())
+                .limit(FLUSH_ENTRIES)
+                .all())
+
+        convert = int if kind == 'messages' else str
+        pairs = [(convert(row.key), int(row.count)) for row in rows]
+        self._summaries[kind] = (time.time(), pairs)
+
+        return pairs
+
+
+counters = Trending()
+
+
+def parse_tags(text):
+    """Distinct lowercased hashtags and distinct mentions in `text`."""
+
+    hashtags = {tag.lower() for tag in HASHTAG_RE.findall(text)}
+    mentions = set(MENTION_RE.findall(text))
+
+    return hashtags, mentions
+
+
+def current(k=TOP_K):
+    """What's trending, with messages and users loaded for display.
+
+    Returns `{'hashtags': [(tag, count)], 'mentions': [(card, count)],
+    'messages': [(row, count)]}`.
+    """
+
+    hashtags = counters.top('hashtags', k)
+
+    mentions = dict(counters.top('mentions', k))
+    cards = queries.user_cards_by_username(list(mentions))
+
+    liked = dict(counters.top('messages', k))
+    messages = queries.messages_by_ids(list(liked))
+
+    return {
+        'hashtags': hashtags,
+        'mentions': [(card, mentions[card.username]) for card in cards],
+        'messages': [(row, liked[row.id]) for row in messages],
+    }
+
+
+@jobs.on('message_posted')
+def count_tags(message_id, user_id):
+    text = (db.session.query(Message.text)
+            .filter(Message.id == message_id)
+            .scalar())
+    if text is None:
+        return
+
+    hashtags, mentions = parse_tags(text)
+    counters.record('hashtags', hashtags)
+    counters.record('mentions', mentions)
+    counters.maybe_flush()
+
+
+@jobs.on('like_added')
+def count_like(user_id, message_id, author_id):
+    counters.record('messages', [message_id])
+    counters.maybe_flush()
+
+
+@jobs.on('like_removed')
+def count_unlike(user_id, message_id, author_id):
+    counters.record('messages', [message_id], n=-1)
+    counters.maybe_flush()
+
+
+@jobs.on('likes_removed')
+def count_unlikes(user_id, likes):
+    counters.record('messages', [message_id for message_id, author_id
+                                 in likes], n=-1)
+    counters.maybe_flush()
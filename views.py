@@ -0,0 +1,682 @@
+"""The site's pages: signup and login, users, messages and the home page."""
+
+from flask import (
+    Blueprint, current_app, render_template, request, flash,
+    redirect, session, url_for, g, abort
+)
+from sqlalchemy.exc import IntegrityError
+
+import accounts
+import activity
+import graph
+import jobs
+import notifications
+import queries
+import recommendations
+import sessions
+import singleflight
+import trending
+import writes
+from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
+from models import db, User, Message, Follows, Likes
+from pagecache import page_cache
+
+CURR_USER_KEY = "curr_user"
+
+views = Blueprint('views', __name__)
+
+
+##############################################################################
+# User signup/login/logout
+
+
+@views.before_app_request
+def add_user_to_g():
+    """If we're logged in, add curr user to Flask global.
+
+    `g.user` comes from the snapshot stored in the session at login; the
+    users table is only queried when a view needs more than that.
+    """
+
+    g.user = sessions.current_user(CURR_USER_KEY)
+
+    if g.user is None and CURR_USER_KEY in session:
+        do_logout()
+
+
+def do_login(user):
+    """Log in user."""
+
+    session.regenerate()
+    session[CURR_USER_KEY] = user.id
+    session[sessions.SNAPSHOT_KEY] = sessions.snapshot(user)
+
+
+def do_logout():
+    """Logout user."""
+
+    session.pop(CURR_USER_KEY, None)
+    session.pop(sessions.SNAPSHOT_KEY, None)
+
+
+@views.route('/signup', methods=["GET", "POST"])
+def signup():
+    """Handle user signup.
+
+    Create new user and add to DB. Redirect to home page.
+
+    If form not valid, present form.
+
+    If the there already is a user with that username: flash message
+    and re-present form.
+    """
+
+    form = UserAddForm()
+
+    if form.validate_on_submit():
+        try:
+            user = User.signup(
+                username=form.username.data,
+                password=form.password.data,
+                email=form.email.data,
+                image_url=form.image_url.data or User.image_url.default.arg,
+            )
+            db.session.commit()
+
+        except IntegrityError:
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        do_login(user)
+
+        return redirect("/")
+
+    else:
+        return render_template('users/signup.html', form=form)
+
+
+@views.route('/login', methods=["GET", "POST"])
+def login():
+    """Handle user login."""
+
+    form = LoginForm()
+
+    if form.validate_on_submit():
+        user = User.authenticate(form.username.data,
+                                 form.password.data)
+
+        if user:
+            do_login(user)
+            flash(f"Hello, {user.username}!", "success")
+            return redirect("/")
+
+        flash("Invalid credentials.", 'danger')
+
+    return render_template('users/login.html', form=form)
+
+
+@views.route('/logout')
+def logout():
+    """Handle logout of user."""
+
+    do_logout()
+    flash(f"{g.user.username} Logged Out", "success")
+
+    return redirect(url_for('views.login'))
+
+
+##############################################################################
+# General user routes:
+
+@views.route('/users')
+def list_users():
+    """Page with listing of users.
+
+    Can take a 'q' param in querystring to search by that username.
+    """
+
+    users = queries.user_directory(request.args.get('q'))
+
+    return render_template(
+        'users/index.html', users=users,
+        followed_ids=followed_by_viewer([user.id for user in users]))
+
+
+@views.route('/users/<int:user_id>')
+@page_cache.cached
+def users_show(user_id):
+    """Show user profile."""
+
+    page_cache.tag(f"user:{user_id}")
+    settle_own_writes(user_id)
+    user = profile_or_404(user_id)
+
+    messages = shared_read(
+        f"messages:{user_id}", user_id,
+        lambda: queries.user_messages(user_id, limit=100)[0])
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           followed_ids=followed_by_viewer([user_id]))
+
+
+@views.route('/users/<int:user_id>/archive')
+def user_archive(user_id):
+    """Show a user's posting history by month."""
+
+    user = profile_or_404(user_id)
+    years = activity.by_year(activity.months(user_id))
+
+    return render_template('users/archive.html', user=user, years=years,
+                           month=None, messages=[], next_cursor=None,
+                           followed_ids=followed_by_viewer([user_id]))
+
+
+@views.route('/users/<int:user_id>/archive/<int:year>/<int:month>')
+def user_archive_month(user_id, year, month):
+    """Show the messages a user posted in one month, a page at a time."""
+
+    user = profile_or_404(user_id)
+
+    try:
+        start, end = activity.month_bounds(year, month)
+    except ValueError:
+        abort(404)
+
+    messages, next_cursor = queries.month_messages(
+        user_id, start, end, before=before_cursor())
+    years = activity.by_year(activity.months(user_id))
+
+    return render_template('users/archive.html', user=user, years=years,
+                           month=start, messages=messages,
+                           next_cursor=next_cursor,
+                           followed_ids=followed_by_viewer([user_id]))
+
+
+@views.route('/users/<int:user_id>/following')
+def show_following(user_id):
+    """Show list of people this user is following, a page at a time."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    settle_own_writes(user_id)
+    user = profile_or_404(user_id)
+    users, next_cursor = queries.following(user_id, after=after_cursor())
+
+    return render_template(
+        'users/following.html', user=user, users=users,
+        next_cursor=next_cursor,
+        followed_ids=followed_by_viewer([user_id] + [u.id for u in users]))
+
+
+@views.route('/users/<int:user_id>/followers')
+def users_followers(user_id):
+    """Show list of followers of this user, a page at a time."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    # The viewer's own buffered follow may put them on this list.
+    settle_own_writes(g.user.id, writes.FOLLOW)
+    user = profile_or_404(user_id)
+    users, next_cursor = queries.followers(user_id, after=after_cursor())
+
+    return render_template(
+        'users/followers.html', user=user, users=users,
+        next_cursor=next_cursor,
+        followed_ids=followed_by_viewer([user_id] + [u.id for u in users]))
+
+
+@views.route('/users/follow/<int:follow_id>', methods=['POST'])
+def add_follow(follow_id):
+    """Add a follow for the currently-logged-in user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    result = writes.follow(g.user.id, follow_id)
+
+    if result == 'not_found':
+        abort(404)
+
+    if result == 'self':
+        flash("You can't follow yourself.", 'warning')
+        return redirect(url_for('views.users_show', user_id=g.user.id))
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@views.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+def stop_following(follow_id):
+    """Have currently-logged-in-user stop following this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    writes.unfollow(g.user.id, follow_id)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@views.route('/users/profile', methods=["GET", "POST"])
+def edit_profile():
+    """Update profile for current user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = UserEditForm()
+
+    if form.validate_on_submit():
+
+        if not User.authenticate(g.user.username, form.password.data):
+            flash('Password Incorrect Try Again', 'warning')
+            return redirect(url_for('views.homepage'))
+
+        user = g.user.record
+        form = user_form_defaults_logic(form)
+        form.populate_obj(user)
+
+        try:
+            db.session.add(user)
+            db.session.commit()
+        except IntegrityError as e:
+            db.session.rollback()
+            flash(e.message)
+            return redirect(url_for('views.edit_profile'))
+
+        sessions.refresh_user(user)
+        jobs.publish('user_updated', user_id=g.user.id)
+
+        flash('Profile Updated', 'success')
+        return redirect(url_for('views.users_show', user_id=g.user.id))
+
+    form = populate_user_edit_form(form, g.user)
+    return render_template('users/edit.html', form=form)
+
+
+@views.route('/users/delete', methods=["POST"])
+def delete_user():
+    """Delete user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    do_logout()
+
+    # Hide the account now and end its other sessions; its messages,
+    # likes and follows are purged in chunks by a background job.
+    accounts.tombstone(g.user.record)
+
+    return redirect("/signup")
+
+
+##############################################################################
+# Messages routes:
+
+@views.route('/messages/new', methods=["GET", "POST"])
+def messages_add():
+    """Add a message:
+
+    Show form if GET. If valid, update message and redirect to user page.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        jobs.publish('message_posted', key=f"message:{msg.id}",
+                     message_id=msg.id, user_id=g.user.id)
+
+        return redirect(f"/users/{g.user.id}")
+
+    return render_template('messages/new.html', form=form)
+
+
+@views.route('/messages/<int:message_id>', methods=["GET"])
+@page_cache.cached
+def messages_show(message_id):
+    """Show a message."""
+
+    page_cache.tag(f"message:{message_id}")
+    msg = Message.query.get_or_404(message_id)
+    page_cache.tag(f"user:{msg.user_id}")
+
+    return render_template('messages/show.html', message=msg,
+                           followed_ids=followed_by_viewer([msg.user_id]))
+
+
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
+def messages_destroy(message_id):
+    """Delete a message."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    msg = Message.query.get(message_id)
+    author_id = msg.user_id
+    month = msg.timestamp.strftime('%Y-%m')
+    likes = Likes.query.filter(Likes.message_id == message_id).count()
+    db.session.delete(msg)
+    db.session.commit()
+
+    jobs.publish('message_deleted', message_id=message_id, user_id=author_id,
+                 month=month, likes=likes)
+
+    return redirect(f"/users/{g.user.id}")
+
+
+##############################################################################
+# Likes
+
+
+@views.route('/users/add_like/<msg_id>', methods=['POST'])
+def add_like(msg_id):
+    """Like a message"""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    message = Message.query.get_or_404(msg_id)
+    writes.toggle_like(g.user.id, message)
+
+    return redirect(url_for('views.homepage'))
+
+
+@views.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Show messages the user liked."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    settle_own_writes(user_id)
+    user = profile_or_404(user_id)
+    messages = queries.messages_by_ids(
+        [like.message_id for like in queries.likes_query(user_id)])
+
+    return render_template('/users/likes.html', messages=messages, user=user,
+                           likes=liked_by_viewer([msg.id for msg in messages]),
+                           followed_ids=followed_by_viewer([user_id]))
+
+
+##############################################################################
+# Homepage and error pages
+
+
+@views.route('/')
+@page_cache.cached
+def homepage():
+    """Show homepage:
+
+    - anon users: no messages
+    - logged in: 100 most recent messages of followed_users
+    """
+
+    if g.user:
+        # The timeline needs the follows; likes are overlaid below.
+        settle_own_writes(g.user.id, writes.FOLLOW)
+        messages, _ = queries.timeline(g.user.id, limit=100)
+        suggested = suggested_ids(g.user.id)
+
+        return render_template(
+            'home.html', messages=messages,
+            likes=liked_by_viewer([msg.id for msg in messages]),
+            counts=queries.user_counts(g.user.id),
+            suggestions=queries.user_cards(suggested)
+        )
+
+    else:
+        return render_template('home-anon.html')
+
+
+@views.route('/trending')
+def show_trending():
+    """Show the hashtags, mentions and messages trending this hour."""
+
+    return render_template('trending.html', trending=trending.current())
+
+
+@views.route('/notifications')
+def show_notifications():
+    """Show the logged-in user's notifications, a page at a time.
+
+    Opening the first page marks them all read; the page still shows
+    which ones were new.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    before = before_id_cursor()
+    rows, next_cursor = queries.notifications(g.user.id, before=before)
+    if before is None:
+        notifications.mark_read(g.user.id)
+
+    return render_template('notifications.html', notifications=rows,
+                           next_cursor=next_cursor)
+
+
+##############################################################################
+# Turn off all caching in Flask
+#   (useful for dev; in production, this kind of stuff is typically
+#   handled elsewhere)
+#
+# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+
+@views.after_app_request
+def add_header(req):
+    """Add non-caching headers on every request."""
+
+    # Proxied thumbnails never change under their URL; browsers keep them.
+    if request.endpoint == 'images.thumbnail':
+        return req
+
+    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
+    req.headers["Pragma"] = "no-cache"
+    req.headers["Expires"] = "0"
+    req.headers['Cache-Control'] = 'public, max-age=0'
+    return req
+
+
+##############################################################################
+# Profile page helpers.
+
+# Profile reads: concurrent requests for the same profile share one
+# query, and the result is reused for PROFILE_CACHE_TTL seconds.
+profile_reads = singleflight.Cache('profile_reads', ttl=5)
+
+
+def shared_read(key, user_id, loader):
+    """`loader()`'s result for `key`, through `profile_reads`.
+
+    Users always see their own profile fresh.
+    """
+
+    ttl = current_app.config.get('PROFILE_CACHE_TTL',
+                                 0 if current_app.testing else 5)
+    if g.user and g.user.id == user_id:
+        ttl = 0
+
+    return profile_reads.get(key, loader, ttl=ttl)
+
+
+@jobs.on('message_posted')
+@jobs.on('message_deleted')
+def expire_profile_messages(message_id, user_id, **details):
+    profile_reads.delete(f"profile:{user_id}", f"messages:{user_id}")
+
+
+@jobs.on('follows_added')
+@jobs.on('follows_removed')
+def expire_profile_follows(user_id, followed_ids):
+    profile_reads.delete(f"profile:{user_id}",
+                         *(f"profile:{other}" for other in followed_ids))
+
+
+@jobs.on('like_added')
+@jobs.on('like_removed')
+def expire_profile_likes(user_id, message_id, author_id):
+    profile_reads.delete(f"profile:{user_id}")
+
+
+@jobs.on('user_updated')
+@jobs.on('user_deleted')
+def expire_profile(user_id):
+    profile_reads.delete(f"profile:{user_id}", f"messages:{user_id}")
+
+
+def profile_or_404(user_id):
+    """Profile header row with counts for the user pages, or 404."""
+
+    user = shared_read(f"profile:{user_id}", user_id,
+                       lambda: queries.profile(user_id))
+    if user is None:
+        abort(404)
+
+    return user
+
+
+def suggested_ids(user_id):
+    """Ids of the users suggested in `user_id`'s home sidebar.
+
+    Without GRAPH_INDEX, the sidebar doesn't make a process build the
+    follow graph; it shows suggestions once something has.
+    """
+
+    if current_app.config['GRAPH_INDEX'] or graph.index.ready:
+        return [suggested for suggested, score
+                in recommendations.engine.suggest(user_id)]
+
+    return []
+
+
+def followed_by_viewer(user_ids):
+    """Which of `user_ids` the logged-in user follows.
+
+    One query, or none when GRAPH_INDEX answers from the follow graph.
+    """
+
+    if not g.user:
+        return set()
+
+    if current_app.config['GRAPH_INDEX']:
+        followed = graph.index.following_among(g.user.id, user_ids)
+    else:
+        followed = Follows.followed_among(g.user.id, user_ids)
+
+    return writes.buffer.overlay(g.user.id, writes.FOLLOW, followed, user_ids)
+
+
+def liked_by_viewer(message_ids):
+    """Which of `message_ids` the logged-in user likes."""
+
+    liked = queries.liked_message_ids(g.user.id, message_ids)
+    return writes.buffer.overlay(g.user.id, writes.LIKE, liked, message_ids)
+
+
+def settle_own_writes(user_id, kind=None):
+    """Before showing `user_id`'s own likes or follows to them, write
+    their buffered ones (of `kind`, if given)."""
+
+    if g.user and g.user.id == user_id:
+        writes.buffer.settle(user_id, kind)
+
+
+def after_cursor():
+    """Decode the `after` keyset cursor of a paginated user list."""
+
+    token = request.args.get('after')
+    if not token:
+        return None
+
+    try:
+        return queries.decode_id_cursor(token)
+    except ValueError:
+        abort(400)
+
+
+def before_id_cursor():
+    """Decode the `before` keyset cursor of a newest-first id list."""
+
+    token = request.args.get('before')
+    if not token:
+        return None
+
+    try:
+        return queries.decode_id_cursor(token)
+    except ValueError:
+        abort(400)
+
+
+def before_cursor():
+    """Decode the `before` keyset cursor of a paginated message list."""
+
+    token = request.args.get('before')
+    if not token:
+        return None
+
+    try:
+        return queries.decode_message_cursor(token)
+    except ValueError:
+        abort(400)
+
+
+##############################################################################
+# Edit forms logics.
+
+def user_form_defaults_logic(form):
+    """
+    Process user edit form for populating object.
+    Use defaults when image inputs left blank.
+    Not trying to changing password - delete password.
+    The defaults logic could be moved into the User model to
+    set the images when input is blank.
+    """
+    if not form.image_url.data:
+        form.image_url.data = '/static/images/default-pic.png'
+    if not form.header_image_url.data:
+        form.header_image_url.data = '/static/images/warbler-hero.jpg'
+    del form.password
+
+    return form
+
+
+def populate_user_edit_form(form, user):
+    """Populate form data with user data for editing."""
+
+    form.username.data = user.username
+    form.email.data = user.email
+    form.image_url.data = (
+        user.image_url if
+        user.image_url and
+        user.image_url != '/static/images/default-pic.png'
+        else ''
+    )
+    form.header_image_url.data = (
+        user.header_image_url if
+        user.header_image_url and
+        user.header_image_url != '/static/images/warbler-hero.jpg'
+        else ''
+    )
+    form.bio.data = user.bio if user.bio else ''
+    form.location.data = user.location if user.location else ''
+
+    return form
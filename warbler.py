@@ -0,0 +1,185 @@
+"""Warbler's application factory.
+
+`create_app(profile)` builds a configured app. The profile picks a
+config class:
+
+- development: the default; local database, debug toolbar.
+- testing: TESTING on, `warbler-test` database, no toolbar.
+- production: everything from the environment; SECRET_KEY is required.
+
+Each reads DATABASE_URL, SECRET_KEY and the feature switches below from
+the environment; keyword arguments to `create_app()` override any of it.
+
+`app.py` builds the app the `flask` command and the tests import, with
+the profile named by WARBLER_PROFILE. A production server should build
+its own in the master process and fork workers from it, e.g.:
+
+    gunicorn --preload 'warbler:create_app("production")'
+
+Nothing here connects to the database or starts threads, so preloading
+is safe: workers share the imported code and templates, and the pool
+guard below keeps them from reusing a connection opened before the fork.
+"""
+
+import os
+
+from flask import Flask
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+import accounts
+import activity
+import images
+import jobs
+import notifications
+import partitions
+import profiling
+import sessions
+import slowlog
+import stream
+import writes
+from admin import admin
+from api import api
+from models import connect_db
+from pagecache import page_cache
+from views import CURR_USER_KEY, views
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = 'postgres:///warbler'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+    SECRET_KEY = "it's a secret"
+    DEBUG_TOOLBAR = False
+    GRAPH_INDEX = False
+    GRAPH_SNAPSHOT_PATH = None
+    ADMIN_USERNAMES = ()
+
+
+class DevelopmentConfig(Config):
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'postgresql:///warbler-test'
+
+
+class ProductionConfig(Config):
+    SECRET_KEY = None
+
+
+def _names(value):
+    """Parse a comma-separated list of names."""
+
+    return tuple(name.strip() for name in value.split(',') if name.strip())
+
+
+def _flag(value):
+    """Parse an on/off setting: 1, true, yes or on (any case) is on,
+    anything else off."""
+
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Settings taken from the environment when set: (variable, parser).
+ENVIRONMENT = {
+    'SQLALCHEMY_DATABASE_URI': ('DATABASE_URL', str),
+    'SECRET_KEY': ('SECRET_KEY', str),
+    'JOBS_PERSISTENT': ('JOBS_PERSISTENT', _flag),
+    'GRAPH_INDEX': ('GRAPH_INDEX', _flag),
+    'GRAPH_SNAPSHOT_PATH': ('GRAPH_SNAPSHOT_PATH', str),
+    'SESSION_STORE_URL': ('SESSION_STORE_URL', str),
+    'PAGE_CACHE_URL': ('PAGE_CACHE_URL', str),
+    'PAGE_CACHE_ENABLED': ('PAGE_CACHE_ENABLED', _flag),
+    'MESSAGE_PARTITIONS': ('MESSAGE_PARTITIONS', _flag),
+    'MESSAGE_ARCHIVE_DIR': ('MESSAGE_ARCHIVE_DIR', str),
+    'MESSAGE_HOT_MONTHS': ('MESSAGE_HOT_MONTHS', int),
+    'STREAM_BROKER_URL': ('STREAM_BROKER_URL', str),
+    'ADMIN_USERNAMES': ('ADMIN_USERNAMES', _names),
+    'SLOW_QUERY_MS': ('SLOW_QUERY_MS', int),
+    'SLOW_QUERY_LOG_PATH': ('SLOW_QUERY_LOG_PATH', str),
+}
+
+
+PROFILES = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
+
+
+def create_app(profile=None, **config):
+    """Build the app for `profile` (default: WARBLER_PROFILE, else
+    development), with `config` overriding its settings."""
+
+    profile = profile or os.environ.get('WARBLER_PROFILE', 'development')
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown profile {profile!r}; expected one of "
+                         f"{', '.join(PROFILES)}")
+
+    app = Flask(__name__)
+    app.config.from_object(PROFILES[profile])
+    for key, (variable, parse) in ENVIRONMENT.items():
+        if variable in os.environ:
+            app.config[key] = parse(os.environ[variable])
+    app.config.update(config)
+    app.config['PROFILE'] = profile
+
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError(f"The {profile} profile needs SECRET_KEY.")
+
+    # Only development pays for importing and installing the toolbar.
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    jobs.queue.init_app(app)
+    page_cache.init_app(app)
+    sessions.init_app(app, CURR_USER_KEY)
+    images.init_app(app)
+    writes.buffer.init_app(app)
+    stream.init_app(app)
+    notifications.init_app(app)
+    slowlog.init_app(app)
+    profiling.init_app(app)
+
+    app.cli.add_command(accounts.purge_user_command)
+    app.cli.add_command(activity.rebuild_activity_command)
+    app.cli.add_command(sessions.revoke_sessions_command)
+    app.cli.add_command(partitions.partition_messages_command)
+    app.cli.add_command(partitions.archive_messages_command)
+    app.cli.add_command(partitions.restore_messages_command)
+
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+    app.register_blueprint(admin)
+
+    return app
+
+
+##############################################################################
+# Fork safety
+#
+# A connection opened before a fork would be shared by parent and child,
+# and their traffic on the one socket would corrupt both. Each pooled
+# connection remembers the pid that opened it; checked out in another
+# process, it's dropped (without closing the parent's socket) and the
+# pool opens a fresh one.
+
+
+@event.listens_for(Pool, 'connect')
+def _remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def _check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    if connection_record.info.get('pid', pid) != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f"Connection opened in process {connection_record.info['pid']}"
+            f" checked out in {pid}")
@@ -0,0 +1,571 @@
+"""Likes and follows, optionally batched behind a write buffer.
+
+`toggle_like()`, `follow()` and `unfollow()` are how views change likes
+and follows. By default each commits at once and publishes its event,
+as the views always did.
+
+With WRITE_BUFFER_ENABLED, they record the wanted state of the (user,
+target) pair in a per-process buffer instead and return at once. A
+flusher thread writes the buffer every WRITE_BUFFER_INTERVAL seconds, or
+sooner once WRITE_BUFFER_MAX_PENDING pairs are waiting, with one
+set-based INSERT and one DELETE per table, then publishes the usual
+events for the rows that really changed. Repeated toggles of one pair
+are coalesced: like, unlike, like within an interval is one insert, and
+like then unlike is nothing at all.
+
+Users see their own writes at once: `overlay()` applies the acting
+user's unflushed writes to what the database says, and `settle()`
+flushes them before pages that list the user's own likes or follows.
+Both only know this process's buffer, so deployments with several
+processes should route a user's requests to one of them.
+
+Durability: without a journal, writes still in the buffer are lost if
+the process dies. With WRITE_BUFFER_JOURNAL_DIR, every write is appended
+to a journal file of the process before it's acknowledged, and the
+journals of dead processes are replayed by the next process to buffer
+a write. WRITE_BUFFER_FSYNC also syncs each append to disk, so writes
+survive the machine going down, at the cost of one fsync per write.
+
+Config:
+
+- WRITE_BUFFER_ENABLED: buffer likes and follows (default False).
+- WRITE_BUFFER_INTERVAL: seconds between flushes (default 0.5).
+- WRITE_BUFFER_MAX_PENDING: pairs waiting before an early flush
+  (default 500).
+- WRITE_BUFFER_AUTOFLUSH: run the flusher thread (default: on unless the
+  app is TESTING; tests call `buffer.flush()`).
+- WRITE_BUFFER_JOURNAL_DIR: directory of the journals (default None).
+- WRITE_BUFFER_FSYNC: fsync each journal append (default False).
+"""
+
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+from sqlalchemy import and_, or_
+
+import jobs
+import queries
+from models import db, insert_ignore, User, Message, Follows, Likes
+
+LIKE, FOLLOW = 'like', 'follow'
+
+# (model, actor column, target column) of each kind of pair.
+TABLES = {
+    LIKE: (Likes, Likes.user_id, Likes.message_id),
+    FOLLOW: (Follows, Follows.user_following_id,
+             Follows.user_being_followed_id),
+}
+
+
+##############################################################################
+# Journal
+
+
+class Journal:
+    """Append-only file of this process's buffered writes.
+
+    The file stays locked while the process lives; a journal nobody
+    holds a lock on belongs to a dead process and is replayed.
+    """
+
+    def __init__(self, directory, fsync):
+        self.directory = directory
+        self.fsync = fsync
+        self._file = None
+
+    def _open(self, suffix):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.{suffix}")
+        f = open(path, 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def append(self, user_id, kind, target, state):
+        if self._file is None:
+            self._file = self._open('log')
+
+        self._file.write(json.dumps([user_id, kind, target, state]) + '\n')
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+
+    def rotate(self):
+        """Start a new file; the old one is deleted by `done(old)` once
+        its writes are committed."""
+
+        old = self._file
+        if old is not None:
+            os.rename(old.name, old.name[:-len('log')] + 'flushing')
+            self._file = None
+
+        return old
+
+    def done(self, old):
+        if old is not None:
+            os.remove(old.name[:-len('log')] + 'flushing')
+            old.close()
+
+    def orphans(self):
+        """Writes in journals of dead processes; their files are removed."""
+
+        paths = [path for path in glob.glob(os.path.join(self.directory, '*'))
+                 if path.endswith(('.log', '.flushing'))]
+
+        writes = []
+        for path in sorted(paths, key=_mtime):
+            try:
+                f = open(path)
+            except OSError:
+                continue
+
+            with f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # a live process's journal
+
+                for line in f:
+                    try:
+                        writes.append(tuple(json.loads(line)))
+                    except ValueError:
+                        break  # torn last line
+
+                os.remove(path)
+
+        return writes
+
+
+def _mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0
+
+
+##############################################################################
+# Buffer
+
+
+class WriteBuffer:
+    """Per-process buffer of wanted like and follow states."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.stats = Counter()
+        self.journal = None
+        # {user_id: {(kind, target): wanted state}}
+        self._pending = defaultdict(dict)
+        self._inflight = defaultdict(dict)
+        self._size = 0
+        self._cond = threading.Condition()
+        self._flushing = threading.Lock()
+        self._pid = None
+        self._recovered = False
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('WRITE_BUFFER_ENABLED', False)
+        app.config.setdefault('WRITE_BUFFER_INTERVAL', 0.5)
+        app.config.setdefault('WRITE_BUFFER_MAX_PENDING', 500)
+        app.config.setdefault('WRITE_BUFFER_JOURNAL_DIR', None)
+        app.config.setdefault('WRITE_BUFFER_FSYNC', False)
+
+        self.app = app
+        if app.config['WRITE_BUFFER_JOURNAL_DIR']:
+            self.journal = Journal(app.config['WRITE_BUFFER_JOURNAL_DIR'],
+                                   app.config['WRITE_BUFFER_FSYNC'])
+
+    @property
+    def enabled(self):
+        return self.app.config['WRITE_BUFFER_ENABLED']
+
+    @property
+    def autoflush(self):
+        return self.app.config.get('WRITE_BUFFER_AUTOFLUSH',
+                                   not self.app.testing)
+
+    def __len__(self):
+        return self._size
+
+    def record(self, user_id, kind, target, state):
+        """Buffer `user_id`'s wanted `state` of the (kind, target) pair."""
+
+        self._recover()
+
+        with self._cond:
+            if self.journal is not None:
+                self.journal.append(user_id, kind, target, state)
+
+            writes = self._pending[user_id]
+            if (kind, target) in writes:
+                self.stats['coalesced'] += 1
+            else:
+                self._size += 1
+            writes[(kind, target)] = state
+            self.stats['writes'] += 1
+
+            if self._size >= self.app.config['WRITE_BUFFER_MAX_PENDING']:
+                self._cond.notify()
+
+        if self.autoflush:
+            self.start()
+
+    def state(self, user_id, kind, target):
+        """Unflushed wanted state of the pair, or None if there's none."""
+
+        with self._cond:
+            for writes in (self._pending, self._inflight):
+                state = writes.get(user_id, {}).get((kind, target))
+                if state is not None:
+                    return state
+
+        return None
+
+    def overlay(self, user_id, kind, found, candidates):
+        """`found`, the targets among `candidates` the database has for
+        `user_id`, with the user's unflushed writes applied."""
+
+        with self._cond:
+            if user_id not in self._pending and user_id not in self._inflight:
+                return found
+
+            found = set(found)
+            for target in candidates:
+                for writes in (self._pending, self._inflight):
+                    state = writes.get(user_id, {}).get((kind, target))
+                    if state is not None:
+                        break
+                if state is True:
+                    found.add(target)
+                elif state is False:
+                    found.discard(target)
+
+        return found
+
+    def has_writes(self, user_id):
+        """Does `user_id` have unflushed writes in this process?"""
+
+        with self._cond:
+            return user_id in self._pending or user_id in self._inflight
+
+    def settle(self, user_id, kind=None):
+        """Write `user_id`'s buffered writes (of `kind`, if given) now."""
+
+        if self.has_writes(user_id):
+            self.flush(user_id, kind)
+
+    ##########################################################################
+    # Flushing
+
+    def start(self):
+        """Start the flusher thread in this process if not running."""
+
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True,
+                             name='warbler-write-buffer').start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait(self.app.config['WRITE_BUFFER_INTERVAL'])
+                if self._pid != os.getpid():
+                    return
+
+            if self._size:
+                with self.app.app_context():
+                    try:
+                        self.flush()
+                    except Exception:
+                        self.app.logger.exception("Write buffer flush failed")
+
+    def stop(self):
+        """Stop the flusher thread and drop buffered writes."""
+
+        with self._cond:
+            self._pid = None
+            self._pending.clear()
+            self._size = 0
+            self._cond.notify_all()
+
+    def _recover(self):
+        if self._recovered:
+            return
+        self._recovered = True
+
+        if self.journal is not None:
+            orphans = self.journal.orphans()
+            for user_id, kind, target, state in orphans:
+                self.record(user_id, kind, target, state)
+            self.stats['recovered'] += len(orphans)
+
+    def flush(self, user_id=None, kind=None):
+        """Write buffered writes in bulk and publish their events; only
+        `user_id`'s of `kind`, if given. Returns how many rows changed."""
+
+        with self._flushing:
+            with self._cond:
+                if user_id is None:
+                    batch = dict(self._pending)
+                    self._pending.clear()
+                else:
+                    batch = {user_id: self._take(user_id, kind)}
+                rows = sum(len(writes) for writes in batch.values())
+                if not rows:
+                    return 0
+
+                # A settled user's writes stay in the journal until the
+                # next full flush; replaying them is harmless.
+                old_journal = (self.journal.rotate()
+                               if self.journal is not None
+                               and user_id is None else None)
+                self._size -= rows
+                self._inflight.update(batch)
+
+            started = time.time()
+            try:
+                changes = _apply(batch)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                with self._cond:
+                    self.stats['errors'] += 1
+                    self._requeue(batch)
+                    if old_journal is not None:
+                        self.journal.done(old_journal)
+                raise
+            finally:
+                with self._cond:
+                    for actor in batch:
+                        self._inflight.pop(actor, None)
+
+            elapsed = time.time() - started
+            with self._cond:
+                self.stats['flushes'] += 1
+                self.stats['flushed_pairs'] += rows
+                self.stats['changed_rows'] += len(changes)
+                self.stats['max_batch'] = max(self.stats['max_batch'], rows)
+                self.stats['flush_ms_total'] += int(elapsed * 1000)
+                self.stats['max_flush_ms'] = max(self.stats['max_flush_ms'],
+                                                 int(elapsed * 1000))
+
+            if old_journal is not None:
+                self.journal.done(old_journal)
+
+        _publish(changes)
+        return len(changes)
+
+    def _take(self, user_id, kind):
+        writes = self._pending.pop(user_id, {})
+        if kind is not None:
+            rest = {pair: state for pair, state in writes.items()
+                    if pair[0] != kind}
+            if rest:
+                self._pending[user_id] = rest
+            writes = {pair: state for pair, state in writes.items()
+                      if pair[0] == kind}
+
+        return writes
+
+    def _requeue(self, batch):
+        """Put back a failed batch under anything buffered since."""
+
+        for actor, writes in batch.items():
+            newer = self._pending[actor]
+            for pair, state in writes.items():
+                if pair not in newer:
+                    newer[pair] = state
+                    self._size += 1
+                    if self.journal is not None:
+                        self.journal.append(actor, pair[0], pair[1], state)
+
+    def metrics(self):
+        """Buffer counters, with the mean batch size and flush time."""
+
+        with self._cond:
+            stats = dict(self.stats, pending=self._size)
+
+        flushes = stats.get('flushes', 0)
+        if flushes:
+            stats['mean_batch'] = round(stats['flushed_pairs'] / flushes, 1)
+            stats['mean_flush_ms'] = round(
+                stats['flush_ms_total'] / flushes, 1)
+
+        return stats
+
+
+def _apply(batch):
+    """Bring the tables to the wanted states in `batch`.
+
+    Returns the `(kind, user_id, target, added)` of each row changed.
+    """
+
+    wanted = defaultdict(dict)
+    for user_id, writes in batch.items():
+        for (kind, target), state in writes.items():
+            wanted[kind][(user_id, target)] = state
+
+    users = {user_id for user_id in batch}
+    users.update(target for user_id, target in wanted[FOLLOW])
+    live = {row.id for row in db.session.query(User.id).filter(
+        User.id.in_(users), User.deleted_at.is_(None))} if users else set()
+
+    changes = []
+    for kind, pairs in wanted.items():
+        if not pairs:
+            continue
+
+        model, actor, target = TABLES[kind]
+        existing = _existing(actor, target, pairs)
+        if kind == LIKE:
+            messages = {pair[1] for pair in pairs}
+            valid = {row.id for row in db.session.query(Message.id).filter(
+                Message.id.in_(messages))}
+        else:
+            valid = live
+
+        added = [pair for pair, state in pairs.items()
+                 if state and pair not in existing
+                 and pair[0] in live and pair[1] in valid]
+        removed = [pair for pair, state in pairs.items()
+                   if not state and pair in existing]
+
+        insert_ignore(model.__table__, [
+            {actor.key: user_id, target.key: other}
+            for user_id, other in added])
+        if removed:
+            (model.query
+             .filter(_pairs_filter(actor, target, removed))
+             .delete(synchronize_session=False))
+
+        changes += [(kind, user_id, other, True) for user_id, other in added]
+        changes += [(kind, user_id, other, False)
+                    for user_id, other in removed]
+
+    return changes
+
+
+def _pairs_filter(actor, target, pairs):
+    by_actor = defaultdict(list)
+    for user_id, other in pairs:
+        by_actor[user_id].append(other)
+
+    return or_(*(and_(actor == user_id, target.in_(others))
+                 for user_id, others in by_actor.items()))
+
+
+def _existing(actor, target, pairs):
+    rows = db.session.query(actor, target).filter(
+        _pairs_filter(actor, target, pairs))
+    return {tuple(row) for row in rows}
+
+
+def _publish(changes):
+    likes = [change for change in changes if change[0] == LIKE]
+    if likes:
+        authors = dict(db.session.query(Message.id, Message.user_id).filter(
+            Message.id.in_({target for kind, u, target, a in likes})))
+        for kind, user_id, message_id, added in likes:
+            if message_id in authors:
+                jobs.publish('like_added' if added else 'like_removed',
+                             user_id=user_id, message_id=message_id,
+                             author_id=authors[message_id])
+
+    follows = defaultdict(list)
+    for kind, user_id, other, added in changes:
+        if kind == FOLLOW:
+            follows[(user_id, added)].append(other)
+    for (user_id, added), others in follows.items():
+        jobs.publish('follows_added' if added else 'follows_removed',
+                     user_id=user_id, followed_ids=others)
+
+
+buffer = WriteBuffer()
+
+
+##############################################################################
+# Write paths
+
+
+def toggle_like(user_id, message):
+    """Like `message` for `user_id`, or unlike it if they already do.
+
+    Returns 'like_added' or 'like_removed'.
+    """
+
+    if not buffer.enabled:
+        liked = bool(queries.liked_message_ids(user_id, [message.id]))
+        if liked:
+            (Likes.query
+             .filter_by(user_id=user_id, message_id=message.id)
+             .delete(synchronize_session=False))
+        else:
+            insert_ignore(Likes.__table__,
+                          [{'user_id': user_id, 'message_id': message.id}])
+        db.session.commit()
+
+        event = 'like_removed' if liked else 'like_added'
+        jobs.publish(event, user_id=user_id, message_id=message.id,
+                     author_id=message.user_id)
+        return event
+
+    liked = buffer.state(user_id, LIKE, message.id)
+    if liked is None:
+        liked = bool(queries.liked_message_ids(user_id, [message.id]))
+
+    buffer.record(user_id, LIKE, message.id, not liked)
+    return 'like_removed' if liked else 'like_added'
+
+
+def follow(user_id, follow_id):
+    """Make `user_id` follow `follow_id`.
+
+    Returns 'followed', 'already_following', 'not_found' or 'self', like
+    `Follows.follow_many()`; buffered follows are always 'followed'.
+    """
+
+    if not buffer.enabled:
+        result = Follows.follow_many(user_id, [follow_id])[follow_id]
+        if result in ('followed', 'already_following'):
+            db.session.commit()
+        if result == 'followed':
+            jobs.publish('follows_added', user_id=user_id,
+                         followed_ids=[follow_id])
+        return result
+
+    if follow_id == user_id:
+        return 'self'
+
+    exists = (db.session.query(User.id)
+              .filter(User.id == follow_id, User.deleted_at.is_(None))
+              .first())
+    if exists is None:
+        return 'not_found'
+
+    buffer.record(user_id, FOLLOW, follow_id, True)
+    return 'followed'
+
+
+def unfollow(user_id, follow_id):
+    """Make `user_id` stop following `follow_id`."""
+
+    if not buffer.enabled:
+        result = Follows.unfollow_many(user_id, [follow_id])[follow_id]
+        db.session.commit()
+        if result == 'unfollowed':
+            jobs.publish('follows_removed', user_id=user_id,
+                         followed_ids=[follow_id])
+        return result
+
+    buffer.record(user_id, FOLLOW, follow_id, False)
+    return 'unfollowed'